@@ -0,0 +1,224 @@
+"""Docstore benchmarks: chunking, ingestion throughput and /query latency.
+
+For every corpus size a synthetic corpus is indexed into a fresh data directory
+with the same pipeline as load_documents.py, then a docstore API is started on
+that index and queried at each concurrency level. Needs the docstore's
+environment and embedding model (models/download_model.py).
+
+    cd llm-assistant-docstore && source .venv/bin/activate
+    python ../bench/bench_docstore.py --sizes 100,1000 --concurrency 1,4,16
+    python ../bench/bench_docstore.py --sizes 1000 --embedding-backend onnx-int8
+"""
+import argparse
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List
+
+from common import REPO_ROOT, latency_summary, peak_rss_mb, percentile, write_results
+from corpus import SyntheticCorpus
+
+DOCSTORE_DIR = REPO_ROOT / "llm-assistant-docstore"
+sys.path.insert(0, str(DOCSTORE_DIR))
+
+
+def bench_chunking(corpus_dir: Path, args) -> dict:
+    from app.services.chunking import chunk_spans
+
+    texts = [path.read_text(encoding="utf-8") for path in sorted(corpus_dir.glob("*.txt"))]
+    size = sum(len(text) for text in texts)
+    started = time.perf_counter()
+    chunks = sum(len(chunk_spans(text, args.chunk_tokens, args.chunk_overlap)) for text in texts)
+    elapsed = max(time.perf_counter() - started, 1e-9)
+    return {
+        "chunking_seconds": round(elapsed, 4),
+        "chunking_mb_per_second": round(size / 1024 ** 2 / elapsed, 2),
+        "chunking_chunks_per_second": round(chunks / elapsed, 1),
+    }
+
+
+def bench_ingestion(workdir: Path, args) -> dict:
+    from load_documents import load_documents
+
+    # load_documents and the API resolve data/ and models/ against the working directory
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        stats = load_documents(
+            documents_dir="corpus",
+            embed_batch_size=args.embed_batch_size,
+            upsert_batch_size=args.upsert_batch_size,
+            reader_threads=args.readers,
+            chunk_tokens=args.chunk_tokens,
+            chunk_overlap=args.chunk_overlap
+        )
+    finally:
+        os.chdir(cwd)
+    elapsed = max(stats.elapsed, 1e-9)
+    return {
+        "chunks": stats.chunks,
+        "ingestion_seconds": round(elapsed, 3),
+        "ingestion_documents_per_second": round(stats.documents / elapsed, 2),
+        "ingestion_chunks_per_second": round(stats.chunks / elapsed, 2),
+        "ingestion_failed": stats.failed,
+        "ingestion_peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def start_server(workdir: Path, port: int, timeout: float) -> subprocess.Popen:
+    env = dict(os.environ, PYTHONPATH=str(DOCSTORE_DIR))
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"],
+        cwd=workdir,
+        env=env
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"Docstore exited with code {server.returncode} during startup")
+        try:
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/ready", timeout=1):
+                return server
+        except (urllib.error.URLError, ConnectionError):
+            time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError(f"Docstore did not become ready within {timeout}s")
+
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    """Parse 'span;dur=1.2, other;dur=3.4' into seconds per span"""
+    spans = {}
+    for entry in filter(None, (part.strip() for part in header.split(","))):
+        name, _, duration = entry.partition(";dur=")
+        if duration:
+            spans[name] = float(duration) / 1000
+    return spans
+
+
+def send_query(port: int, query: str, num_results: int) -> tuple:
+    body = json.dumps({"query": query, "num_results": num_results}).encode("utf-8")
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/query",
+        data=body,
+        headers={"Content-Type": "application/json"}
+    )
+    started = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=60) as response:
+            response.read()
+            spans = parse_server_timing(response.headers.get("Server-Timing", ""))
+        return time.perf_counter() - started, spans, None
+    except (urllib.error.URLError, ConnectionError) as e:
+        return time.perf_counter() - started, {}, str(e)
+
+
+def bench_queries(port: int, queries: List[str], concurrency: int, num_results: int) -> dict:
+    latencies, errors = [], 0
+    spans: Dict[str, List[float]] = {}
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for latency, server_spans, error in pool.map(lambda q: send_query(port, q, num_results), queries):
+            if error:
+                errors += 1
+                continue
+            latencies.append(latency)
+            for span, seconds in server_spans.items():
+                spans.setdefault(span, []).append(seconds)
+    elapsed = max(time.perf_counter() - started, 1e-9)
+
+    result = {
+        "concurrency": concurrency,
+        "requests": len(queries),
+        "errors": errors,
+        "queries_per_second": round(len(latencies) / elapsed, 2),
+        **latency_summary(latencies),
+    }
+    for span, values in sorted(spans.items()):
+        result[f"server_{span}_p50_seconds"] = round(percentile(values, 50), 5)
+    return result
+
+
+def run(args):
+    # Read by load_documents and inherited by the docstore under test
+    os.environ["EMBEDDING_BACKEND"] = args.embedding_backend
+    corpus = SyntheticCorpus(seed=args.seed, words_per_document=args.words_per_document)
+    results = []
+    for size in args.sizes:
+        workdir = Path(tempfile.mkdtemp(prefix=f"docstore-bench-{size}-"))
+        try:
+            (workdir / "models").symlink_to(DOCSTORE_DIR / "models", target_is_directory=True)
+            corpus_bytes = corpus.write(str(workdir / "corpus"), size)
+            logging.info(f"Corpus of {size} documents ({corpus_bytes / 1024 ** 2:.1f} MiB) in {workdir}")
+
+            result = {"documents": size, "corpus_mb": round(corpus_bytes / 1024 ** 2, 2)}
+            result.update(bench_chunking(workdir / "corpus", args))
+            result.update(bench_ingestion(workdir, args))
+            logging.info(f"Ingestion: {result['ingestion_documents_per_second']} documents/s")
+
+            if not args.skip_queries:
+                per_level = args.warmup + args.requests
+                queries = corpus.queries(per_level * len(args.concurrency), size)
+                server = start_server(workdir, args.port, args.startup_timeout)
+                try:
+                    result["query"] = []
+                    for index, concurrency in enumerate(args.concurrency):
+                        # Fresh queries per level so the embedding cache does not flatter later levels
+                        level_queries = queries[index * per_level:(index + 1) * per_level]
+                        bench_queries(args.port, level_queries[:args.warmup], concurrency, args.num_results)
+                        level = bench_queries(args.port, level_queries[args.warmup:], concurrency, args.num_results)
+                        logging.info(
+                            f"/query at concurrency {concurrency}: p50 {level.get('latency_p50_seconds')}s, "
+                            f"p99 {level.get('latency_p99_seconds')}s, {level['queries_per_second']} queries/s"
+                        )
+                        result["query"].append(level)
+                finally:
+                    server.terminate()
+                    server.wait(timeout=30)
+            results.append(result)
+        finally:
+            if args.keep_workdir:
+                logging.info(f"Kept {workdir}")
+            else:
+                shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def int_list(value: str) -> List[int]:
+    return [int(part) for part in value.split(",") if part]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Benchmark docstore ingestion and query latency")
+    parser.add_argument("--sizes", type=int_list, default=[100, 1000], help="Corpus sizes in documents")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 4, 16], help="Concurrent /query clients")
+    parser.add_argument("--requests", type=int, default=200, help="Measured queries per concurrency level")
+    parser.add_argument("--warmup", type=int, default=10, help="Unmeasured queries per concurrency level")
+    parser.add_argument("--num-results", type=int, default=3)
+    parser.add_argument("--words-per-document", type=int, default=800)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--embed-batch-size", type=int, default=64)
+    parser.add_argument("--embedding-backend", default=os.getenv("EMBEDDING_BACKEND", "torch"), help="torch, onnx or onnx-int8")
+    parser.add_argument("--upsert-batch-size", type=int, default=512)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--chunk-tokens", type=int, default=128)
+    parser.add_argument("--chunk-overlap", type=int, default=16)
+    parser.add_argument("--port", type=int, default=8011, help="Port for the docstore under test")
+    parser.add_argument("--startup-timeout", type=float, default=300.0)
+    parser.add_argument("--skip-queries", action="store_true", help="Only benchmark chunking and ingestion")
+    parser.add_argument("--keep-workdir", action="store_true", help="Keep the generated corpus and index")
+    parser.add_argument("--output", default=str(REPO_ROOT / "bench" / "results" / "docstore.json"))
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key not in ("output", "keep_workdir", "port")}
+    write_results(args.output, "docstore", config, run(args))
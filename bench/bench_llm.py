@@ -0,0 +1,256 @@
+"""Generation benchmarks: time to first token and tokens/s of LLMService.
+
+Chat turns go through LLMService.generate_response_stream, so prompt building,
+context assembly and the inference queue are all measured. Runs against a
+local GGUF model (--model) or, without one, a stub model that evaluates and
+generates at fixed rates, which isolates the service's own overhead.
+
+Retrieval is replaced by a fixed synthetic context of --context-tokens,
+returned after --retrieval-latency-ms, unless --docstore-url points at a
+running docstore. --history-turns gives every question earlier turns, whose
+evaluation pipelined prefill overlaps with retrieval. With --speculative every
+concurrency level is measured once per speculative mode, which needs --model.
+
+    cd llm-assistant-backend && source .venv/bin/activate
+    python ../bench/bench_llm.py --model app/models/qwen2-0_5b-instruct-q4_0.gguf
+    python ../bench/bench_llm.py --model app/models/qwen2-0_5b-instruct-q4_0.gguf --speculative off,prompt_lookup
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import time
+import zlib
+from pathlib import Path
+from typing import List, Optional
+
+from common import REPO_ROOT, latency_summary, peak_rss_mb, write_results
+from corpus import SyntheticCorpus
+
+BACKEND_DIR = REPO_ROOT / "llm-assistant-backend"
+sys.path.insert(0, str(BACKEND_DIR))
+
+# Rough bytes per token of English text, used by the stub tokenizer
+STUB_BYTES_PER_TOKEN = 4
+
+
+class StubLlama:
+    """Stands in for llama_cpp.Llama with fixed prompt evaluation and generation rates.
+
+    Like llama.cpp it keeps the tokens in its context and only evaluates the
+    part of a prompt that follows the prefix it shares with them.
+    """
+
+    def __init__(self, prompt_tokens_per_second: float, tokens_per_second: float, words: List[str]):
+        self.prompt_tokens_per_second = prompt_tokens_per_second
+        self.tokens_per_second = tokens_per_second
+        self.words = words
+        self.input_ids: List[int] = []
+        self.n_tokens = 0
+
+    def tokenize(self, text: bytes, add_bos: bool = True) -> List[int]:
+        # Equal text gives equal tokens, so shared prefixes are found
+        return [1] * int(add_bos) + [
+            zlib.crc32(text[start:start + STUB_BYTES_PER_TOKEN])
+            for start in range(0, len(text), STUB_BYTES_PER_TOKEN)
+        ]
+
+    def eval(self, tokens: List[int]):
+        time.sleep(len(tokens) / self.prompt_tokens_per_second)
+        self.input_ids = self.input_ids[:self.n_tokens] + list(tokens)
+        self.n_tokens = len(self.input_ids)
+
+    def __call__(self, prompt: str, stream: bool = False, max_tokens: int = 16, **params):
+        tokens = self.tokenize(prompt.encode("utf-8"))
+        common = 0
+        for cached, token in zip(self.input_ids[:self.n_tokens], tokens[:-1]):
+            if cached != token:
+                break
+            common += 1
+        self.n_tokens = common
+        self.eval(tokens[common:])
+        for index in range(max_tokens):
+            if index:
+                time.sleep(1 / self.tokens_per_second)
+            yield {"choices": [{"text": f" {self.words[index % len(self.words)]}"}]}
+
+
+def load_models(args) -> list:
+    """One model per worker"""
+    if args.model:
+        from llama_cpp import Llama
+
+        logging.getLogger("llama_cpp").setLevel(logging.ERROR)
+        n_threads = max(1, (os.cpu_count() or 2) // 2 // args.workers)
+        # Speculative decoding checks drafted tokens with the logits of every position
+        logits_all = any(mode != "off" for mode in args.speculative)
+        return [
+            Llama(model_path=args.model, n_gpu_layers=args.gpu_layers, n_ctx=args.n_ctx, n_threads=n_threads, logits_all=logits_all, verbose=False)
+            for _ in range(args.workers)
+        ]
+    corpus = SyntheticCorpus(seed=args.seed)
+    return [StubLlama(args.stub_prompt_rate, args.stub_generation_rate, corpus.document(0).split()) for _ in range(args.workers)]
+
+
+async def run_turn(service, question: str, history: list, speculative: str, args) -> Optional[dict]:
+    from app.models.chat import ChatMessage
+    from app.services.inference_worker import QueueFullError
+
+    try:
+        slot = service.reserve_slot()
+    except QueueFullError:
+        return None
+    usage, timings = {}, {}
+    messages = [*history, ChatMessage(role="user", content=question)]
+    async for _ in service.generate_response_stream(
+        messages,
+        temperature=args.temperature,
+        max_tokens=args.max_tokens,
+        slot=slot,
+        usage=usage,
+        timings=timings,
+        speculative=speculative
+    ):
+        pass
+    return {**usage, **timings}
+
+
+def synthetic_history(corpus, turns: int, seed: int) -> list:
+    """Earlier questions and answers, different for every seed"""
+    from app.models.chat import ChatMessage
+
+    words = corpus.document(seed + 2).split()
+    history = []
+    for turn in range(turns):
+        history.append(ChatMessage(role="user", content=" ".join(words[turn * 80:turn * 80 + 20])))
+        history.append(ChatMessage(role="assistant", content=" ".join(words[turn * 80 + 20:turn * 80 + 80])))
+    return history
+
+
+async def bench_level(service, corpus, questions: List[str], concurrency: int, speculative: str, args) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(question: str):
+        # Every question has its own history, so no turn finds another's prefix in the context
+        history = synthetic_history(corpus, args.history_turns, zlib.crc32(question.encode("utf-8"))) if args.history_turns else []
+        async with semaphore:
+            return await run_turn(service, question, history, speculative, args)
+
+    started = time.perf_counter()
+    turns = await asyncio.gather(*(limited(question) for question in questions))
+    elapsed = max(time.perf_counter() - started, 1e-9)
+
+    completed = [turn for turn in turns if turn is not None]
+    generated = sum(turn.get("generated_tokens", 0) for turn in completed)
+    result = {
+        "speculative": speculative,
+        "concurrency": concurrency,
+        "turns": len(questions),
+        "rejected": len(turns) - len(completed),
+        "aggregate_tokens_per_second": round(generated / elapsed, 2),
+        "mean_prompt_tokens": round(sum(turn.get("prompt_tokens", 0) for turn in completed) / max(len(completed), 1), 1),
+        "mean_generated_tokens": round(generated / max(len(completed), 1), 1),
+    }
+    for metric in ("time_to_first_token", "queue_wait", "prefill", "prompt_eval", "total"):
+        result.update(latency_summary([turn[metric] for turn in completed if metric in turn], metric))
+    rates = [turn["tokens_per_second"] for turn in completed if "tokens_per_second" in turn]
+    if rates:
+        result["tokens_per_second_mean"] = round(sum(rates) / len(rates), 2)
+        result["tokens_per_second_min"] = round(min(rates), 2)
+    drafted = sum(turn.get("draft_tokens", 0) for turn in completed)
+    if drafted:
+        result["acceptance_rate"] = round(sum(turn.get("accepted_draft_tokens", 0) for turn in completed) / drafted, 4)
+    return result
+
+
+async def run(args) -> List[dict]:
+    os.environ["LLM_N_CTX"] = str(args.n_ctx)
+    os.environ["CONTEXT_TOKEN_BUDGET"] = str(args.context_tokens)
+    os.environ["INFERENCE_QUEUE_SIZE"] = str(max(args.concurrency))
+    os.environ["LLM_WORKERS"] = str(args.workers)
+    os.environ["PIPELINED_PREFILL"] = "true" if args.pipelined_prefill else "false"
+    if any(mode != "off" for mode in args.speculative):
+        if not args.model:
+            raise SystemExit("Speculative decoding needs a real model, pass --model")
+        os.environ["SPECULATIVE_DECODING"] = "true"
+        os.environ["SPECULATIVE_DRAFT_TOKENS"] = str(args.draft_tokens)
+        if args.draft_model:
+            os.environ["DRAFT_MODEL_PATH"] = args.draft_model
+    from app.services.llm_service import LLMService
+
+    loading_started = time.perf_counter()
+    llms = load_models(args)
+    model_load_seconds = round(time.perf_counter() - loading_started, 3)
+    service = LLMService(docstore_url=args.docstore_url or "http://127.0.0.1:8001", llms=llms)
+
+    corpus = SyntheticCorpus(seed=args.seed)
+    if not args.docstore_url:
+        context = corpus.document(1)
+        context_tokens = service.count_tokens(context)
+        while context_tokens > args.context_tokens:
+            context = context[:int(len(context) * args.context_tokens / context_tokens * 0.95)]
+            context_tokens = service.count_tokens(context)
+
+        async def fixed_context(query, token_budget=None, timings=None):
+            await asyncio.sleep(args.retrieval_latency_ms / 1000)
+            return context, context_tokens
+
+        service.get_context = fixed_context
+
+    results = []
+    try:
+        for speculative in args.speculative:
+            for concurrency in args.concurrency:
+                questions = corpus.queries(args.warmup + args.turns, 50)
+                await bench_level(service, corpus, questions[:args.warmup], concurrency, speculative, args)
+                level = await bench_level(service, corpus, questions[args.warmup:], concurrency, speculative, args)
+                level["model_load_seconds"] = model_load_seconds
+                level["peak_rss_mb"] = peak_rss_mb()
+                level["worker_utilisation"] = [worker["utilisation"] for worker in service.pool.stats()["per_worker"]]
+                logging.info(
+                    f"Speculative {speculative}, concurrency {concurrency}: "
+                    f"time to first token p50 {level.get('time_to_first_token_p50_seconds')}s, "
+                    f"{level.get('tokens_per_second_mean')} tokens/s per turn, acceptance rate {level.get('acceptance_rate')}"
+                )
+                results.append(level)
+    finally:
+        await service.pool.close()
+        await service.docstore.close()
+    return results
+
+
+def int_list(value: str) -> List[int]:
+    return [int(part) for part in value.split(",") if part]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Benchmark time to first token and generation speed")
+    parser.add_argument("--model", help="GGUF model to load; a stub model is used when omitted")
+    parser.add_argument("--gpu-layers", type=int, default=32)
+    parser.add_argument("--n-ctx", type=int, default=4096)
+    parser.add_argument("--workers", type=int, default=1, help="Model workers, each with its own instance")
+    parser.add_argument("--concurrency", type=int_list, default=[1, 2, 4], help="Concurrent chat turns")
+    parser.add_argument("--turns", type=int, default=8, help="Measured chat turns per concurrency level")
+    parser.add_argument("--warmup", type=int, default=1, help="Unmeasured chat turns per concurrency level")
+    parser.add_argument("--max-tokens", type=int, default=64)
+    parser.add_argument("--temperature", type=float, default=0.15)
+    parser.add_argument("--context-tokens", type=int, default=1000, help="Size of the synthetic retrieved context")
+    parser.add_argument("--speculative", type=lambda value: value.split(","), default=["off"], help="Speculative modes to measure: off, prompt_lookup, draft")
+    parser.add_argument("--draft-model", help="Small GGUF model for the draft mode, with the same tokenizer as --model")
+    parser.add_argument("--draft-tokens", type=int, default=10, help="Tokens drafted per forward pass")
+    parser.add_argument("--retrieval-latency-ms", type=float, default=0.0, help="Delay of the synthetic retrieval")
+    parser.add_argument("--history-turns", type=int, default=0, help="Earlier turns of every question")
+    parser.add_argument("--no-pipelined-prefill", dest="pipelined_prefill", action="store_false", help="Evaluate the prompt only after retrieval")
+    parser.add_argument("--docstore-url", help="Retrieve context from this running docstore instead")
+    parser.add_argument("--stub-prompt-rate", type=float, default=2000.0, help="Stub prompt tokens evaluated per second")
+    parser.add_argument("--stub-generation-rate", type=float, default=50.0, help="Stub tokens generated per second")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=str(REPO_ROOT / "bench" / "results" / "llm.json"))
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    config["model"] = Path(args.model).name if args.model else "stub"
+    write_results(args.output, "llm", config, asyncio.run(run(args)))
@@ -0,0 +1,297 @@
+"""Vector search benchmarks: recall and latency of the compact vector index against exact search and Chroma.
+
+Synthetic unit vectors around random topic centres stand in for chunk
+embeddings, generated block by block from a fixed seed so corpora of millions
+of vectors never have to fit in memory. Recall@k is measured against an exact
+float32 scan of the same vectors. Needs numpy, and chromadb for --chroma and
+--server-path.
+
+With --server-path, every backend's stores are also written the way ingestion
+writes them, Chroma included, and then queried the way the API does in a fresh
+process, whose peak resident memory is reported as server_peak_rss_mb.
+
+    cd llm-assistant-docstore && source .venv/bin/activate
+    python ../bench/bench_vectors.py --sizes 100000,1000000 --chroma --server-path
+"""
+import argparse
+import logging
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Callable, List
+
+import numpy as np
+
+from common import REPO_ROOT, latency_summary, peak_rss_mb, write_results
+
+DOCSTORE_DIR = REPO_ROOT / "llm-assistant-docstore"
+sys.path.insert(0, str(DOCSTORE_DIR))
+
+# Vectors generated per block, every block has its own seed
+BLOCK = 10000
+
+
+class SyntheticVectors:
+    def __init__(self, seed: int, dim: int, topics: int, noise: float):
+        self.seed = seed
+        self.dim = dim
+        self.noise = noise
+        self.centres = self._normalize(np.random.default_rng(seed).standard_normal((topics, dim), dtype=np.float32))
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    def _around_centres(self, rng: np.random.Generator, count: int) -> np.ndarray:
+        topics = rng.integers(len(self.centres), size=count)
+        noise = rng.standard_normal((count, self.dim), dtype=np.float32) * self.noise / np.sqrt(self.dim)
+        return self._normalize(self.centres[topics] + noise).astype(np.float32)
+
+    def block(self, index: int, count: int) -> np.ndarray:
+        return self._around_centres(np.random.default_rng([self.seed, 1, index]), count)
+
+    def blocks(self, size: int):
+        """(first id, vectors) of the corpus of size vectors"""
+        for index, start in enumerate(range(0, size, BLOCK)):
+            yield start, self.block(index, min(BLOCK, size - start))
+
+    def queries(self, count: int) -> np.ndarray:
+        return self._around_centres(np.random.default_rng([self.seed, 2]), count)
+
+
+def exact_neighbours(vectors: SyntheticVectors, size: int, queries: np.ndarray, k: int) -> np.ndarray:
+    """Ids of the k nearest vectors of every query, by an exact float32 scan"""
+    best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+    best_scores = np.zeros((len(queries), 0), dtype=np.float32)
+    for start, block in vectors.blocks(size):
+        scores = np.concatenate([best_scores, queries @ block.T], axis=1)
+        ids = np.concatenate([best_ids, np.broadcast_to(np.arange(start, start + len(block)), (len(queries), len(block)))], axis=1)
+        top = np.argsort(-scores, axis=1)[:, :k]
+        best_scores = np.take_along_axis(scores, top, axis=1)
+        best_ids = np.take_along_axis(ids, top, axis=1)
+    return best_ids
+
+
+def measure(search: Callable[[np.ndarray], List[int]], queries: np.ndarray, truth: np.ndarray, k: int) -> dict:
+    latencies, recalls = [], []
+    for query, expected in zip(queries, truth):
+        started = time.perf_counter()
+        found = search(query)
+        latencies.append(time.perf_counter() - started)
+        recalls.append(len(set(found[:k]) & set(expected.tolist())) / k)
+    return {
+        f"recall_at_{k}": round(float(np.mean(recalls)), 4),
+        "queries_per_second": round(len(latencies) / max(sum(latencies), 1e-9), 1),
+        **latency_summary(latencies),
+    }
+
+
+def bench_compact(vectors: SyntheticVectors, size: int, queries: np.ndarray, truth: np.ndarray, quantization: str, args) -> dict:
+    from app.services.vector_index import CompactVectorIndex
+
+    workdir = Path(tempfile.mkdtemp(prefix="vector-bench-"))
+    try:
+        index = CompactVectorIndex(
+            str(workdir),
+            quantization=quantization,
+            probes=args.probes,
+            rerank_factor=args.rerank_factor,
+            min_train_size=args.min_train_size
+        )
+        started = time.perf_counter()
+        for start, block in vectors.blocks(size):
+            index.add(
+                (str(start + offset), vector, {"source": f"doc{(start + offset) // 8}"})
+                for offset, vector in enumerate(block.tolist())
+            )
+        index.flush()
+        build_seconds = time.perf_counter() - started
+        stats = index.stats()
+
+        # Warm the quantized matrix into the page cache before timing
+        index.search(queries[:args.warmup].tolist(), args.k)
+        result = measure(lambda query: [int(hit.chunk_id) for hit in index.search([query.tolist()], args.k)[0]], queries, truth, args.k)
+        return {
+            "backend": f"compact-{quantization}",
+            "build_seconds": round(build_seconds, 3),
+            "lists": stats["lists"],
+            "index_memory_mb": stats["quantized_mb"],
+            **result,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench_chroma(vectors: SyntheticVectors, size: int, queries: np.ndarray, truth: np.ndarray, args) -> dict:
+    """The current path: Chroma's HNSW index with L2 distance, as created by DocumentService"""
+    import chromadb
+
+    workdir = Path(tempfile.mkdtemp(prefix="vector-bench-chroma-"))
+    try:
+        collection = chromadb.PersistentClient(path=str(workdir)).create_collection("bench")
+        started = time.perf_counter()
+        for start, block in vectors.blocks(size):
+            for offset in range(0, len(block), 5000):
+                part = block[offset:offset + 5000]
+                collection.add(
+                    ids=[str(start + offset + i) for i in range(len(part))],
+                    embeddings=part.tolist(),
+                    metadatas=[{"source": f"doc{(start + offset + i) // 8}"} for i in range(len(part))]
+                )
+        build_seconds = time.perf_counter() - started
+
+        collection.query(query_embeddings=queries[:args.warmup].tolist(), n_results=args.k)
+        result = measure(
+            lambda query: [int(i) for i in collection.query(query_embeddings=[query.tolist()], n_results=args.k)["ids"][0]],
+            queries, truth, args.k
+        )
+        return {
+            "backend": "chroma",
+            "build_seconds": round(build_seconds, 3),
+            # float32 vectors, without the HNSW graph
+            "index_memory_mb": round(size * vectors.dim * 4 / 1024 ** 2, 2),
+            **result,
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _build_server_stores(workdir: str, backend: str, vector_args: tuple, size: int, min_train_size: int):
+    """Runs in a child process: write the chunks the way ingestion does for the backend"""
+    import chromadb
+    from app.services.vector_index import CompactVectorIndex, FULL_COLLECTION, METADATA_COLLECTION, PLACEHOLDER_EMBEDDING
+
+    vectors = SyntheticVectors(*vector_args)
+    client = chromadb.PersistentClient(path=str(Path(workdir) / "chromadb"))
+    index = None
+    if backend == "chroma":
+        collection = client.create_collection(FULL_COLLECTION)
+    else:
+        collection = client.create_collection(METADATA_COLLECTION)
+        index = CompactVectorIndex(
+            str(Path(workdir) / "vectors"), quantization=backend.split("-", 1)[1], min_train_size=min_train_size
+        )
+    for start, block in vectors.blocks(size):
+        for offset in range(0, len(block), 5000):
+            part = block[offset:offset + 5000].tolist()
+            ids = [str(start + offset + i) for i in range(len(part))]
+            metadatas = [{"source": f"doc{int(chunk_id) // 8}"} for chunk_id in ids]
+            # Only Chroma's own backend gives it the vectors
+            embeddings = part if index is None else [PLACEHOLDER_EMBEDDING] * len(part)
+            collection.add(ids=ids, embeddings=embeddings, metadatas=metadatas, documents=ids)
+            if index is not None:
+                index.add(zip(ids, part, metadatas))
+    if index is not None:
+        index.flush()
+
+
+def _serve(workdir: str, backend: str, queries: np.ndarray, k: int, probes: int, rerank_factor: int, warmup: int) -> dict:
+    """Runs in a fresh child process: open the stores like DocumentService and answer the queries"""
+    import chromadb
+    from app.services.vector_index import CompactVectorIndex, FULL_COLLECTION, METADATA_COLLECTION
+
+    client = chromadb.PersistentClient(path=str(Path(workdir) / "chromadb"))
+    if backend == "chroma":
+        collection = client.get_collection(FULL_COLLECTION)
+
+        def search(query: np.ndarray) -> List[int]:
+            found = collection.query(query_embeddings=[query.tolist()], n_results=k, include=["documents", "metadatas", "distances"])
+            return [int(chunk_id) for chunk_id in found["ids"][0]]
+    else:
+        collection = client.get_collection(METADATA_COLLECTION)
+        index = CompactVectorIndex(
+            str(Path(workdir) / "vectors"), quantization=backend.split("-", 1)[1], probes=probes, rerank_factor=rerank_factor
+        )
+
+        def search(query: np.ndarray) -> List[int]:
+            # Text and metadata of the hits come from Chroma, as in DocumentService._search_compact
+            ids = [hit.chunk_id for hit in index.search([query.tolist()], k)[0]]
+            collection.get(ids=ids, include=["documents", "metadatas"])
+            return [int(chunk_id) for chunk_id in ids]
+
+    for query in queries[:warmup]:
+        search(query)
+    return {"found": [search(query) for query in queries], "peak_rss_mb": peak_rss_mb()}
+
+
+def bench_server_path(vectors: SyntheticVectors, size: int, queries: np.ndarray, truth: np.ndarray, backend: str, args) -> dict:
+    """Peak resident memory of answering queries like the API, in a process that did not build the stores"""
+    workdir = tempfile.mkdtemp(prefix="vector-bench-server-")
+    context = multiprocessing.get_context("spawn")
+    try:
+        vector_args = (vectors.seed, vectors.dim, len(vectors.centres), vectors.noise)
+        with context.Pool(1) as pool:
+            pool.apply(_build_server_stores, (workdir, backend, vector_args, size, args.min_train_size))
+        with context.Pool(1) as pool:
+            served = pool.apply(_serve, (workdir, backend, queries, args.k, args.probes, args.rerank_factor, args.warmup))
+        recall = np.mean([len(set(found) & set(expected.tolist())) / args.k for found, expected in zip(served["found"], truth)])
+        return {
+            "backend": backend,
+            f"recall_at_{args.k}": round(float(recall), 4),
+            "server_peak_rss_mb": served["peak_rss_mb"],
+        }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def run(args):
+    vectors = SyntheticVectors(args.seed, args.dim, args.topics, args.noise)
+    queries = vectors.queries(args.queries)
+    results = []
+    for size in args.sizes:
+        started = time.perf_counter()
+        truth = exact_neighbours(vectors, size, queries, args.k)
+        logging.info(f"Exact neighbours of {len(queries)} queries over {size} vectors in {time.perf_counter() - started:.1f}s")
+
+        backends = []
+        for quantization in args.quantizations:
+            backends.append(bench_compact(vectors, size, queries, truth, quantization, args))
+        if args.chroma:
+            backends.append(bench_chroma(vectors, size, queries, truth, args))
+        for backend in backends:
+            logging.info(
+                f"{backend['backend']} over {size} vectors: recall@{args.k} {backend[f'recall_at_{args.k}']}, "
+                f"p50 {backend.get('latency_p50_seconds')}s, index {backend['index_memory_mb']} MiB"
+            )
+
+        server_path = []
+        if args.server_path:
+            for backend in [f"compact-{quantization}" for quantization in args.quantizations] + (["chroma"] if args.chroma else []):
+                server_path.append(bench_server_path(vectors, size, queries, truth, backend, args))
+                logging.info(
+                    f"{backend} server path over {size} vectors: peak RSS {server_path[-1]['server_peak_rss_mb']} MiB"
+                )
+        results.append({"vectors": size, "backends": backends, "server_path": server_path, "peak_rss_mb": peak_rss_mb()})
+    return results
+
+
+def int_list(value: str) -> List[int]:
+    return [int(part) for part in value.split(",") if part]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Benchmark recall and latency of the vector search backends")
+    parser.add_argument("--sizes", type=int_list, default=[10000, 100000], help="Corpus sizes in vectors")
+    parser.add_argument("--quantizations", type=lambda value: value.split(","), default=["int8", "float16"])
+    parser.add_argument("--chroma", action="store_true", help="Also measure Chroma's HNSW index, the current path")
+    parser.add_argument("--server-path", action="store_true", help="Also measure the peak memory of querying each backend's stores like the API")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--topics", type=int, default=2000, help="Centres the vectors are drawn around")
+    parser.add_argument("--noise", type=float, default=1.0, help="Spread of the vectors around their centre")
+    parser.add_argument("--probes", type=int, default=32)
+    parser.add_argument("--rerank-factor", type=int, default=4)
+    parser.add_argument("--min-train-size", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=str(REPO_ROOT / "bench" / "results" / "vectors.json"))
+    args = parser.parse_args()
+
+    config = {key: value for key, value in vars(args).items() if key != "output"}
+    write_results(args.output, "vectors", config, run(args))
@@ -0,0 +1,92 @@
+"""Compare two benchmark result files and flag regressions.
+
+    python bench/compare.py baseline.json candidate.json --threshold 0.1
+
+Exits with status 1 when any metric got worse by more than the threshold.
+"""
+import argparse
+import json
+import sys
+from typing import Dict, Optional
+
+# Keys that identify a result row rather than measure it
+IDENTITY_KEYS = ("documents", "speculative", "concurrency", "vectors", "backend")
+# Counts where any increase is a regression
+FAILURE_KEYS = ("errors", "rejected", "ingestion_failed")
+
+
+def flatten(results: list, prefix: str = "") -> Dict[str, float]:
+    metrics = {}
+    for row in results:
+        identity = "/".join(f"{key}={row[key]}" for key in IDENTITY_KEYS if key in row)
+        row_prefix = f"{prefix}{identity}/" if identity else prefix
+        for key, value in row.items():
+            if key in IDENTITY_KEYS:
+                continue
+            if isinstance(value, list):
+                metrics.update(flatten(value, row_prefix))
+            elif isinstance(value, (int, float)) and not isinstance(value, bool):
+                metrics[f"{row_prefix}{key}"] = value
+    return metrics
+
+
+def direction(metric: str) -> Optional[int]:
+    """1 if higher is better, -1 if lower is better, None if the metric is not compared"""
+    name = metric.rsplit("/", 1)[-1]
+    if "per_second" in name or name.startswith("recall") or name == "acceptance_rate":
+        return 1
+    if name.endswith(("_seconds", "_mb")) or name in FAILURE_KEYS:
+        return -1
+    return None
+
+
+def compare(baseline: dict, candidate: dict, threshold: float, min_delta: float) -> int:
+    if baseline["benchmark"] != candidate["benchmark"]:
+        raise SystemExit(f"Cannot compare a {baseline['benchmark']} run with a {candidate['benchmark']} run")
+
+    before, after = flatten(baseline["results"]), flatten(candidate["results"])
+    print(f"{baseline['environment']['git_revision']} -> {candidate['environment']['git_revision']}")
+    regressions = 0
+    for metric in sorted(before.keys() & after.keys()):
+        better = direction(metric)
+        if better is None:
+            continue
+        old, new = before[metric], after[metric]
+        if old == 0:
+            change = 0.0 if new == 0 else float("inf")
+        else:
+            change = (new - old) / abs(old)
+        # Positive when the metric got worse
+        worse = -change * better
+        name = metric.rsplit("/", 1)[-1]
+        if name in FAILURE_KEYS:
+            regressed = new > old
+        elif name.endswith("_seconds") and abs(new - old) < min_delta:
+            # Sub-millisecond changes are timer noise, not regressions
+            worse, regressed = 0.0, False
+        else:
+            regressed = worse > threshold
+        marker = "REGRESSION" if regressed else ("improved" if worse < -threshold else "")
+        regressions += regressed
+        print(f"{metric:70} {old:>12g} {new:>12g} {change:>+8.1%} {marker}")
+
+    missing = before.keys() - after.keys()
+    if missing:
+        print(f"Metrics missing from the candidate run: {', '.join(sorted(missing))}")
+    print(f"{regressions} regression(s) beyond {threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare two benchmark result files")
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change tolerated before flagging")
+    parser.add_argument("--min-delta", type=float, default=0.001, help="Smallest change in seconds worth flagging")
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    sys.exit(compare(baseline, candidate, args.threshold, args.min_delta))
@@ -0,0 +1,83 @@
+"""Deterministic synthetic corpus for the benchmarks.
+
+The same seed always gives the same documents and queries, so runs made on
+different commits measure the same work.
+"""
+import argparse
+import random
+from pathlib import Path
+from typing import List
+
+SYLLABLES = [
+    "al", "an", "ar", "be", "ca", "co", "de", "di", "el", "en", "er", "fa", "ga", "in", "is",
+    "ka", "la", "li", "lo", "ma", "mi", "mo", "na", "ne", "no", "or", "pa", "po", "ra", "re",
+    "ri", "ro", "sa", "se", "si", "ta", "te", "ti", "to", "tu", "un", "va", "ve", "vi", "za",
+]
+
+
+class SyntheticCorpus:
+    """Documents of paragraphs and sentences drawn from a Zipf-distributed vocabulary"""
+
+    def __init__(self, seed: int = 42, vocabulary_size: int = 5000, words_per_document: int = 800):
+        self.seed = seed
+        self.words_per_document = words_per_document
+        rng = random.Random(seed)
+        vocabulary = set()
+        while len(vocabulary) < vocabulary_size:
+            vocabulary.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(1, 4))))
+        self.vocabulary = sorted(vocabulary)
+        rng.shuffle(self.vocabulary)
+        # Zipf weights so a few words are common and most are rare, like real text
+        self.weights = [1 / (rank + 1) for rank in range(vocabulary_size)]
+
+    def _sentence(self, rng: random.Random) -> str:
+        words = rng.choices(self.vocabulary, weights=self.weights, k=rng.randint(6, 24))
+        return " ".join(words).capitalize() + "."
+
+    def document(self, index: int) -> str:
+        rng = random.Random(f"{self.seed}-document-{index}")
+        title = " ".join(rng.choices(self.vocabulary, weights=self.weights, k=4)).title()
+        paragraphs = [title]
+        words = 0
+        # Document lengths vary between half and one and a half times the average
+        target = int(self.words_per_document * rng.uniform(0.5, 1.5))
+        while words < target:
+            sentences = [self._sentence(rng) for _ in range(rng.randint(2, 8))]
+            words += sum(sentence.count(" ") + 1 for sentence in sentences)
+            paragraphs.append(" ".join(sentences))
+        return "\n\n".join(paragraphs) + "\n"
+
+    def queries(self, count: int, num_documents: int) -> List[str]:
+        """Queries made of a phrase taken from a random document, so every query has a match"""
+        rng = random.Random(f"{self.seed}-queries")
+        queries = []
+        for _ in range(count):
+            words = self.document(rng.randrange(num_documents)).split()
+            length = rng.randint(3, 10)
+            start = rng.randrange(max(1, len(words) - length))
+            queries.append(" ".join(words[start:start + length]).replace(".", "").lower())
+        return queries
+
+    def write(self, directory: str, num_documents: int) -> int:
+        """Write num_documents files into directory and return their total size in bytes"""
+        path = Path(directory)
+        path.mkdir(parents=True, exist_ok=True)
+        total = 0
+        for index in range(num_documents):
+            text = self.document(index)
+            (path / f"doc_{index:06d}.txt").write_text(text, encoding="utf-8")
+            total += len(text.encode("utf-8"))
+        return total
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic benchmark corpus to a directory")
+    parser.add_argument("directory")
+    parser.add_argument("--documents", type=int, default=1000)
+    parser.add_argument("--words-per-document", type=int, default=800)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    corpus = SyntheticCorpus(seed=args.seed, words_per_document=args.words_per_document)
+    size = corpus.write(args.directory, args.documents)
+    print(f"Wrote {args.documents} documents ({size / 1024 ** 2:.1f} MiB) to {args.directory}")
@@ -1,13 +1,61 @@
-from fastapi import FastAPI, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse
-from app.models.chat import ChatRequest, ChatResponse
-from app.services.llm_service import LLMService
+from fastapi.responses import StreamingResponse, Response, JSONResponse
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from app.models.chat import ChatRequest, ChatResponse, ConversationResponse
+from app.services.inference_worker import QueueFullError
+from app.services.token_stream import ClientDisconnected, coalesce_tokens
+import asyncio
 import logging
 import json
+import os
+import time
+from typing import Optional
 from pydantic import BaseModel
 
-app = FastAPI(title="LLM Assistant API")
+# Set once the model is loaded; requests are only served when the state is "ready"
+llm_service = None
+# "loading", "warming_up", "ready" or "failed"
+service_state = {"status": "loading", "error": None, "load_seconds": None}
+# Tokens are sent in SSE events of up to this many bytes, or after this long
+SSE_FLUSH_BYTES = int(os.getenv("SSE_FLUSH_BYTES", 256))
+SSE_FLUSH_INTERVAL = float(os.getenv("SSE_FLUSH_INTERVAL_MS", 50)) / 1000
+
+async def load_service():
+    """Load the model off the event loop, then warm it up, while the API already answers /health"""
+    global llm_service
+    started = time.perf_counter()
+    try:
+        # Imported here so importing the app does not load llama.cpp
+        from app.services.llm_service import LLMService
+        llm_service = await asyncio.to_thread(LLMService)
+    except Exception as e:
+        logging.error(f"Error loading LLM service: {str(e)}")
+        service_state.update(status="failed", error=str(e))
+        return
+
+    if os.getenv("LLM_WARMUP", "true").lower() == "true":
+        service_state["status"] = "warming_up"
+        try:
+            await llm_service.warm_up()
+        except Exception as e:
+            # A cold model still works, only the first turns are slower
+            logging.error(f"Error warming up the model: {str(e)}")
+
+    service_state.update(status="ready", load_seconds=round(time.perf_counter() - started, 2))
+    logging.info(f"LLM service ready after {service_state['load_seconds']}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loader = asyncio.create_task(load_service())
+    yield
+    loader.cancel()
+    if llm_service is not None:
+        await llm_service.pool.close()
+        await llm_service.docstore.close()
+
+app = FastAPI(title="LLM Assistant API", lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -18,12 +66,31 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-try:
-    # Initialize LLM service
-    llm_service = LLMService()
-except FileNotFoundError as e:
-    logging.error(str(e))
-    llm_service = None
+def require_service():
+    """The LLM service, or 503 while the model is loading or when it failed to load"""
+    if service_state["status"] == "ready":
+        return llm_service
+    if service_state["status"] == "failed":
+        raise HTTPException(
+            status_code=503,
+            detail="LLM model not loaded. Please check server logs for details."
+        )
+    raise HTTPException(
+        status_code=503,
+        detail="LLM model is still loading. Please retry shortly.",
+        headers={"Retry-After": "5"}
+    )
+
+def reserve_inference_slot(session_id: Optional[str] = None):
+    """Fail fast with 503 when the inference queue is saturated"""
+    try:
+        return require_service().reserve_slot(session_id)
+    except QueueFullError as e:
+        raise HTTPException(
+            status_code=503,
+            detail=str(e),
+            headers={"Retry-After": "2"}
+        )
 
 class PromptRequest(BaseModel):
     prompt: str
@@ -37,39 +104,106 @@ async def root():
 
 @app.get("/health")
 async def health_check():
+    """Liveness: the API is up, whether or not the model is ready"""
     return {
         "status": "healthy",
-        "model_loaded": llm_service is not None
+        "model_loaded": llm_service is not None,
+        "model_state": service_state["status"],
+        "inference": llm_service.pool.stats() if llm_service is not None else None,
+        "docstore": llm_service.docstore.stats() if llm_service is not None else None,
+        "answer_cache": llm_service.answer_cache.stats() if llm_service is not None and llm_service.answer_cache else None,
+        "conversations": llm_service.conversations.stats() if llm_service is not None else None
     }
 
-async def generate_stream(request: ChatRequest):
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: 200 once the model is loaded and warmed up, 503 before that"""
+    return JSONResponse(
+        status_code=200 if service_state["status"] == "ready" else 503,
+        content={"ready": service_state["status"] == "ready", **service_state}
+    )
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+async def generate_stream(request: ChatRequest, slot, http_request: Request):
+    usage = {}
+    timings = {}
+    tokens = llm_service.generate_response_stream(
+        messages=request.messages,
+        temperature=request.temperature,
+        max_tokens=request.max_tokens,
+        slot=slot,
+        session_id=request.session_id,
+        usage=usage,
+        timings=timings,
+        message=request.message,
+        speculative=request.speculative
+    )
     try:
-        async for text in llm_service.generate_response_stream(
-            messages=request.messages,
-            temperature=request.temperature,
-            max_tokens=request.max_tokens
+        # Generation stops and the slot is freed as soon as the client disconnects
+        async for text in coalesce_tokens(
+            tokens,
+            max_delay=SSE_FLUSH_INTERVAL,
+            max_bytes=SSE_FLUSH_BYTES,
+            is_disconnected=http_request.is_disconnected
         ):
             yield f"data: {json.dumps({'text': text})}\n\n"
+        yield f"data: {json.dumps({'usage': usage})}\n\n"
+        if request.include_timings:
+            yield f"data: {json.dumps({'timings': timings})}\n\n"
+    except ClientDisconnected:
+        logging.info("Client disconnected, generation stopped")
     except Exception as e:
         yield f"data: {json.dumps({'error': str(e)})}\n\n"
 
 @app.post("/chat/stream")
-async def chat_stream(request: ChatRequest):
-    if llm_service is None:
-        raise HTTPException(
-            status_code=503,
-            detail="LLM model not loaded. Please check server logs for details."
-        )
+async def chat_stream(request: ChatRequest, http_request: Request):
+    if request.message is not None and not request.session_id:
+        raise HTTPException(status_code=422, detail="A message without messages needs a session_id")
+    if request.message is None and not request.messages:
+        raise HTTPException(status_code=422, detail="Either messages or message is required")
+    if request.speculative is not None and request.speculative not in require_service().speculative_modes():
+        raise HTTPException(status_code=422, detail=f"Speculative mode {request.speculative} is not enabled on this server")
+    if request.message is not None:
+        conversations = require_service().conversations
+        if request.new_session:
+            conversations.start(request.session_id, request.messages)
+        elif conversations.get(request.session_id) is None:
+            # Lost to a restart or evicted; answering would silently drop the history
+            raise HTTPException(
+                status_code=404,
+                detail="Conversation not found, send it again with new_session and its messages"
+            )
+    slot = reserve_inference_slot(request.session_id)
     
     return StreamingResponse(
-        generate_stream(request),
+        generate_stream(request, slot, http_request),
         media_type="text/event-stream"
     )
 
+@app.get("/conversations/{session_id}", response_model=ConversationResponse)
+async def get_conversation(session_id: str):
+    conversation = require_service().conversations.get(session_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    return ConversationResponse(session_id=session_id, summary=conversation.summary, messages=conversation.turns)
+
+@app.delete("/conversations/{session_id}", status_code=204)
+async def delete_conversation(session_id: str):
+    service = require_service()
+    if not service.conversations.delete(session_id):
+        raise HTTPException(status_code=404, detail="Conversation not found")
+    # The session's model state is of no use without its history
+    if service.pool.session_cache is not None:
+        service.pool.session_cache.discard(session_id)
+
 @app.post("/prompt", response_model=PromptResponse)
 async def process_prompt(request: PromptRequest):
+    slot = reserve_inference_slot()
     try:
-        response = await llm_service.process_prompt(request.prompt)
+        response = await llm_service.process_prompt(request.prompt, slot=slot)
         return PromptResponse(response=response)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
@@ -0,0 +1,49 @@
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from prometheus_client import Counter, Histogram
+
+# Buckets from a few milliseconds up to long CPU generations
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768)
+
+SPAN_SECONDS = Histogram(
+    "llm_span_seconds",
+    "Time spent in each stage of a chat turn",
+    ["span"],
+    buckets=LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = Histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from receiving a chat request to its first generated token",
+    buckets=LATENCY_BUCKETS
+)
+TOKENS_PER_SECOND = Histogram(
+    "llm_generation_tokens_per_second",
+    "Generation speed of a chat turn after the first token",
+    ["speculative"],
+    buckets=(0.5, 1, 2, 4, 8, 16, 32, 64, 128)
+)
+PROMPT_TOKENS = Histogram("llm_prompt_tokens", "Prompt tokens per chat turn", buckets=TOKEN_BUCKETS)
+CONTEXT_TOKENS = Histogram("llm_context_tokens", "Retrieved context tokens per chat turn", buckets=TOKEN_BUCKETS)
+GENERATED_TOKENS = Histogram("llm_generated_tokens", "Generated tokens per chat turn", buckets=TOKEN_BUCKETS)
+CHAT_TURNS = Counter("llm_chat_turns_total", "Chat turns handled", ["outcome"])
+# accepted / drafted is the acceptance rate of each speculative mode
+SPECULATIVE_TOKENS = Counter("llm_speculative_tokens_total", "Tokens drafted and accepted by speculative decoding", ["mode", "result"])
+ANSWER_CACHE_LOOKUPS = Counter("llm_answer_cache_lookups_total", "Answer cache lookups", ["result"])
+# rate() of the busy time is the utilisation of each model worker
+WORKER_BUSY_SECONDS = Counter("llm_worker_busy_seconds_total", "Time each model worker spent generating", ["worker"])
+
+
+@contextmanager
+def timed(span: str, timings: Optional[dict] = None):
+    """Observe the duration of a block in SPAN_SECONDS and optionally record it in timings"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        SPAN_SECONDS.labels(span=span).observe(elapsed)
+        if timings is not None:
+            timings[span] = round(elapsed, 4)
@@ -1,14 +1,30 @@
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 class ChatMessage(BaseModel):
     role: str
     content: str
 
 class ChatRequest(BaseModel):
-    messages: List[ChatMessage]
+    # The whole conversation, or only the new message with a session_id
+    messages: List[ChatMessage] = []
+    message: Optional[str] = None
     temperature: Optional[float] = 0.7
     max_tokens: Optional[int] = 2000
+    # Lets the server reuse the llama.cpp state of earlier turns
+    session_id: Optional[str] = None
+    # With message, starts the session's conversation from messages. Without it, a
+    # message for a conversation the server does not know (anymore) gets a 404
+    new_session: bool = False
+    # Adds a final SSE event with the duration of every stage of the turn
+    include_timings: bool = False
+    # Speculative decoding by prompt lookup or a draft model, the server default when unset
+    speculative: Optional[Literal["off", "prompt_lookup", "draft"]] = None
 
 class ChatResponse(BaseModel):
-    response: str 
\ No newline at end of file
+    response: str 
+class ConversationResponse(BaseModel):
+    session_id: str
+    # Summary of the turns compacted out of the history
+    summary: Optional[str] = None
+    messages: List[ChatMessage]
@@ -0,0 +1,122 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Dict, FrozenSet, Hashable, List, NamedTuple, Optional, Set, Tuple
+
+from app.metrics import ANSWER_CACHE_LOOKUPS
+
+# (source, doc_id) of every retrieved document an answer was based on
+Sources = FrozenSet[Tuple[str, Optional[str]]]
+
+
+class _Entry(NamedTuple):
+    key: Hashable
+    sources: Sources
+    embedding: List[float]
+    answer: str
+    expires_at: float
+
+
+def _normalize(vector: List[float]) -> List[float]:
+    norm = math.sqrt(sum(x * x for x in vector))
+    return [x / norm for x in vector] if norm else list(vector)
+
+
+class AnswerCache:
+    """Semantic cache of generated answers, with LRU and TTL eviction.
+
+    An answer is reused for a new question when the same documents, at the same
+    versions, were retrieved for it and the cosine similarity of its embedding
+    to the cached question's is at least min_similarity. Document ids are
+    content hashes, so a changed document never matches an old entry; entries
+    of a source are also dropped as soon as it is retrieved with another id.
+    """
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600.0, min_similarity: float = 0.95):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.min_similarity = min_similarity
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        # Entry ids by retrieved documents and settings, and by source for invalidation
+        self._by_key: Dict[Hashable, Set[int]] = {}
+        self._by_source: Dict[str, Set[int]] = {}
+        self._next_id = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def sources_of(results: List[dict]) -> Sources:
+        """The documents behind a docstore query result"""
+        return frozenset((r["metadata"]["source"], r["metadata"].get("doc_id")) for r in results)
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        bucket = self._by_key.get(entry.key)
+        if bucket is not None:
+            bucket.discard(entry_id)
+            if not bucket:
+                del self._by_key[entry.key]
+        for source, _ in entry.sources:
+            ids = self._by_source.get(source)
+            if ids is not None:
+                ids.discard(entry_id)
+                if not ids:
+                    del self._by_source[source]
+
+    def invalidate(self, sources: Sources):
+        """Drop entries that depend on another version of any of these sources"""
+        for source, doc_id in sources:
+            for entry_id in list(self._by_source.get(source, ())):
+                entry = self._entries.get(entry_id)
+                if entry is not None and (source, doc_id) not in entry.sources:
+                    self._remove(entry_id)
+                    self.invalidations += 1
+
+    def get(self, embedding: List[float], sources: Sources, settings: Hashable = None) -> Optional[str]:
+        """Best cached answer for a question with this embedding and these retrieved documents"""
+        self.invalidate(sources)
+        embedding = _normalize(embedding)
+        now = time.monotonic()
+        best_id, best_similarity = None, self.min_similarity
+        for entry_id in list(self._by_key.get((sources, settings), ())):
+            entry = self._entries[entry_id]
+            if entry.expires_at < now:
+                self._remove(entry_id)
+                continue
+            similarity = sum(a * b for a, b in zip(embedding, entry.embedding))
+            if similarity >= best_similarity:
+                best_id, best_similarity = entry_id, similarity
+
+        if best_id is None:
+            self.misses += 1
+            ANSWER_CACHE_LOOKUPS.labels(result="miss").inc()
+            return None
+        self._entries.move_to_end(best_id)
+        self.hits += 1
+        ANSWER_CACHE_LOOKUPS.labels(result="hit").inc()
+        return self._entries[best_id].answer
+
+    def put(self, embedding: List[float], sources: Sources, answer: str, settings: Hashable = None):
+        key = (sources, settings)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = _Entry(key, sources, _normalize(embedding), answer, time.monotonic() + self.ttl)
+        self._by_key.setdefault(key, set()).add(entry_id)
+        for source, _ in sources:
+            self._by_source.setdefault(source, set()).add(entry_id)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
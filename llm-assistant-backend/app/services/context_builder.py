@@ -0,0 +1,155 @@
+from typing import Callable, List, Optional, Tuple
+
+SEPARATOR = "\n\n---\n\n"
+
+
+class ContextCandidate:
+    """A retrieved document with the matched chunk and the part of its text that was loaded.
+
+    `text` holds the loaded window of the document, which starts at `window_start`
+    in the full document of `doc_length` characters. `chunk_start`/`chunk_end` are
+    the matched chunk's offsets in the full document.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        text: str,
+        window_start: int,
+        doc_length: int,
+        chunk_start: int,
+        chunk_end: int
+    ):
+        self.source = source
+        self.text = text
+        self.window_start = window_start
+        self.doc_length = doc_length
+        self.chunk_start = chunk_start
+        self.chunk_end = chunk_end
+
+    @classmethod
+    def from_chunk(cls, source: str, chunk: str) -> "ContextCandidate":
+        """Candidate for a chunk whose surrounding document is not available"""
+        return cls(source, chunk, 0, len(chunk), 0, len(chunk))
+
+
+class _Selection:
+    def __init__(self, candidate: ContextCandidate):
+        self.candidate = candidate
+        # Selected range, relative to the loaded window
+        self.start = candidate.chunk_start - candidate.window_start
+        self.end = candidate.chunk_end - candidate.window_start
+        self.min_step = max(self.end - self.start, 1)
+        self.step = self.min_step
+        self.included = False
+        # Tokens of the rendered block, header included
+        self.tokens = 0
+
+    @property
+    def exhausted(self) -> bool:
+        return self.start <= 0 and self.end >= len(self.candidate.text)
+
+    def render(self, start: Optional[int] = None, end: Optional[int] = None) -> str:
+        """The block of the selection, or of the range start:end of the loaded window"""
+        candidate = self.candidate
+        start = self.start if start is None else start
+        end = self.end if end is None else end
+        body = candidate.text[start:end].strip()
+        if candidate.window_start + start > 0:
+            body = "... " + body
+        if candidate.window_start + end < candidate.doc_length:
+            body = body + " ..."
+        return f"Source: {candidate.source}\n\n{body}"
+
+
+class ContextBuilder:
+    """Fills a token budget with retrieved context, by priority.
+
+    The best matching chunk of every source goes in first, then the chunks
+    around it, then progressively more of each document, until the budget is
+    used up. Candidates are expected in order of relevance.
+    """
+
+    def __init__(self, count_tokens: Callable[[str], int]):
+        self.count_tokens = count_tokens
+
+    def build(self, candidates: List[ContextCandidate], budget: int) -> Tuple[Optional[str], int]:
+        """Return the context text and the number of tokens it uses"""
+        if budget <= 0 or not candidates:
+            return None, 0
+
+        selections = [_Selection(candidate) for candidate in candidates]
+        used = 0
+
+        # Best chunk of every source first
+        for selection in selections:
+            separator_tokens = self.count_tokens(SEPARATOR) if used else 0
+            selection.tokens = self.count_tokens(selection.render())
+            if used + selection.tokens + separator_tokens <= budget:
+                selection.included = True
+                used += selection.tokens + separator_tokens
+            elif not used:
+                # Not even the best chunk fits, include as much of it as we can
+                self._truncate(selection, budget)
+                selection.included = True
+                selection.tokens = self.count_tokens(selection.render())
+                used = selection.tokens
+                break
+
+        # Then neighbouring chunks, then ever larger parts of each document
+        growing = [selection for selection in selections if selection.included]
+        while growing:
+            still_growing = []
+            for selection in growing:
+                added = self._expand(selection, budget - used)
+                if added is not None:
+                    used += added
+                    if not selection.exhausted:
+                        still_growing.append(selection)
+            growing = still_growing
+
+        included = [selection.render() for selection in selections if selection.included]
+        if not included:
+            return None, 0
+        return SEPARATOR.join(included), used
+
+    def _expand(self, selection: _Selection, remaining: int) -> Optional[int]:
+        """Grow a selection on both sides if it fits, returning the tokens it added, None if it did not grow"""
+        text = selection.candidate.text
+        while True:
+            new_start = max(selection.start - selection.step, 0)
+            new_end = min(selection.end + selection.step, len(text))
+
+            added = self._resize(selection, new_start, new_end, remaining)
+            if added is not None:
+                # Grow faster once the direct neighbours are in
+                selection.step *= 2
+                return added
+
+            # Try one side only, preceding text first as it is usually what a chunk continues
+            for start, end in ((new_start, selection.end), (selection.start, new_end)):
+                if (start, end) != (selection.start, selection.end):
+                    added = self._resize(selection, start, end, remaining)
+                    if added is not None:
+                        return added
+
+            if selection.step <= selection.min_step:
+                return None
+            selection.step = max(selection.step // 2, selection.min_step)
+
+    def _resize(self, selection: _Selection, start: int, end: int, remaining: int) -> Optional[int]:
+        """Select start:end if the whole block, header and ellipses included, still fits; the tokens it added"""
+        tokens = self.count_tokens(selection.render(start, end))
+        if tokens - selection.tokens > remaining:
+            return None
+        added = tokens - selection.tokens
+        selection.start, selection.end, selection.tokens = start, end, tokens
+        return added
+
+    def _truncate(self, selection: _Selection, budget: int):
+        while selection.end > selection.start:
+            tokens = self.count_tokens(selection.render())
+            if tokens <= budget:
+                return
+            length = selection.end - selection.start
+            selection.end = selection.start + int(length * budget / tokens * 0.95)
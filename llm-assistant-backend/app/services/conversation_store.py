@@ -0,0 +1,116 @@
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional
+
+from app.models.chat import ChatMessage
+
+
+class Conversation:
+    """History of one conversation: a summary of its compacted turns and the recent turns verbatim"""
+
+    def __init__(self):
+        self.summary: Optional[str] = None
+        self.summary_tokens = 0
+        self.turns: List[ChatMessage] = []
+        self.turn_tokens: List[int] = []
+        self.last_used = time.monotonic()
+
+    @property
+    def tokens(self) -> int:
+        return self.summary_tokens + sum(self.turn_tokens)
+
+
+class ConversationStore:
+    """Server-side chat histories keyed by session id, so clients only send their new message.
+
+    Once a history holds more than history_tokens tokens, its oldest turns
+    are dropped until it is down to half of that, and returned so the caller
+    can fold them into the conversation's summary. Compacting in large steps
+    keeps the prompt prefix of the following turns unchanged, which the session
+    state cache needs. Conversations idle for idle_ttl seconds are evicted, and
+    the least recently used ones once there are more than max_conversations.
+    """
+
+    def __init__(
+        self,
+        count_tokens: Callable[[str], int],
+        history_tokens: int = 2000,
+        max_conversations: int = 1000,
+        idle_ttl: float = 1800.0
+    ):
+        self.count_tokens = count_tokens
+        self.history_tokens = history_tokens
+        self.max_conversations = max_conversations
+        self.idle_ttl = idle_ttl
+        self._conversations: "OrderedDict[str, Conversation]" = OrderedDict()
+
+        self.compactions = 0
+        self.evictions = 0
+
+    def _evict(self):
+        expired = time.monotonic() - self.idle_ttl
+        while self._conversations:
+            conversation_id, conversation = next(iter(self._conversations.items()))
+            if conversation.last_used >= expired and len(self._conversations) <= self.max_conversations:
+                break
+            del self._conversations[conversation_id]
+            self.evictions += 1
+
+    def get(self, conversation_id: str) -> Optional[Conversation]:
+        self._evict()
+        conversation = self._conversations.get(conversation_id)
+        if conversation is not None:
+            conversation.last_used = time.monotonic()
+            self._conversations.move_to_end(conversation_id)
+        return conversation
+
+    def start(self, conversation_id: str, messages: List[ChatMessage] = ()) -> Conversation:
+        """Start a conversation, or restart it, from the turns a client still has, e.g. after a restart"""
+        conversation = Conversation()
+        for message in messages:
+            if message.role in ("user", "assistant"):
+                conversation.turns.append(ChatMessage(role=message.role, content=message.content))
+                conversation.turn_tokens.append(self.count_tokens(message.content))
+        self._conversations.pop(conversation_id, None)
+        self._conversations[conversation_id] = conversation
+        self._evict()
+        return conversation
+
+    def append(self, conversation_id: str, question: str, answer: str) -> List[ChatMessage]:
+        """Record a finished turn, returning the turns compacted away to make room for it"""
+        conversation = self.get(conversation_id)
+        if conversation is None:
+            conversation = self._conversations[conversation_id] = Conversation()
+            self._evict()
+        for message in (ChatMessage(role="user", content=question), ChatMessage(role="assistant", content=answer)):
+            conversation.turns.append(message)
+            conversation.turn_tokens.append(self.count_tokens(message.content))
+
+        dropped: List[ChatMessage] = []
+        if conversation.tokens > self.history_tokens:
+            self.compactions += 1
+            while conversation.turns and conversation.tokens > self.history_tokens // 2:
+                # A question and its answer are dropped together
+                for _ in range(min(2, len(conversation.turns))):
+                    dropped.append(conversation.turns.pop(0))
+                    conversation.turn_tokens.pop(0)
+        return dropped
+
+    def set_summary(self, conversation_id: str, summary: str):
+        conversation = self._conversations.get(conversation_id)
+        if conversation is not None:
+            conversation.summary = summary
+            conversation.summary_tokens = self.count_tokens(summary)
+
+    def delete(self, conversation_id: str) -> bool:
+        return self._conversations.pop(conversation_id, None) is not None
+
+    def stats(self) -> dict:
+        self._evict()
+        return {
+            "conversations": len(self._conversations),
+            "max_conversations": self.max_conversations,
+            "history_tokens": sum(conversation.tokens for conversation in self._conversations.values()),
+            "compactions": self.compactions,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Any, Hashable, Optional
+
+import aiohttp
+
+from app.services.ttl_cache import TTLCache
+
+# Status codes worth retrying: the docstore is restarting or overloaded
+RETRYABLE_STATUSES = {502, 503, 504}
+
+
+class DocstoreError(Exception):
+    """Raised when the docstore answers with an error or cannot be reached"""
+
+
+def normalize_query(query: str) -> str:
+    return re.sub(r"\s+", " ", query).strip().lower()
+
+
+class DocstoreClient:
+    """Long-lived, pooled HTTP client for the docstore with a retrieval cache.
+
+    One aiohttp session with keep-alive connections and DNS caching is shared
+    by all chat turns. Retrieval results are kept in a TTL+LRU cache that is
+    cleared whenever the docstore reports a new index version, so answers never
+    come from an index that has since changed.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        timeout: float = 10.0,
+        retries: int = 2,
+        max_connections: int = 20,
+        cache_size: int = 256,
+        cache_ttl: float = 300.0,
+        version_check_interval: float = 2.0
+    ):
+        self.base_url = base_url
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.retries = retries
+        self.max_connections = max_connections
+        self.version_check_interval = version_check_interval
+
+        self.cache = TTLCache(max_size=cache_size, ttl=cache_ttl)
+        # Document text is content-addressed and never changes, so it only needs LRU
+        self.document_cache = TTLCache(max_size=cache_size, ttl=float("inf"))
+
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._index_version: Optional[int] = None
+        self._version_checked_at = 0.0
+
+    @property
+    def total_timeout(self) -> float:
+        """Longest a request can take, over all its attempts and the backoff between them"""
+        return (self.retries + 1) * self.timeout.total + sum(0.1 * 2 ** attempt for attempt in range(self.retries))
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created lazily so it binds to the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_connections,
+                keepalive_timeout=60,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def _request(self, method: str, path: str, **kwargs) -> dict:
+        """Send a request, retrying connection errors and transient failures with backoff"""
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._get_session().request(method, f"{self.base_url}{path}", **kwargs) as response:
+                    if response.status == 200:
+                        return await response.json()
+                    if response.status not in RETRYABLE_STATUSES or attempt == self.retries:
+                        raise DocstoreError(f"Docstore returned {response.status} for {path}")
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise DocstoreError(f"Docstore request to {path} failed: {str(e)}") from e
+            logging.warning(f"Retrying docstore request to {path} (attempt {attempt + 2})")
+            await asyncio.sleep(0.1 * 2 ** attempt)
+
+    def _observe_version(self, version: Optional[int]):
+        if version is None:
+            return
+        if self._index_version is not None and version != self._index_version:
+            logging.info(f"Docstore index changed ({self._index_version} -> {version}), clearing retrieval cache")
+            self.cache.clear()
+        self._index_version = version
+        self._version_checked_at = time.monotonic()
+
+    async def _check_version(self):
+        """Ask the docstore for its index version, at most once per version_check_interval"""
+        if time.monotonic() - self._version_checked_at < self.version_check_interval:
+            return
+        try:
+            result = await self._request("GET", "/index/version")
+            self._observe_version(result.get("index_version"))
+        except DocstoreError as e:
+            # Without a version we cannot trust the cache
+            logging.warning(f"Could not check docstore index version: {str(e)}")
+            self.cache.clear()
+
+    async def get_cached(self, key: Hashable) -> Optional[Any]:
+        """Look up a retrieval-derived value, valid only for the current index version"""
+        await self._check_version()
+        return self.cache.get(key)
+
+    def set_cached(self, key: Hashable, value: Any):
+        self.cache.set(key, value)
+
+    async def query(self, query: str, num_results: int, min_similarity: Optional[float] = None, include_embedding: bool = False) -> dict:
+        key = ("query", normalize_query(query), num_results, min_similarity, include_embedding)
+        result = await self.get_cached(key)
+        if result is not None:
+            return result
+
+        result = await self._request(
+            "POST",
+            "/query",
+            json={
+                "query": query,
+                "num_results": num_results,
+                "min_similarity": min_similarity,
+                "include_embedding": include_embedding
+            }
+        )
+        self._observe_version(result.get("index_version"))
+        self.set_cached(key, result)
+        return result
+
+    async def get_document(self, doc_id: str, start: int = 0, end: Optional[int] = None) -> dict:
+        key = (doc_id, start, end)
+        document = self.document_cache.get(key)
+        if document is None:
+            params = {"start": start}
+            if end is not None:
+                params["end"] = end
+            document = await self._request("GET", f"/documents/{doc_id}", params=params)
+            self.document_cache.set(key, document)
+        return document
+
+    def stats(self) -> dict:
+        return {
+            "index_version": self._index_version,
+            "retrieval_cache": self.cache.stats(),
+            "document_cache": self.document_cache.stats(),
+        }
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
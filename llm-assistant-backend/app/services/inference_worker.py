@@ -0,0 +1,418 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncGenerator, Optional, Sequence
+from app.services.session_cache import SessionStateCache, load_compact_state, save_compact_state
+from app.metrics import WORKER_BUSY_SECONDS
+
+# Marker pushed onto a job's token queue once generation has finished
+_DONE = object()
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue cannot accept another job"""
+
+
+class InferenceSlot:
+    """Admission ticket for a single inference job"""
+
+    def __init__(self, worker: "InferenceWorker"):
+        # The worker the job will run on
+        self.worker = worker
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.worker._release_slot()
+
+    def __del__(self):
+        # Safety net for responses that were never streamed (e.g. the client
+        # disconnected before the body started), so the slot is not leaked
+        self.release()
+
+
+class RecordingDraftModel:
+    """Wraps a llama_cpp draft model to count the drafting steps and drafted tokens of one generation"""
+
+    def __init__(self, draft):
+        self.draft = draft
+        self.calls = 0
+        self.drafted = 0
+
+    def __call__(self, input_ids: Sequence[int], /, **kwargs) -> Sequence[int]:
+        tokens = self.draft(input_ids, **kwargs)
+        self.calls += 1
+        self.drafted += len(tokens)
+        return tokens
+
+    def accepted(self, generated_tokens: int) -> int:
+        """Estimated drafted tokens the main model accepted.
+
+        Every drafting step is followed by one forward pass that yields one
+        token of its own plus the accepted drafted ones, after the first token
+        that came from prompt evaluation.
+        """
+        return max(0, min(self.drafted, generated_tokens - 1 - self.calls))
+
+
+class InferenceJob:
+    def __init__(
+        self,
+        prompt: Optional[str],
+        params: dict,
+        slot: InferenceSlot,
+        session_id: Optional[str] = None,
+        speculative: Optional[str] = None,
+        prefix: Optional[str] = None,
+        prompt_timeout: Optional[float] = None
+    ):
+        self.prompt = prompt
+        self.params = params
+        self.slot = slot
+        self.session_id = session_id
+        # Speculative mode of the job, None or "off" for one token per forward pass
+        self.speculative = speculative
+        # Start of the prompt, evaluated while the caller is still completing the prompt
+        self.prefix = prefix
+        # Longest the worker waits for set_prompt before giving the job up, None for no limit
+        self.prompt_timeout = prompt_timeout
+        self.prompt_ready = threading.Event()
+        self._prompt_lock = threading.Lock()
+        # Set when the worker gave the job up, its slot is then left to the caller
+        self.expired = False
+        if prompt is not None:
+            self.prompt_ready.set()
+        self.tokens: asyncio.Queue = asyncio.Queue()
+        self.cancelled = threading.Event()
+        self.enqueued_at = time.monotonic()
+        # Filled in by the inference thread
+        self.started_at: Optional[float] = None
+        self.prefilled_at: Optional[float] = None
+        self.prompt_started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.prefilled_tokens = 0
+        self.generated_tokens = 0
+        self.draft: Optional[RecordingDraftModel] = None
+
+    def set_prompt(self, prompt: str) -> bool:
+        """Complete the prompt of a job queued with only its prefix, False if the job was given up"""
+        with self._prompt_lock:
+            if self.cancelled.is_set():
+                return False
+            self.prompt = prompt
+            self.prompt_ready.set()
+            return True
+
+    def expire(self) -> bool:
+        """Give the job up unless its prompt was completed meanwhile, True if it was given up"""
+        with self._prompt_lock:
+            if self.prompt_ready.is_set():
+                return False
+            self.expired = True
+            self.cancelled.set()
+            return True
+
+    def cancel(self):
+        self.cancelled.set()
+        # Wakes the worker if it is waiting for the prompt
+        self.prompt_ready.set()
+
+    def timings(self) -> dict:
+        """Queue wait, prompt evaluation and generation time of a finished job"""
+        if self.started_at is None:
+            return {}
+        prompt_started_at = self.prompt_started_at or self.started_at
+        first_token_at = self.first_token_at or self.finished_at or prompt_started_at
+        finished_at = self.finished_at or first_token_at
+        timings = {
+            "queue_wait": round(self.started_at - self.enqueued_at, 4),
+            "prompt_eval": round(first_token_at - prompt_started_at, 4),
+            "generation": round(finished_at - first_token_at, 4),
+            "generated_tokens": self.generated_tokens,
+        }
+        if self.prefilled_at is not None:
+            timings["prefill"] = round(self.prefilled_at - self.started_at, 4)
+            # Time the prefilled worker waited for the rest of the prompt
+            timings["prefill_idle"] = round(max(prompt_started_at - self.prefilled_at, 0.0), 4)
+            timings["prefilled_tokens"] = self.prefilled_tokens
+        if self.draft is not None:
+            timings["draft_tokens"] = self.draft.drafted
+            timings["accepted_draft_tokens"] = self.draft.accepted(self.generated_tokens)
+        return timings
+
+
+class InferenceWorker:
+    """Owns the Llama instance and runs generation jobs on a dedicated thread.
+
+    Jobs are taken from a bounded asyncio queue one at a time; generated tokens
+    are pushed back to the caller through a per-job asyncio queue so the event
+    loop is never blocked by llama.cpp. Jobs may ask for one of the worker's
+    draft models, by speculative mode, to generate several tokens per forward pass.
+    """
+
+    def __init__(self, llm, max_queue_size: int = 8, session_cache: Optional[SessionStateCache] = None, name: str = "0", drafts: Optional[dict] = None):
+        self.llm = llm
+        self.name = name
+        self.max_queue_size = max_queue_size
+        self.session_cache = session_cache
+        self.drafts = drafts or {}
+        # Session whose tokens are currently held in the llama.cpp context
+        self._active_session: Optional[str] = None
+        # One job may be running while max_queue_size others are waiting
+        self.max_pending = max_queue_size + 1
+
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"llama-inference-{name}")
+        self._queue: Optional[asyncio.Queue] = None
+        self._consumer: Optional[asyncio.Task] = None
+
+        self._pending = 0
+        self._running = False
+        self._started = 0
+        self._completed = 0
+        self._rejected = 0
+        self._total_wait = 0.0
+        self._last_wait = 0.0
+        self._max_wait = 0.0
+        self._created_at = time.monotonic()
+        self._busy_seconds = 0.0
+        self._busy_since: Optional[float] = None
+        self._draft_tokens = 0
+        self._accepted_draft_tokens = 0
+
+    @property
+    def load(self) -> int:
+        """Jobs reserved on this worker, running or waiting"""
+        return self._pending
+
+    @property
+    def has_capacity(self) -> bool:
+        return self._pending < self.max_pending
+
+    def utilisation(self) -> float:
+        """Fraction of the time since startup this worker spent running jobs"""
+        now = time.monotonic()
+        busy = self._busy_seconds + (now - self._busy_since if self._busy_since is not None else 0.0)
+        return busy / max(now - self._created_at, 1e-9)
+
+    def reserve(self) -> InferenceSlot:
+        """Reserve a place in the queue, failing fast when it is full"""
+        if self._pending >= self.max_pending:
+            self._rejected += 1
+            raise QueueFullError(
+                f"Inference queue is full ({self.max_queue_size} waiting). Please retry shortly."
+            )
+        self._pending += 1
+        return InferenceSlot(self)
+
+    def _release_slot(self):
+        self._pending -= 1
+
+    def _ensure_started(self):
+        if self._consumer is None or self._consumer.done():
+            self._queue = asyncio.Queue(maxsize=self.max_pending)
+            self._consumer = asyncio.get_running_loop().create_task(self._consume())
+
+    def submit(
+        self,
+        prompt: Optional[str] = None,
+        slot: Optional[InferenceSlot] = None,
+        session_id: Optional[str] = None,
+        speculative: Optional[str] = None,
+        prefix: Optional[str] = None,
+        prompt_timeout: Optional[float] = None,
+        **params
+    ) -> InferenceJob:
+        """Queue a completion whose tokens are read with results.
+
+        Without a prompt, the worker evaluates prefix as soon as the job starts
+        and then waits for job.set_prompt, or job.cancel. After prompt_timeout
+        seconds it gives the job up and moves on to the next one, set_prompt
+        then returns False and the job's slot stays reserved for queueing the
+        whole prompt again.
+        """
+        if speculative not in (None, "off") and speculative not in self.drafts:
+            raise ValueError(f"Speculative mode {speculative} is not available")
+        slot = slot or self.reserve()
+        job = InferenceJob(prompt, params, slot, session_id, speculative, prefix, prompt_timeout)
+        try:
+            self._ensure_started()
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            slot.release()
+            raise QueueFullError("Inference queue is full. Please retry shortly.")
+        return job
+
+    async def results(self, job: InferenceJob, timings: Optional[dict] = None) -> AsyncGenerator[str, None]:
+        """Yield the tokens of a submitted job as they are generated.
+
+        If a timings dict is given it is filled with the job's timings once it ends.
+        """
+        try:
+            while True:
+                item = await job.tokens.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # Stops the worker thread early if the caller went away
+            job.cancel()
+            if timings is not None:
+                timings.update(job.timings())
+
+    async def stream(self, prompt: str, slot: Optional[InferenceSlot] = None, session_id: Optional[str] = None, timings: Optional[dict] = None, speculative: Optional[str] = None, **params) -> AsyncGenerator[str, None]:
+        """Queue a completion and yield its tokens as they are generated, see results"""
+        job = self.submit(prompt, slot=slot, session_id=session_id, speculative=speculative, **params)
+        async for text in self.results(job, timings):
+            yield text
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            try:
+                if job.cancelled.is_set():
+                    continue
+
+                wait = time.monotonic() - job.enqueued_at
+                self._started += 1
+                self._last_wait = wait
+                self._total_wait += wait
+                self._max_wait = max(self._max_wait, wait)
+
+                self._running = True
+                self._busy_since = time.monotonic()
+                await loop.run_in_executor(self._executor, self._run_job, job, loop)
+                self._completed += 1
+            except Exception as e:
+                logging.error(f"Inference job failed: {str(e)}")
+            finally:
+                if self._busy_since is not None:
+                    busy = time.monotonic() - self._busy_since
+                    self._busy_seconds += busy
+                    self._busy_since = None
+                    WORKER_BUSY_SECONDS.labels(worker=self.name).inc(busy)
+                self._running = False
+                if not job.expired:
+                    job.slot.release()
+                self._queue.task_done()
+
+    def _restore_session(self, session_id: Optional[str]):
+        """Load the session's cached state so only the new prompt suffix is evaluated"""
+        if self.session_cache is None or session_id is None:
+            self._active_session = None
+            return
+
+        if session_id == self._active_session:
+            # The context still holds this session's tokens
+            self.session_cache.record_hit()
+            return
+
+        state = self.session_cache.get(session_id)
+        if state is not None:
+            load_compact_state(self.llm, state)
+            logging.info(f"Restored cached state for session {session_id}")
+        self._active_session = session_id
+
+    def _prefill(self, prefix: str) -> int:
+        """Evaluate the tokens of prefix that are not in the context yet, returning how many that were"""
+        # Without the last token, which may merge with the text that completes the prompt.
+        # Special tokens are parsed the way Llama.create_completion tokenizes the prompt
+        tokens = self.llm.tokenize(prefix.encode("utf-8"), special=True)[:-1]
+        cached = self.llm.input_ids[:self.llm.n_tokens]
+        common = 0
+        for cached_token, token in zip(cached, tokens):
+            if cached_token != token:
+                break
+            common += 1
+        if common < len(tokens):
+            self.llm.n_tokens = common
+            self.llm.eval(tokens[common:])
+        return len(tokens) - common
+
+    def _save_session(self, session_id: Optional[str]):
+        if self.session_cache is None or session_id is None:
+            return
+        self.session_cache.put(session_id, save_compact_state(self.llm))
+
+    def _run_job(self, job: InferenceJob, loop: asyncio.AbstractEventLoop):
+        """Runs on the inference thread; the only place the Llama instance is used"""
+        completed = False
+        job.started_at = time.monotonic()
+        try:
+            self._restore_session(job.session_id)
+            if job.prefix is not None:
+                # The prompt is completed while the prefix is evaluated; generation
+                # then starts from the prefix's state and only evaluates the rest
+                job.prefilled_tokens = self._prefill(job.prefix)
+                job.prefilled_at = time.monotonic()
+                # Set by set_prompt, or by cancel when the caller went away
+                if not job.prompt_ready.wait(job.prompt_timeout) and job.expire():
+                    logging.warning(f"Prompt of inference job not complete after {job.prompt_timeout}s, releasing the worker")
+                    return
+                if job.cancelled.is_set():
+                    logging.info("Inference job cancelled before its prompt was complete")
+                    return
+            job.prompt_started_at = time.monotonic()
+            if job.speculative in self.drafts:
+                # Read by Llama.generate after every forward pass
+                job.draft = RecordingDraftModel(self.drafts[job.speculative])
+                self.llm.draft_model = job.draft
+            for output in self.llm(job.prompt, stream=True, **job.params):
+                if job.cancelled.is_set():
+                    logging.info("Inference job cancelled by caller")
+                    break
+                if job.first_token_at is None:
+                    job.first_token_at = time.monotonic()
+                job.generated_tokens += 1
+                if output and 'choices' in output and len(output['choices']) > 0:
+                    text = output['choices'][0]['text']
+                    if text:
+                        loop.call_soon_threadsafe(job.tokens.put_nowait, text)
+            completed = True
+        except Exception as e:
+            self._active_session = None
+            loop.call_soon_threadsafe(job.tokens.put_nowait, e)
+        finally:
+            job.finished_at = time.monotonic()
+            if job.draft is not None:
+                self.llm.draft_model = None
+                self._draft_tokens += job.draft.drafted
+                self._accepted_draft_tokens += job.draft.accepted(job.generated_tokens)
+            loop.call_soon_threadsafe(job.tokens.put_nowait, _DONE)
+
+        # Saved after the caller has its answer so it does not delay the stream
+        if completed:
+            try:
+                self._save_session(job.session_id)
+            except Exception as e:
+                logging.error(f"Error saving session state: {str(e)}")
+
+    def stats(self) -> dict:
+        return {
+            "worker": self.name,
+            "pending": self._pending,
+            "utilisation": round(self.utilisation(), 4),
+            "queue_depth": self._queue.qsize() if self._queue else 0,
+            "max_queue_size": self.max_queue_size,
+            "running": self._running,
+            "completed": self._completed,
+            "rejected": self._rejected,
+            "last_wait_seconds": round(self._last_wait, 4),
+            "avg_wait_seconds": round(self._total_wait / self._started, 4) if self._started else 0.0,
+            "max_wait_seconds": round(self._max_wait, 4),
+            "speculative_modes": sorted(self.drafts),
+            "draft_tokens": self._draft_tokens,
+            "accepted_draft_tokens": self._accepted_draft_tokens,
+            "session_cache": self.session_cache.stats() if self.session_cache else None,
+        }
+
+    async def close(self):
+        if self._consumer is not None:
+            self._consumer.cancel()
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,15 +1,48 @@
 from llama_cpp import Llama
 from app.models.chat import ChatMessage
+from app.services.inference_worker import InferenceSlot, QueueFullError
+from app.services.worker_pool import InferencePool
+from app.services.session_cache import SessionStateCache
+from app.services.context_builder import ContextBuilder, ContextCandidate
+from app.services.answer_cache import AnswerCache, Sources
+from app.services.conversation_store import ConversationStore
+from app.services.speculative import load_draft_models
+from app.services.docstore_client import DocstoreClient, DocstoreError, normalize_query
+from app.metrics import (
+    timed, SPAN_SECONDS, TIME_TO_FIRST_TOKEN, TOKENS_PER_SECOND,
+    PROMPT_TOKENS, CONTEXT_TOKENS, GENERATED_TOKENS, CHAT_TURNS, SPECULATIVE_TOKENS
+)
 import os
+from contextlib import aclosing
 from pathlib import Path
-from typing import Generator, Optional, AsyncGenerator
+from typing import Dict, Generator, Hashable, List, Optional, AsyncGenerator, Tuple
+import asyncio
 import logging
-import aiohttp
+import time
+
+# Tokens kept free in the context window besides the answer, for stop words and rounding
+CONTEXT_SAFETY_MARGIN = 64
+# Characters of surrounding document to load per context token, when expanding a match
+CHARS_PER_TOKEN = 6
+# Documents retrieved per question, and the least similarity worth using
+RETRIEVAL_RESULTS = 2
+RETRIEVAL_MIN_SIMILARITY = 0.1
+# Longest summary of the compacted turns of a conversation
+SUMMARY_MAX_TOKENS = 200
 
 class LLMService:
-    def __init__(self, docstore_url: str = "http://localhost:8001"):
+    def __init__(self, docstore_url: str = "http://localhost:8001", llms: Optional[List[Llama]] = None):
         self.docstore_url = docstore_url
+        # Shared, pooled connection to the docstore with a retrieval cache
+        self.docstore = DocstoreClient(
+            docstore_url,
+            timeout=float(os.getenv("DOCSTORE_TIMEOUT", 10.0)),
+            cache_ttl=float(os.getenv("RETRIEVAL_CACHE_TTL", 300.0))
+        )
         model_path = os.getenv("MODEL_PATH")
+        self.n_ctx = int(os.getenv("LLM_N_CTX", 32000))
+        # Upper bound on retrieved context per request, in tokens
+        self.context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", 3000))
         
         # Define system prompts
         self.system_prompt = """You are a helpful AI assistant that provides accurate information based strictly on the given context. 
@@ -20,7 +53,102 @@ Your responses should:
 4. Quote relevant parts of the context when appropriate
 5. Be concise and direct"""
 
-        if not Path(model_path).exists():
+        # One model instance per worker. The weights are memory-mapped, so the
+        # instances share them through the page cache and only the contexts add up
+        self.num_workers = max(1, int(os.getenv("LLM_WORKERS", 1)))
+        # Split the cores between the workers, llama.cpp defaults to half of them
+        self.n_threads = int(os.getenv("LLM_THREADS_PER_WORKER", max(1, (os.cpu_count() or 2) // 2 // self.num_workers)))
+
+        # Map the weights instead of reading them, so loading is fast and workers share
+        # them; mlock keeps them in RAM so the OS cannot page them out under pressure
+        self.use_mmap = os.getenv("LLM_USE_MMAP", "true").lower() == "true"
+        self.use_mlock = os.getenv("LLM_USE_MLOCK", "false").lower() == "true"
+
+        # Speculative decoding drafts several tokens, by prompt lookup or with a small
+        # model, which the main model checks in one forward pass. Checking needs the
+        # logits of every position, so it is enabled when the models are loaded
+        self.speculative = os.getenv("SPECULATIVE_DECODING", "false").lower() == "true"
+        # Mode of requests that do not choose one
+        self.default_speculative = os.getenv("SPECULATIVE_DEFAULT", "off")
+        # Most memory a worker may use for those logits, n_ctx * n_vocab floats
+        self.speculative_max_logits_bytes = int(os.getenv("SPECULATIVE_MAX_LOGITS_BYTES", 4 * 1024 ** 3))
+
+        # Preloaded models can be passed in, e.g. by the benchmarks
+        if llms is None:
+            llms = [self._load_model(model_path, logits_all=self.speculative)]
+            if self.speculative:
+                # Before anything is evaluated, the logits are only allocated once written
+                self._check_logits_memory(llms[0])
+            llms += [self._load_model(model_path, logits_all=self.speculative) for _ in range(self.num_workers - 1)]
+        # Used for tokenizing, which every instance does the same
+        self.llm = llms[0]
+
+        drafts = None
+        if self.speculative:
+            draft_tokens = int(os.getenv("SPECULATIVE_DRAFT_TOKENS", 10))
+            draft_model_path = os.getenv("DRAFT_MODEL_PATH")
+            drafts = [
+                load_draft_models(llm, draft_tokens, self._load_model(draft_model_path) if draft_model_path else None)
+                for llm in llms
+            ]
+
+        # All generation goes through the pool, whose workers own the Llama instances
+        self.pool = InferencePool(
+            llms,
+            max_queue_size=int(os.getenv("INFERENCE_QUEUE_SIZE", 8)),
+            session_cache=SessionStateCache(
+                capacity_bytes=int(os.getenv("SESSION_CACHE_BYTES", 2 * 1024 ** 3))
+            ),
+            drafts=drafts
+        )
+        if self.default_speculative not in self.speculative_modes():
+            raise ValueError(
+                f"SPECULATIVE_DEFAULT={self.default_speculative} is not available, "
+                f"use one of {', '.join(self.speculative_modes())}"
+            )
+
+        self.context_builder = ContextBuilder(self.count_tokens)
+
+        # Opt-in reuse of answers to near-identical questions about the same documents
+        self.answer_cache = None
+        if os.getenv("ANSWER_CACHE", "false").lower() == "true":
+            self.answer_cache = AnswerCache(
+                max_size=int(os.getenv("ANSWER_CACHE_SIZE", 1000)),
+                ttl=float(os.getenv("ANSWER_CACHE_TTL", 3600.0)),
+                min_similarity=float(os.getenv("ANSWER_CACHE_SIMILARITY", 0.95))
+            )
+
+        # Histories of clients that only send their new message
+        self.conversations = ConversationStore(
+            self.count_tokens,
+            history_tokens=int(os.getenv("CONVERSATION_HISTORY_TOKENS", 2000)),
+            max_conversations=int(os.getenv("MAX_CONVERSATIONS", 1000)),
+            idle_ttl=float(os.getenv("CONVERSATION_IDLE_SECONDS", 1800.0))
+        )
+        # Compacted turns are summarized by the model, or only dropped
+        self.summarize_history = os.getenv("CONVERSATION_SUMMARY", "true").lower() == "true"
+        # The latest summary task of every session, each waits for the one before
+        self._summaries: Dict[str, asyncio.Task] = {}
+        # Evaluate the start of the prompt while the context is being retrieved
+        self.pipelined_prefill = os.getenv("PIPELINED_PREFILL", "true").lower() == "true"
+
+    def speculative_modes(self) -> List[str]:
+        """Speculative modes requests can choose from"""
+        return ["off", *self.pool.workers[0].drafts]
+
+    def _check_logits_memory(self, llm: Llama):
+        """Refuse speculative decoding when the logits of a full context would not fit the limit"""
+        n_vocab = llm.n_vocab()
+        logits_bytes = self.n_ctx * n_vocab * 4
+        if logits_bytes > self.speculative_max_logits_bytes:
+            raise ValueError(
+                f"Speculative decoding keeps the logits of every position, {logits_bytes / 1024 ** 3:.1f} GiB per worker "
+                f"with LLM_N_CTX={self.n_ctx} and a vocabulary of {n_vocab} tokens, more than SPECULATIVE_MAX_LOGITS_BYTES. "
+                f"Set LLM_N_CTX to at most {self.speculative_max_logits_bytes // (n_vocab * 4)} or raise the limit"
+            )
+
+    def _load_model(self, model_path: Optional[str], logits_all: bool = False) -> Llama:
+        if not model_path or not Path(model_path).exists():
             raise FileNotFoundError(
                 f"Model file not found at {model_path}. "
                 "Please download a GGUF format model and place it in the models directory, "
@@ -30,120 +158,402 @@ Your responses should:
         logging.getLogger('llama_cpp').setLevel(logging.ERROR)
         
         try:
-            self.llm = Llama(
+            return Llama(
                 model_path=model_path,
                 n_gpu_layers=32,
                 verbose=False,
-                n_ctx=32000
+                n_ctx=self.n_ctx,
+                n_threads=self.n_threads,
+                use_mmap=self.use_mmap,
+                use_mlock=self.use_mlock,
+                logits_all=logits_all
             )
         except Exception as e:
             logging.error(f"Error loading model: {str(e)}")
             raise
-    
-    async def generate_response_stream(self, messages: list[ChatMessage], temperature: float = 0.15, max_tokens: int = 150) -> AsyncGenerator[str, None]:
+
+    async def warm_up(self):
+        """Evaluate the system prompt on every worker, which also pages in the weights.
+
+        Every prompt starts with it, so first turns only evaluate what follows.
+        """
+        started = time.perf_counter()
+        await self.pool.warm_up(f"System: {self.system_prompt}")
+        logging.info(f"Warmed up {len(self.pool.workers)} workers in {time.perf_counter() - started:.1f}s")
+
+    def count_tokens(self, text: str) -> int:
+        return len(self.llm.tokenize(text.encode("utf-8"), add_bos=False))
+
+    def _context_budget(self, prompt_without_context: str, max_tokens: int) -> int:
+        """Tokens left for retrieved context once the prompt and the answer are accounted for"""
+        available = self.n_ctx - self.count_tokens(prompt_without_context) - max_tokens - CONTEXT_SAFETY_MARGIN
+        return max(0, min(self.context_token_budget, available))
+
+    def reserve_slot(self, session_id: Optional[str] = None) -> InferenceSlot:
+        """Reserve an inference slot on the session's worker, raising QueueFullError when saturated"""
+        return self.pool.reserve(session_id)
+
+    @staticmethod
+    def _split_latest(messages: list[ChatMessage]) -> Tuple[list[ChatMessage], Optional[ChatMessage]]:
+        """The earlier turns and the new user message, if the messages end with one"""
+        if messages and messages[-1].role == "user":
+            return messages[:-1], messages[-1]
+        return messages, None
+
+    def _prompt_prefix(self, history: list[ChatMessage], summary: Optional[str] = None) -> str:
+        """The part of the prompt that does not depend on retrieval: system prompt, summary and earlier turns"""
+        formatted_messages = [f"System: {self.system_prompt}"]
+
+        if summary:
+            formatted_messages.append(f"Summary of the earlier conversation: {summary}")
+
+        # Add conversation history
+        for msg in history:
+            if msg.role == "user":
+                formatted_messages.append(f"User: {msg.content}")
+            elif msg.role == "assistant":
+                formatted_messages.append(f"Assistant: {msg.content}")
+        return "\n".join(formatted_messages)
+
+    def _build_prompt(self, messages: list[ChatMessage], context: Optional[str], summary: Optional[str] = None) -> str:
+        """Build the chat prompt with its stable part first.
+
+        The system prompt, the summary of compacted turns and earlier turns come
+        before the retrieved context and the new user message, so consecutive
+        turns of a session share a long token prefix that llama.cpp does not
+        need to evaluate again.
+        """
+        history, latest = self._split_latest(messages)
+        formatted_messages = [self._prompt_prefix(history, summary)]
+
+        if context:
+            formatted_messages.append(f"\nRelevant Context:\n{context}\n")
+
+        if latest:
+            formatted_messages.append(f"User: {latest.content}")
+
+        prompt = "\n".join(formatted_messages)
+        prompt += "\nAssistant:"
+        return prompt
+
+    async def generate_response_stream(self, messages: list[ChatMessage], temperature: float = 0.15, max_tokens: int = 150, slot: Optional[InferenceSlot] = None, session_id: Optional[str] = None, usage: Optional[dict] = None, timings: Optional[dict] = None, message: Optional[str] = None, speculative: Optional[str] = None) -> AsyncGenerator[str, None]:
+        """Stream an answer.
+
+        With message, the answer continues the session's conversation kept by
+        the server instead of the given messages, and the turn is added to it.
+        speculative picks the speculative mode, the configured default when None.
+        If given, usage is filled with per-request token counts and timings with
+        the duration of every stage of the turn, in seconds.
+        """
+        slot = slot or self.reserve_slot(session_id)
+        usage = usage if usage is not None else {}
+        timings = timings if timings is not None else {}
+        turn_started = time.perf_counter()
+        speculative = speculative or self.default_speculative
+        params = dict(
+            max_tokens=max_tokens,
+            temperature=temperature,
+            top_p=0.76,
+            top_k=10,
+            repeat_penalty=1.2,
+            presence_penalty=0.1,
+            frequency_penalty=0.1,
+            stop=["User:", "Context:", "System:"]
+        )
+        job = None
+        summary = None
+        if message is not None:
+            conversation = self.conversations.get(session_id)
+            history = conversation.turns if conversation else []
+            summary = conversation.summary if conversation else None
+            messages = [*history, ChatMessage(role="user", content=message)]
         try:
             # Get the last user message to fetch relevant context
             last_user_message = next((msg.content for msg in reversed(messages) if msg.role == "user"), None)
+
+            cached_key = None
+            # Answers generated with other sampling settings are not reused
+            answer_settings = (temperature, max_tokens)
+            if self.answer_cache is not None and last_user_message and not summary and self._is_first_question(messages):
+                with timed("answer_cache_lookup", timings):
+                    answer, cached_key = await self._lookup_answer(last_user_message, answer_settings)
+                if answer is not None:
+                    logging.info("Answering from the answer cache")
+                    timings["time_to_first_token"] = round(time.perf_counter() - turn_started, 4)
+                    TIME_TO_FIRST_TOKEN.observe(timings["time_to_first_token"])
+                    usage.update(cached=True, context_tokens=0, prompt_tokens=0, generated_tokens=0)
+                    CHAT_TURNS.labels(outcome="cached").inc()
+                    yield answer
+                    if message is not None:
+                        self._record_turn(session_id, message, answer)
+                    return
+
             context = None
-            
+            context_tokens = 0
+            # Room left after the system prompt, history and the answer
+            with timed("context_budget", timings):
+                budget = self._context_budget(self._build_prompt(messages, None, summary), max_tokens)
+
+            # The worker evaluates the system prompt, summary and earlier turns while the
+            # context is retrieved, and only the context and new message once it is back.
+            # Only on an otherwise idle worker, it holds the worker until the prompt is complete,
+            # or for as long as a docstore request may take, after which it gives the job up
+            if self.pipelined_prefill and last_user_message and slot.worker.load <= 1:
+                job = self.pool.submit(
+                    slot=slot,
+                    session_id=session_id,
+                    speculative=speculative,
+                    prefix=self._prompt_prefix(self._split_latest(messages)[0], summary),
+                    prompt_timeout=self.docstore.total_timeout,
+                    **params
+                )
+
             if last_user_message:
                 # Fetch context for the last user message
-                context = await self.get_context(last_user_message)
+                with timed("retrieval", timings):
+                    context, context_tokens = await self.get_context(last_user_message, budget, timings)
                 if context:
                     logging.info("Context found and will be used for response")
                     logging.debug(f"Context preview: {context[:200]}...")
                 else:
                     logging.info("No relevant context found")
 
-            # Build the prompt with system message and context
-            formatted_messages = [f"System: {self.system_prompt}"]
-            
-            if context:
-                formatted_messages.append(f"\nRelevant Context:\n{context}\n")
-            
-            # Add conversation history
-            for msg in messages:
-                if msg.role == "user":
-                    formatted_messages.append(f"User: {msg.content}")
-                elif msg.role == "assistant":
-                    formatted_messages.append(f"Assistant: {msg.content}")
-            
-            prompt = "\n".join(formatted_messages)
-            prompt += "\nAssistant:"
+            # Build the prompt with system message, history and context
+            with timed("prompt_build", timings):
+                prompt = self._build_prompt(messages, context, summary)
+                prompt_tokens = self.count_tokens(prompt)
 
-            # Generate streaming response
-            stream = self.llm(
-                prompt,
-                max_tokens=max_tokens,
-                temperature=temperature,
-                top_p=0.76,
-                top_k=10,
-                repeat_penalty=1.2,
-                presence_penalty=0.1,
-                frequency_penalty=0.1,
-                stop=["User:", "Context:", "System:"],
-                stream=True
-            )
+            usage["context_tokens"] = context_tokens
+            usage["context_budget"] = budget
+            usage["prompt_tokens"] = prompt_tokens
+            usage["speculative"] = speculative
+
+            # Generate streaming response on the slot's inference worker
+            job_timings = {}
+            if job is not None and job.set_prompt(prompt):
+                tokens = self.pool.results(job, job_timings)
+            else:
+                if job is not None:
+                    # The worker gave the job up and left its slot reserved for this one
+                    logging.warning("Retrieval outlasted the pipelined prefill, queueing the whole prompt")
+                tokens = self.pool.stream(prompt, slot=slot, session_id=session_id, timings=job_timings, speculative=speculative, **params)
+            # Closed as soon as this turn ends, which stops generation when the caller went away
+            stream = aclosing(tokens)
             
-            for output in stream:
-                if output and 'choices' in output and len(output['choices']) > 0:
-                    text = output['choices'][0]['text']
-                    if text:
-                        yield text
+            first_token = True
+            answer_parts = []
+            async with stream as tokens:
+                async for text in tokens:
+                    if first_token:
+                        first_token = False
+                        timings["time_to_first_token"] = round(time.perf_counter() - turn_started, 4)
+                        TIME_TO_FIRST_TOKEN.observe(timings["time_to_first_token"])
+                    answer_parts.append(text)
+                    yield text
+
+            if cached_key is not None:
+                embedding, sources = cached_key
+                self.answer_cache.put(embedding, sources, "".join(answer_parts), settings=answer_settings)
+            if message is not None:
+                self._record_turn(session_id, message, "".join(answer_parts).strip())
+            self._record_generation(job_timings, usage, timings)
+            CHAT_TURNS.labels(outcome="ok").inc()
 
+        except (asyncio.CancelledError, GeneratorExit):
+            CHAT_TURNS.labels(outcome="cancelled").inc()
+            logging.info("Chat turn cancelled, the client went away")
+            raise
         except Exception as e:
+            CHAT_TURNS.labels(outcome="error").inc()
             logging.error(f"Error in generate_response_stream: {str(e)}")
             logging.exception("Full traceback:")
             yield f"Error generating response: {str(e)}"
+        finally:
+            if job is not None:
+                # Frees the worker if the turn ended before the prompt was complete
+                job.cancel()
+            slot.release()
+            timings["total"] = round(time.perf_counter() - turn_started, 4)
+
+    def _record_turn(self, session_id: str, question: str, answer: str):
+        """Add a turn to the session's conversation, summarizing the turns it pushed out"""
+        dropped = self.conversations.append(session_id, question, answer)
+        if dropped and self.summarize_history:
+            task = asyncio.create_task(self._summarize(session_id, dropped, self._summaries.get(session_id)))
+            self._summaries[session_id] = task
+            task.add_done_callback(lambda done: self._forget_summary(session_id, done))
+
+    def _forget_summary(self, session_id: str, task: asyncio.Task):
+        if self._summaries.get(session_id) is task:
+            del self._summaries[session_id]
 
-    async def get_context(self, query: str) -> Optional[str]:
+    async def _summarize(self, session_id: str, dropped: list[ChatMessage], previous_task: Optional[asyncio.Task] = None):
+        """Fold compacted turns into the conversation's summary, on a free inference slot.
+
+        Runs after the session's previous summary task, so it extends the latest
+        summary instead of both starting from the same one and one being lost.
+        """
+        if previous_task is not None:
+            await asyncio.wait([previous_task])
+        conversation = self.conversations.get(session_id)
+        previous = conversation.summary if conversation else None
+        lines = [f"{'User' if msg.role == 'user' else 'Assistant'}: {msg.content}" for msg in dropped]
+        prompt = "\n".join([
+            "System: Summarize the conversation below in a few sentences. Keep names, numbers, facts and decisions.",
+            *([f"Summary so far: {previous}"] if previous else []),
+            *lines,
+            "Summary:"
+        ])
+        try:
+            slot = self.reserve_slot()
+        except QueueFullError:
+            # Under load the turns are only dropped, generation for users comes first
+            logging.info(f"Inference queue full, conversation {session_id} compacted without a summary")
+            return
         try:
-            # Make request to docstore with new query format
-            async with aiohttp.ClientSession() as session:
-                async with session.post(
-                    f"{self.docstore_url}/query",
-                    json={
-                        "query": query,
-                        "num_results": 2,
-                        "min_similarity": 0.1
-                    }
-                ) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        
-                        # Check if we have results using new response format
-                        if result.get("has_results") and result.get("results"):
-                            # Use dict to deduplicate by source
-                            unique_contexts = {}
-                            
-                            for doc_result in result["results"]:
-                                source = doc_result["metadata"]["source"]
-                                # Only add if we haven't seen this source before
-                                if source not in unique_contexts:
-                                    full_doc = doc_result["metadata"]["full_document"]
-                                    unique_contexts[source] = f"Source: {source}\n\n{full_doc}"
-                            
-                            if not unique_contexts:
-                                return None
-                            
-                            # Combine unique contexts with separators
-                            context = "\n\n---\n\n".join(unique_contexts.values())
-                            logging.info(f"Found {len(unique_contexts)} unique documents for context")
-                            return context
-                            
-                        return None
-                    else:
-                        logging.error(f"Error fetching context: {response.status}")
-                        return None
+            with timed("summarize"):
+                stream = self.pool.stream(prompt, slot=slot, max_tokens=SUMMARY_MAX_TOKENS, temperature=0.1, stop=["User:", "System:"])
+                summary = "".join([text async for text in stream]).strip()
+            if summary:
+                self.conversations.set_summary(session_id, summary)
+        except Exception as e:
+            logging.error(f"Error summarizing conversation {session_id}: {str(e)}")
+        finally:
+            slot.release()
+
+    @staticmethod
+    def _is_first_question(messages: list[ChatMessage]) -> bool:
+        """Only answers without earlier turns are cached, later ones depend on the conversation"""
+        return sum(1 for msg in messages if msg.role in ("user", "assistant")) == 1
+
+    async def _retrieve(self, query: str) -> dict:
+        # The answer cache needs the query embedding, ask for it so both share one docstore request
+        return await self.docstore.query(
+            query,
+            num_results=RETRIEVAL_RESULTS,
+            min_similarity=RETRIEVAL_MIN_SIMILARITY,
+            include_embedding=self.answer_cache is not None
+        )
+
+    async def _lookup_answer(self, query: str, settings: Hashable) -> Tuple[Optional[str], Optional[Tuple[list, Sources]]]:
+        """A cached answer for the question generated with these settings, and the key to store a new answer under on a miss"""
+        try:
+            result = await self._retrieve(query)
+        except DocstoreError as e:
+            logging.error(f"Error looking up cached answer: {str(e)}")
+            return None, None
+        embedding = result.get("query_embedding")
+        if not embedding:
+            return None, None
+        sources = AnswerCache.sources_of(result.get("results") or [])
+        return self.answer_cache.get(embedding, sources, settings=settings), (embedding, sources)
+
+    def _record_generation(self, job_timings: dict, usage: dict, timings: dict):
+        """Move the inference worker's timings into the turn's usage, timings and metrics"""
+        generated_tokens = job_timings.pop("generated_tokens", 0)
+        draft_tokens = job_timings.pop("draft_tokens", None)
+        accepted_draft_tokens = job_timings.pop("accepted_draft_tokens", None)
+        if "prefilled_tokens" in job_timings:
+            usage["prefilled_tokens"] = job_timings.pop("prefilled_tokens")
+        for span, seconds in job_timings.items():
+            SPAN_SECONDS.labels(span=span).observe(seconds)
+        timings.update(job_timings)
+
+        usage["generated_tokens"] = generated_tokens
+        # Rate after the first token, which is dominated by prompt evaluation
+        generation = job_timings.get("generation", 0)
+        if generated_tokens > 1 and generation > 0:
+            usage["tokens_per_second"] = round((generated_tokens - 1) / generation, 2)
+            TOKENS_PER_SECOND.labels(speculative=usage.get("speculative", "off")).observe(usage["tokens_per_second"])
+
+        if draft_tokens is not None:
+            usage["draft_tokens"] = draft_tokens
+            usage["accepted_draft_tokens"] = accepted_draft_tokens
+            usage["acceptance_rate"] = round(accepted_draft_tokens / draft_tokens, 4) if draft_tokens else None
+            SPECULATIVE_TOKENS.labels(mode=usage["speculative"], result="drafted").inc(draft_tokens)
+            SPECULATIVE_TOKENS.labels(mode=usage["speculative"], result="accepted").inc(accepted_draft_tokens)
+
+        PROMPT_TOKENS.observe(usage.get("prompt_tokens", 0))
+        CONTEXT_TOKENS.observe(usage.get("context_tokens", 0))
+        GENERATED_TOKENS.observe(generated_tokens)
+
+    async def get_context(self, query: str, token_budget: Optional[int] = None, timings: Optional[dict] = None) -> Tuple[Optional[str], int]:
+        """Retrieve documents for the query and assemble them into at most token_budget tokens.
+
+        Returns the context text and the number of tokens it uses.
+        """
+        budget = self.context_token_budget if token_budget is None else min(token_budget, self.context_token_budget)
+        if budget <= 0:
+            logging.info("No room left in the context window for retrieved context")
+            return None, 0
+
+        cache_key = ("context", normalize_query(query), budget)
+        cached = await self.docstore.get_cached(cache_key)
+        if cached is not None:
+            logging.info("Using cached context")
+            return cached
+
+        try:
+            with timed("docstore_query", timings):
+                result = await self._retrieve(query)
+
+            # Check if we have results using new response format
+            if not (result.get("has_results") and result.get("results")):
+                self.docstore.set_cached(cache_key, (None, 0))
+                return None, 0
+
+            # Deduplicate by source, results arrive best match first
+            candidates = []
+            seen_sources = set()
+            with timed("document_fetch", timings):
+                for doc_result in result["results"]:
+                    source = doc_result["metadata"]["source"]
+                    if source not in seen_sources:
+                        seen_sources.add(source)
+                        candidates.append(await self._load_candidate(doc_result, budget))
+
+            # Tokenizing is CPU work, keep it off the event loop
+            with timed("context_build", timings):
+                context, tokens = await asyncio.to_thread(self.context_builder.build, candidates, budget)
+            logging.info(f"Using {tokens} of {budget} context tokens from {len(candidates)} documents")
+            self.docstore.set_cached(cache_key, (context, tokens))
+            return context, tokens
 
         except Exception as e:
             logging.error(f"Error getting context: {str(e)}", exc_info=True)
-            return None
+            return None, 0
+
+    async def _load_candidate(self, doc_result: dict, budget: int) -> ContextCandidate:
+        """Load the part of a matched document that could fit the budget around the matched chunk"""
+        metadata = doc_result["metadata"]
+        source = metadata["source"]
+        start, end = metadata.get("start"), metadata.get("end")
+        if start is None or end is None:
+            return ContextCandidate.from_chunk(source, doc_result["text"])
 
-    async def process_prompt(self, prompt: str) -> str:
+        if metadata.get("full_document"):
+            text = metadata["full_document"]
+            return ContextCandidate(source, text, 0, len(text), start, end)
+
+        doc_id = metadata.get("doc_id")
+        if doc_id:
+            window = budget * CHARS_PER_TOKEN
+            window_start = max(0, start - window)
+            try:
+                document = await self.docstore.get_document(doc_id, window_start, end + window)
+                return ContextCandidate(source, document["text"], window_start, document["length"], start, end)
+            except DocstoreError as e:
+                logging.error(f"Error fetching document {doc_id}: {str(e)}")
+
+        return ContextCandidate.from_chunk(source, doc_result["text"])
+
+    async def process_prompt(self, prompt: str, slot: Optional[InferenceSlot] = None) -> str:
         """Process a prompt with context from the document store"""
+        slot = slot or self.reserve_slot()
         try:
-            context = await self.get_context(prompt)
+            max_tokens = 150
+            budget = self._context_budget(f"{self.system_prompt}\n\nQuestion: {prompt}\nAnswer:", max_tokens)
+            context, _ = await self.get_context(prompt, budget)
             
             if context:
                 full_prompt = f"""{self.system_prompt}
@@ -159,18 +569,22 @@ Answer (based strictly on the above context):"""
 Question: {prompt}
 Answer: I don't have any relevant information in my context to answer this question."""
 
-            response = self.llm(
+            stream = self.pool.stream(
                 full_prompt,
-                max_tokens=150,
+                slot=slot,
+                max_tokens=max_tokens,
                 temperature=0.1,
                 top_p=0.1,
                 top_k=10,
                 repeat_penalty=1.2,
                 stop=["Question:", "Context:", "System:"],
             )
+            response = "".join([text async for text in stream])
 
-            return response['choices'][0]['text'].strip()
+            return response.strip()
 
         except Exception as e:
             logging.error(f"Error processing prompt: {str(e)}")
-            return f"Error processing prompt: {str(e)}"
\ No newline at end of file
+            return f"Error processing prompt: {str(e)}"
+        finally:
+            slot.release()
\ No newline at end of file
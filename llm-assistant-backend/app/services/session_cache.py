@@ -0,0 +1,114 @@
+import logging
+import threading
+from collections import OrderedDict
+
+
+class SessionStateCache:
+    """LRU cache of llama.cpp states keyed by chat session, bounded by memory.
+
+    Restoring a session's state before generating lets llama.cpp reuse the
+    longest common token prefix, so only the new part of the prompt is evaluated.
+    """
+
+    def __init__(self, capacity_bytes: int):
+        self.capacity_bytes = capacity_bytes
+        self._states: "OrderedDict[str, object]" = OrderedDict()
+        self._size = 0
+        # Written from the inference thread, read by /health
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _state_size(state) -> int:
+        size = int(getattr(state, "llama_state_size", 0))
+        for name in ("scores", "input_ids"):
+            array = getattr(state, name, None)
+            if array is not None:
+                size += array.nbytes
+        return size
+
+    def record_hit(self):
+        with self._lock:
+            self.hits += 1
+
+    def get(self, session_id: str):
+        with self._lock:
+            state = self._states.get(session_id)
+            if state is None:
+                self.misses += 1
+                return None
+            self._states.move_to_end(session_id)
+            self.hits += 1
+            return state
+
+    def put(self, session_id: str, state):
+        size = self._state_size(state)
+        if size > self.capacity_bytes:
+            logging.info(f"Session state for {session_id} ({size} bytes) exceeds cache budget, not cached")
+            self.discard(session_id)
+            return
+
+        with self._lock:
+            previous = self._states.pop(session_id, None)
+            if previous is not None:
+                self._size -= self._state_size(previous)
+
+            self._states[session_id] = state
+            self._size += size
+
+            while self._size > self.capacity_bytes and self._states:
+                evicted_id, evicted = self._states.popitem(last=False)
+                self._size -= self._state_size(evicted)
+                self.evictions += 1
+                logging.info(f"Evicted cached state for session {evicted_id}")
+
+    def discard(self, session_id: str):
+        with self._lock:
+            state = self._states.pop(session_id, None)
+            if state is not None:
+                self._size -= self._state_size(state)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "sessions": len(self._states),
+                "size_bytes": self._size,
+                "capacity_bytes": self.capacity_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+def save_compact_state(llm):
+    """Llama.save_state without the unused rows of its scores and input_ids.
+
+    save_state copies the whole (n_ctx, n_vocab) scores array, gigabytes for a
+    large context and vocabulary. Generation only samples from the logits of
+    tokens it evaluates itself, plus the last one, so only that row is kept,
+    also when logits are kept for every position for speculative decoding.
+    """
+    n_tokens = llm.n_tokens
+    scores = llm.scores
+    llm.scores = scores[max(n_tokens - 1, 0):n_tokens]
+    try:
+        state = llm.save_state()
+    finally:
+        llm.scores = scores
+    state.input_ids = state.input_ids[:n_tokens].copy()
+    return state
+
+
+def load_compact_state(llm, state):
+    """Restore a state saved by save_compact_state into the Llama's full-size arrays"""
+    scores, input_ids = llm.scores, llm.input_ids
+    llm.load_state(state)
+    n_tokens = state.n_tokens
+    scores[n_tokens - len(state.scores):n_tokens] = state.scores
+    input_ids[:n_tokens] = state.input_ids
+    llm.scores, llm.input_ids = scores, input_ids
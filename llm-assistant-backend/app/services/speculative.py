@@ -0,0 +1,58 @@
+from typing import Optional
+
+import numpy as np
+import numpy.typing as npt
+from llama_cpp import Llama
+from llama_cpp.llama_speculative import LlamaDraftModel, LlamaPromptLookupDecoding
+
+
+class DraftModelDecoding(LlamaDraftModel):
+    """Drafts tokens greedily with a small model that shares the main model's vocabulary.
+
+    The draft model keeps its own context, so only the tokens the main model
+    accepted since the previous call are evaluated again.
+    """
+
+    def __init__(self, llm: Llama, num_pred_tokens: int = 10):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids: npt.NDArray[np.intc], /, **kwargs) -> npt.NDArray[np.intc]:
+        cached = self.llm.input_ids[:self.llm.n_tokens]
+        shared = min(len(cached), len(input_ids))
+        mismatches = np.nonzero(cached[:shared] != input_ids[:shared])[0]
+        prefix = int(mismatches[0]) if len(mismatches) else shared
+        # The logits of the last token are needed, so it is evaluated again when cached
+        prefix = min(prefix, len(input_ids) - 1)
+        num_pred_tokens = min(self.num_pred_tokens, self.llm.n_ctx() - len(input_ids))
+        if prefix < 0 or num_pred_tokens <= 0:
+            return np.array([], dtype=np.intc)
+
+        self.llm.n_tokens = prefix
+        self.llm.eval(input_ids[prefix:].tolist())
+        drafted = []
+        for index in range(num_pred_tokens):
+            token = int(np.argmax(self.llm.scores[self.llm.n_tokens - 1]))
+            if token == self.llm.token_eos():
+                break
+            drafted.append(token)
+            if index < num_pred_tokens - 1:
+                self.llm.eval([token])
+        return np.array(drafted, dtype=np.intc)
+
+
+def load_draft_models(
+    llm: Llama,
+    num_pred_tokens: int = 10,
+    draft_llm: Optional[Llama] = None
+) -> dict:
+    """The draft models a worker can use, by speculative mode"""
+    drafts = {"prompt_lookup": LlamaPromptLookupDecoding(num_pred_tokens=num_pred_tokens)}
+    if draft_llm is not None:
+        if draft_llm.n_vocab() != llm.n_vocab():
+            raise ValueError(
+                f"The draft model has a vocabulary of {draft_llm.n_vocab()} tokens, "
+                f"the main model one of {llm.n_vocab()}; they must share a tokenizer"
+            )
+        drafts["draft"] = DraftModelDecoding(draft_llm, num_pred_tokens=num_pred_tokens)
+    return drafts
@@ -0,0 +1,72 @@
+import asyncio
+import time
+from typing import AsyncGenerator, Awaitable, Callable, Optional
+
+# How often the client connection is checked while waiting for tokens
+DISCONNECT_POLL_INTERVAL = 0.25
+
+
+class ClientDisconnected(Exception):
+    """Raised by coalesce_tokens when the client has gone away"""
+
+
+async def _watch(is_disconnected: Callable[[], Awaitable[bool]], interval: float):
+    while not await is_disconnected():
+        await asyncio.sleep(interval)
+
+
+async def coalesce_tokens(
+    tokens: AsyncGenerator[str, None],
+    max_delay: float = 0.05,
+    max_bytes: int = 256,
+    is_disconnected: Optional[Callable[[], Awaitable[bool]]] = None,
+    poll_interval: float = DISCONNECT_POLL_INTERVAL
+) -> AsyncGenerator[str, None]:
+    """Join streamed tokens into fewer, larger pieces of text.
+
+    A piece is sent once it holds max_bytes bytes or its first token has
+    waited max_delay seconds. The first token of the stream is sent on its own,
+    so the time to first token does not change. When is_disconnected reports
+    the client gone, the token stream is cancelled, which stops generation and
+    frees its inference slot, and ClientDisconnected is raised.
+    """
+    watcher = asyncio.ensure_future(_watch(is_disconnected, poll_interval)) if is_disconnected else None
+    next_token: Optional[asyncio.Future] = None
+    buffer, size, deadline = [], 0, None
+    first = True
+    try:
+        while True:
+            if next_token is None:
+                next_token = asyncio.ensure_future(tokens.__anext__())
+            waiting = {next_token} if watcher is None else {next_token, watcher}
+            timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+            done, _ = await asyncio.wait(waiting, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if watcher is not None and watcher in done:
+                # Also when checking failed, the connection is gone then too
+                raise ClientDisconnected()
+            if next_token in done:
+                try:
+                    token = next_token.result()
+                except StopAsyncIteration:
+                    next_token = None
+                    break
+                next_token = None
+                buffer.append(token)
+                size += len(token.encode("utf-8"))
+                if deadline is None:
+                    deadline = time.monotonic() + max_delay
+            if buffer and (first or size >= max_bytes or time.monotonic() >= deadline):
+                first = False
+                piece, buffer, size, deadline = "".join(buffer), [], 0, None
+                yield piece
+        if buffer:
+            yield "".join(buffer)
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+        if next_token is not None:
+            # Cancelling the pending read unwinds the token stream right away
+            next_token.cancel()
+        else:
+            await tokens.aclose()
@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from typing import AsyncGenerator, List, Optional
+
+from app.services.inference_worker import InferenceJob, InferenceWorker, InferenceSlot, QueueFullError
+from app.services.session_cache import SessionStateCache
+
+
+class InferencePool:
+    """Routes generation jobs over several inference workers, each with its own model.
+
+    A job goes to the worker with the fewest running and waiting jobs. Jobs of
+    a chat session stay on the worker that served the session before, whose
+    context still holds its tokens, unless that worker is clearly busier than
+    the least loaded one. The session state cache is shared, so a session that
+    moves to another worker is restored from it.
+    """
+
+    def __init__(
+        self,
+        llms: list,
+        max_queue_size: int = 8,
+        session_cache: Optional[SessionStateCache] = None,
+        affinity_slack: int = 1,
+        max_sessions: int = 10000,
+        drafts: Optional[List[dict]] = None
+    ):
+        if not llms:
+            raise ValueError("An inference pool needs at least one model")
+        # Draft models by speculative mode, for every worker
+        drafts = drafts or [{} for _ in llms]
+        self.workers: List[InferenceWorker] = [
+            InferenceWorker(llm, max_queue_size=max_queue_size, session_cache=session_cache, name=str(index), drafts=worker_drafts)
+            for index, (llm, worker_drafts) in enumerate(zip(llms, drafts))
+        ]
+        self.session_cache = session_cache
+        # Extra jobs a session's worker may have over the least loaded one before the session moves
+        self.affinity_slack = affinity_slack
+        self.max_sessions = max_sessions
+        # Session id to the index of the worker that last served it, least recently used first
+        self._affinity: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._rejected = 0
+        self._moved_sessions = 0
+
+    def _pick(self, session_id: Optional[str]) -> int:
+        least = min(range(len(self.workers)), key=lambda index: self.workers[index].load)
+        if session_id is None:
+            return least
+
+        preferred = self._affinity.get(session_id)
+        if preferred is None or preferred == least:
+            return least
+        worker = self.workers[preferred]
+        if worker.has_capacity and worker.load <= self.workers[least].load + self.affinity_slack:
+            return preferred
+        self._moved_sessions += 1
+        logging.info(f"Moving session {session_id} from worker {preferred} to worker {least}")
+        return least
+
+    def reserve(self, session_id: Optional[str] = None) -> InferenceSlot:
+        """Reserve a place on the best worker for the session, failing fast when all are full"""
+        with self._lock:
+            index = self._pick(session_id)
+            try:
+                slot = self.workers[index].reserve()
+            except QueueFullError:
+                self._rejected += 1
+                raise
+            if session_id is not None:
+                self._affinity[session_id] = index
+                self._affinity.move_to_end(session_id)
+                while len(self._affinity) > self.max_sessions:
+                    self._affinity.popitem(last=False)
+            return slot
+
+    def stream(self, prompt: str, slot: Optional[InferenceSlot] = None, session_id: Optional[str] = None, timings: Optional[dict] = None, **params) -> AsyncGenerator[str, None]:
+        """Queue a completion on the slot's worker and yield its tokens, see InferenceWorker.stream"""
+        slot = slot or self.reserve(session_id)
+        return slot.worker.stream(prompt, slot=slot, session_id=session_id, timings=timings, **params)
+
+    def submit(self, prompt: Optional[str] = None, slot: Optional[InferenceSlot] = None, session_id: Optional[str] = None, **params) -> InferenceJob:
+        """Queue a completion on the slot's worker, see InferenceWorker.submit"""
+        slot = slot or self.reserve(session_id)
+        return slot.worker.submit(prompt, slot=slot, session_id=session_id, **params)
+
+    def results(self, job: InferenceJob, timings: Optional[dict] = None) -> AsyncGenerator[str, None]:
+        """Yield the tokens of a submitted job, see InferenceWorker.results"""
+        return job.slot.worker.results(job, timings)
+
+    async def warm_up(self, prompt: str):
+        """Evaluate prompt on every worker, so its tokens are already in each context"""
+        async def warm(worker: InferenceWorker):
+            async for _ in worker.stream(prompt, max_tokens=1, temperature=0.0):
+                pass
+
+        await asyncio.gather(*(warm(worker) for worker in self.workers))
+
+    def stats(self) -> dict:
+        workers = [worker.stats() for worker in self.workers]
+        for worker in workers:
+            # Reported once for the whole pool
+            worker.pop("session_cache", None)
+        draft_tokens = sum(worker["draft_tokens"] for worker in workers)
+        accepted_draft_tokens = sum(worker["accepted_draft_tokens"] for worker in workers)
+        return {
+            "workers": len(self.workers),
+            "pending": sum(worker["pending"] for worker in workers),
+            "running": sum(1 for worker in workers if worker["running"]),
+            "completed": sum(worker["completed"] for worker in workers),
+            "rejected": self._rejected,
+            "utilisation": round(sum(worker["utilisation"] for worker in workers) / len(workers), 4),
+            "sessions": len(self._affinity),
+            "moved_sessions": self._moved_sessions,
+            "speculative": {
+                "modes": workers[0]["speculative_modes"],
+                "draft_tokens": draft_tokens,
+                "accepted_draft_tokens": accepted_draft_tokens,
+                "acceptance_rate": round(accepted_draft_tokens / draft_tokens, 4) if draft_tokens else None,
+            },
+            "session_cache": self.session_cache.stats() if self.session_cache else None,
+            "per_worker": workers,
+        }
+
+    async def close(self):
+        for worker in self.workers:
+            await worker.close()
@@ -1,9 +1,19 @@
+import argparse
 import uvicorn
 from dotenv import load_dotenv
 import os
 
 if __name__ == "__main__":
     load_dotenv()
+
+    parser = argparse.ArgumentParser(description="Run the LLM assistant API")
+    parser.add_argument(
+        "--production",
+        action="store_true",
+        default=os.getenv("RUN_MODE") == "production",
+        help="Run without auto-reload, so the model is loaded once and never reloaded on file changes"
+    )
+    args = parser.parse_args()
     
     os.environ["MODEL_PATH"] = "app/models/Qwen2-7B-Instruct.Q6_K.gguf"
 
@@ -11,5 +21,5 @@ if __name__ == "__main__":
         "app.main:app",
         host=os.getenv("API_HOST", "0.0.0.0"),
         port=int(os.getenv("API_PORT", 8080)),
-        reload=True
-    ) 
\ No newline at end of file
+        reload=not args.production
+    ) 
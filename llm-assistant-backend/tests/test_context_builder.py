@@ -0,0 +1,34 @@
+import random
+
+from app.services.context_builder import ContextBuilder, ContextCandidate
+
+
+def count_tokens(text: str) -> int:
+    return len(text.split())
+
+
+def test_context_stays_within_budget_and_counts_its_tokens():
+    random.seed(7)
+    words = ["alpha", "beta", "gamma", "delta", "epsilon"]
+    document = " ".join(random.choice(words) + random.choice(["", ".", ","]) for _ in range(400))
+    builder = ContextBuilder(count_tokens)
+
+    for budget in range(5, 500, 7):
+        candidates = []
+        for source in ("a.md", "b.md"):
+            # Chunk offsets that split words, so pieces of text are not whole words
+            start = random.randint(1, len(document) - 200)
+            candidates.append(ContextCandidate(source, document, 0, len(document), start, start + 97))
+        context, used = builder.build(candidates, budget)
+
+        assert context is not None
+        assert used == count_tokens(context)
+        assert used <= budget
+
+
+def test_small_budget_truncates_the_best_chunk():
+    chunk = "one two three four five six seven eight nine ten"
+    context, used = ContextBuilder(count_tokens).build([ContextCandidate.from_chunk("a.md", chunk)], 6)
+
+    assert context.startswith("Source: a.md")
+    assert used == count_tokens(context) <= 6
@@ -0,0 +1,56 @@
+import asyncio
+
+from app.services.inference_worker import InferenceWorker
+
+
+class FakeLlama:
+    """Tokenizes by character and answers with the last character of the prompt"""
+
+    def __init__(self):
+        self.input_ids = [0] * 512
+        self.n_tokens = 0
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False):
+        return list(text)
+
+    def eval(self, tokens):
+        for token in tokens:
+            self.input_ids[self.n_tokens] = token
+            self.n_tokens += 1
+
+    def __call__(self, prompt, stream=True, **params):
+        yield {"choices": [{"text": prompt[-1]}]}
+
+
+async def collect(tokens) -> str:
+    return "".join([text async for text in tokens])
+
+
+def test_worker_gives_up_a_job_whose_prompt_is_late():
+    async def run():
+        worker = InferenceWorker(FakeLlama())
+        job = worker.submit(prefix="System: be brief", prompt_timeout=0.05)
+        queued = worker.submit("User: hi")
+
+        # Runs although the first job's prompt never comes
+        assert await asyncio.wait_for(collect(worker.results(queued)), 5) == "i"
+        assert not job.set_prompt("System: be brief User: hello")
+        # The slot stays reserved for queueing the whole prompt
+        assert worker.load >= 1
+        fallback = worker.stream("System: be brief User: hello", slot=job.slot)
+        assert await asyncio.wait_for(collect(fallback), 5) == "o"
+
+    asyncio.run(run())
+
+
+def test_worker_runs_a_job_whose_prompt_is_in_time():
+    async def run():
+        worker = InferenceWorker(FakeLlama())
+        job = worker.submit(prefix="System: be brief", prompt_timeout=5)
+        await asyncio.sleep(0.05)
+
+        assert job.set_prompt("System: be brief User: hello")
+        assert await asyncio.wait_for(collect(worker.results(job)), 5) == "o"
+        assert job.prefilled_tokens == len("System: be brief") - 1
+
+    asyncio.run(run())
@@ -0,0 +1,94 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.services.session_cache import SessionStateCache, load_compact_state, save_compact_state
+
+
+class FakeLlama:
+    """Keeps scores and input_ids the way llama_cpp.Llama 0.2.56 does"""
+
+    def __init__(self, n_ctx: int = 512, n_vocab: int = 1000, logits_all: bool = False):
+        self.context_params = SimpleNamespace(logits_all=logits_all)
+        self.n_tokens = 0
+        self.input_ids = np.zeros((n_ctx,), dtype=np.intc)
+        self.scores = np.zeros((n_ctx, n_vocab), dtype=np.single)
+        self.kv = b""
+
+    def eval(self, tokens):
+        for token in tokens:
+            self.input_ids[self.n_tokens] = token
+            self.scores[self.n_tokens] = token
+            self.n_tokens += 1
+        self.kv = bytes(self.n_tokens * 16)
+
+    def save_state(self):
+        return SimpleNamespace(
+            scores=self.scores.copy(),
+            input_ids=self.input_ids.copy(),
+            n_tokens=self.n_tokens,
+            llama_state=self.kv,
+            llama_state_size=len(self.kv),
+        )
+
+    def load_state(self, state):
+        self.scores = state.scores.copy()
+        self.input_ids = state.input_ids.copy()
+        self.n_tokens = state.n_tokens
+        self.kv = state.llama_state
+
+
+def real_size(state) -> int:
+    return state.scores.nbytes + state.input_ids.nbytes + len(state.llama_state)
+
+
+def test_accounted_size_matches_compact_state():
+    llm = FakeLlama()
+    llm.eval(list(range(1, 41)))
+    state = save_compact_state(llm)
+
+    assert state.scores.shape == (1, 1000)
+    assert SessionStateCache._state_size(state) == real_size(state)
+    assert real_size(state) < llm.scores.nbytes // 100
+
+
+def test_accounted_size_with_logits_all():
+    llm = FakeLlama(logits_all=True)
+    llm.eval(list(range(1, 41)))
+    state = save_compact_state(llm)
+
+    assert state.scores.shape == (1, 1000)
+    assert SessionStateCache._state_size(state) == real_size(state)
+
+
+def test_cache_budget_counts_arrays():
+    llm = FakeLlama()
+    llm.eval(list(range(1, 41)))
+    state = save_compact_state(llm)
+    cache = SessionStateCache(capacity_bytes=real_size(state) * 2)
+
+    cache.put("a", state)
+    cache.put("b", save_compact_state(llm))
+    cache.put("c", save_compact_state(llm))
+
+    assert cache.stats()["size_bytes"] == 2 * real_size(state)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_restore_keeps_full_size_arrays():
+    llm = FakeLlama()
+    llm.eval([5, 6, 7])
+    state = save_compact_state(llm)
+    llm.eval([8, 9])
+
+    other = FakeLlama()
+    load_compact_state(other, state)
+
+    assert other.scores.shape == (512, 1000)
+    assert other.input_ids.shape == (512,)
+    assert other.n_tokens == 3
+    assert list(other.input_ids[:3]) == [5, 6, 7]
+    assert np.all(other.scores[2] == 7)
+    # Generation continues in the restored arrays
+    other.eval([10])
+    assert other.input_ids[3] == 10
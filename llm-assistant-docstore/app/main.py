@@ -1,11 +1,64 @@
-from fastapi import FastAPI, UploadFile, HTTPException
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, UploadFile, HTTPException, Request, Response, Form, Query
 from fastapi.middleware.cors import CORSMiddleware
-from app.services.document_service import DocumentService
-from app.models.document import QueryRequest, QueryResponse
+from fastapi.responses import JSONResponse
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from app.metrics import REQUEST_SECONDS
+from app.services.job_service import IngestionJobManager
+from app.models.document import QueryRequest, QueryResponse, QueryBatchRequest, QueryBatchResponse, DocumentContent, IndexVersion
+from app.models.job import JobInfo, BatchJobResponse
+from app.services.search_filter import split_tags
+from typing import List, Optional
+import asyncio
 import logging
+import os
+import time
 
-app = FastAPI()
-doc_service = DocumentService()
+# Set once the embedding model and vector store are loaded
+doc_service = None
+job_manager = None
+# "loading", "warming_up", "ready" or "failed"
+service_state = {"status": "loading", "error": None, "load_seconds": None}
+
+async def load_service():
+    """Load the embedding model and stores off the event loop, while the API already answers /health"""
+    global doc_service, job_manager
+    started = time.perf_counter()
+    try:
+        # Imported here so importing the app does not load torch, langchain and chromadb
+        from app.services.document_service import DocumentService
+        doc_service = await asyncio.to_thread(DocumentService)
+        job_manager = IngestionJobManager(
+            doc_service,
+            max_workers=int(os.getenv("INGESTION_WORKERS", 2)),
+            persist_interval=float(os.getenv("PERSIST_INTERVAL", 5.0))
+        )
+    except Exception as e:
+        logging.error(f"Error loading document service: {str(e)}")
+        logging.exception("Full traceback:")
+        service_state.update(status="failed", error=str(e))
+        return
+
+    if os.getenv("DOCSTORE_WARMUP", "true").lower() == "true":
+        service_state["status"] = "warming_up"
+        try:
+            await doc_service.warm_up()
+        except Exception as e:
+            logging.error(f"Error warming up the document service: {str(e)}")
+
+    service_state.update(status="ready", load_seconds=round(time.perf_counter() - started, 2))
+    logging.info(f"Document service ready after {service_state['load_seconds']}s")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    loader = asyncio.create_task(load_service())
+    yield
+    loader.cancel()
+    if job_manager is not None:
+        # Finish running jobs and flush pending writes
+        job_manager.shutdown()
+
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -16,26 +69,149 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.post("/documents")
-async def upload_document(file: UploadFile):
+@app.middleware("http")
+async def record_request_latency(request: Request, call_next):
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = request.scope.get("route")
+    REQUEST_SECONDS.labels(
+        method=request.method,
+        route=route.path if route else "unmatched",
+        status=response.status_code
+    ).observe(time.perf_counter() - started)
+    return response
+
+def require_service():
+    """The document service, or 503 while it is loading or when it failed to load"""
+    if service_state["status"] == "ready":
+        return doc_service
+    if service_state["status"] == "failed":
+        raise HTTPException(status_code=503, detail="Document service failed to load. Please check server logs for details.")
+    raise HTTPException(
+        status_code=503,
+        detail="Document service is still loading. Please retry shortly.",
+        headers={"Retry-After": "5"}
+    )
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/health")
+async def health_check():
+    """Liveness: the API is up, whether or not the service is ready"""
+    loaded = doc_service is not None
+    return {
+        "status": "healthy",
+        "service_state": service_state["status"],
+        "embedding_cache": doc_service.embedding_model.stats() if loaded else None,
+        "lexical_index": {"chunks": doc_service.lexical_index.count()} if loaded else None,
+        "vector_index": doc_service.vector_index.stats() if loaded and doc_service.vector_index else None
+    }
+
+@app.get("/ready")
+async def readiness_check():
+    """Readiness: 200 once the embedding model and stores are loaded and warmed up, 503 before that"""
+    return JSONResponse(
+        status_code=200 if service_state["status"] == "ready" else 503,
+        content={"ready": service_state["status"] == "ready", **service_state}
+    )
+
+@app.get("/index/version", response_model=IndexVersion)
+async def index_version():
+    return IndexVersion(index_version=require_service().manifest.index_version())
+
+@app.post("/documents", response_model=JobInfo, status_code=202)
+async def upload_document(file: UploadFile, tags: Optional[str] = Form(None)):
+    """Index a file in the background, tags is an optional comma-separated list"""
+    doc_service = require_service()
     try:
-        content = await file.read()
-        doc_id = await doc_service.add_document(file.filename, content)
-        return {"message": "Document added successfully", "doc_id": doc_id}
+        path = await doc_service.spool_upload(file)
+        return job_manager.submit(file.filename, path, ",".join(split_tags(tags)))
     except Exception as e:
         logging.error(f"Error uploading document: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/documents/batch", response_model=BatchJobResponse, status_code=202)
+async def upload_documents(files: List[UploadFile], tags: Optional[str] = Form(None)):
+    """Index files in the background, tags are given to every file"""
+    doc_service = require_service()
+    paths = []
+    try:
+        # Every file is spooled before any job starts, so a failure queues none of them
+        for file in files:
+            paths.append(await doc_service.spool_upload(file))
+    except Exception as e:
+        for path in paths:
+            path.unlink(missing_ok=True)
+        logging.error(f"Error uploading documents: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return BatchJobResponse(jobs=[
+        job_manager.submit(file.filename, path, ",".join(split_tags(tags)))
+        for file, path in zip(files, paths)
+    ])
+
+@app.get("/jobs/{job_id}", response_model=JobInfo)
+async def get_job(job_id: str):
+    require_service()
+    job = job_manager.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job
+
 @app.post("/query", response_model=QueryResponse)
-async def query_documents(request: QueryRequest):
+async def query_documents(request: QueryRequest, response: Response):
+    doc_service = require_service()
     try:
+        timings = {}
         results = await doc_service.query_documents(
             query=request.query,
             num_results=request.num_results,
             min_relevance=request.min_relevance,
-            min_similarity=request.min_similarity
+            min_similarity=request.min_similarity,
+            include_full_document=request.include_full_document,
+            timings=timings,
+            include_embedding=request.include_embedding,
+            filters=request.filters
+        )
+        response.headers["Server-Timing"] = ", ".join(
+            f"{span};dur={seconds * 1000:.1f}" for span, seconds in timings.items()
         )
         return results
     except Exception as e:
         logging.error(f"Error processing query: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e)) 
+
+@app.post("/query/batch", response_model=QueryBatchResponse)
+async def query_documents_batch(request: QueryBatchRequest):
+    doc_service = require_service()
+    try:
+        # Run concurrently so the vector searches share embedding batches
+        responses = await asyncio.gather(*(
+            doc_service.query_documents(
+                query=query.query,
+                num_results=query.num_results,
+                min_relevance=query.min_relevance,
+                min_similarity=query.min_similarity,
+                include_full_document=query.include_full_document,
+                include_embedding=query.include_embedding,
+                filters=query.filters
+            )
+            for query in request.queries
+        ))
+        return QueryBatchResponse(responses=responses)
+    except Exception as e:
+        logging.error(f"Error processing query batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/documents/{doc_id}", response_model=DocumentContent)
+async def get_document(doc_id: str, start: int = Query(0, ge=0), end: Optional[int] = Query(None, ge=0)):
+    doc_service = require_service()
+    if not doc_service.document_store.is_valid_id(doc_id):
+        raise HTTPException(status_code=400, detail="Invalid document id")
+    # Reading the file would otherwise block every other request
+    document = await asyncio.to_thread(doc_service.get_document, doc_id, start, end)
+    if document is None:
+        raise HTTPException(status_code=404, detail="Document not found")
+    text, length = document
+    return DocumentContent(doc_id=doc_id, text=text, start=start, end=end, length=length)
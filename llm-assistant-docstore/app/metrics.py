@@ -0,0 +1,38 @@
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from prometheus_client import Histogram
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+SPAN_SECONDS = Histogram(
+    "docstore_span_seconds",
+    "Time spent in each stage of indexing and querying",
+    ["span"],
+    buckets=LATENCY_BUCKETS
+)
+REQUEST_SECONDS = Histogram(
+    "docstore_request_seconds",
+    "HTTP request latency by route",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS
+)
+QUERY_BATCH_SIZE = Histogram(
+    "docstore_query_batch_size",
+    "Number of queries embedded and searched together",
+    buckets=(1, 2, 4, 8, 16, 32, 64)
+)
+
+
+@contextmanager
+def timed(span: str, timings: Optional[dict] = None):
+    """Observe the duration of a block in SPAN_SECONDS and optionally record it in timings"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        SPAN_SECONDS.labels(span=span).observe(elapsed)
+        if timings is not None:
+            timings[span] = round(elapsed, 4)
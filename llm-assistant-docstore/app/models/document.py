@@ -1,7 +1,11 @@
+import re
+from datetime import date, datetime, time, timezone
 from enum import Enum
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional
 
+_DATE_ONLY = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
 class RelevanceLevel(str, Enum):
     HIGH = "high"
     MEDIUM = "medium"
@@ -10,7 +14,14 @@ class RelevanceLevel(str, Enum):
 
 class DocumentMetadata(BaseModel):
     source: str
-    full_document: str
+    doc_id: Optional[str] = None
+    start: Optional[int] = None
+    end: Optional[int] = None
+    tags: List[str] = []
+    # Unix time the document was modified or uploaded
+    modified: Optional[int] = None
+    # Only filled when explicitly requested; use GET /documents/{doc_id} instead
+    full_document: Optional[str] = None
     similarity: float
     relevance: RelevanceLevel
 
@@ -22,9 +33,60 @@ class QueryResult(BaseModel):
 class QueryResponse(BaseModel):
     results: List[QueryResult]
     has_results: bool = False
+    # Changes whenever documents are added, changed or removed
+    index_version: Optional[int] = None
+    # Embedding of the query, when requested, e.g. to key a semantic cache on
+    query_embedding: Optional[List[float]] = None
+
+class IndexVersion(BaseModel):
+    index_version: int
+
+class QueryFilters(BaseModel):
+    """Only search documents matching all of the given conditions"""
+    sources: Optional[List[str]] = None
+    # Documents with any of these tags
+    tags: Optional[List[str]] = None
+    modified_after: Optional[datetime] = None
+    modified_before: Optional[datetime] = None
+
+    @field_validator("modified_before", mode="before")
+    @classmethod
+    def _end_of_day(cls, value):
+        """A date without a time includes the whole day"""
+        if isinstance(value, str) and _DATE_ONLY.match(value):
+            value = date.fromisoformat(value)
+        if isinstance(value, date) and not isinstance(value, datetime):
+            return datetime.combine(value, time.max)
+        return value
+
+    @field_validator("modified_after", "modified_before")
+    @classmethod
+    def _utc(cls, value: Optional[datetime]) -> Optional[datetime]:
+        """Times without a timezone are in UTC"""
+        if value is not None and value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value
 
 class QueryRequest(BaseModel):
     query: str
     num_results: Optional[int] = 3
     min_relevance: Optional[RelevanceLevel] = None
-    min_similarity: Optional[float] = None
\ No newline at end of file
+    min_similarity: Optional[float] = None
+    include_full_document: bool = False
+    include_embedding: bool = False
+    filters: Optional[QueryFilters] = None
+
+class QueryBatchRequest(BaseModel):
+    queries: List[QueryRequest] = Field(..., min_length=1, max_length=64)
+
+class QueryBatchResponse(BaseModel):
+    # One response per query, in request order
+    responses: List[QueryResponse]
+
+class DocumentContent(BaseModel):
+    doc_id: str
+    text: str
+    start: int = 0
+    end: Optional[int] = None
+    # Length of the whole document, so callers can tell whether a slice is complete
+    length: int
\ No newline at end of file
@@ -0,0 +1,22 @@
+from enum import Enum
+from pydantic import BaseModel
+from typing import List, Optional
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+class JobInfo(BaseModel):
+    job_id: str
+    filename: str
+    status: JobStatus = JobStatus.QUEUED
+    doc_id: Optional[str] = None
+    error: Optional[str] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+class BatchJobResponse(BaseModel):
+    jobs: List[JobInfo]
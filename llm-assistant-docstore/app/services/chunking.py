@@ -0,0 +1,300 @@
+import re
+from collections import deque
+from typing import Callable, Deque, Iterator, List, NamedTuple, Optional, Tuple
+
+# A chunk as (start, end) character offsets into the document
+Span = Tuple[int, int]
+
+DEFAULT_MAX_TOKENS = 128
+DEFAULT_OVERLAP_TOKENS = 16
+
+# Words and single punctuation marks, a close and cheap stand-in for model tokens
+TOKEN = re.compile(r"\w+|[^\w\s]")
+FENCE = re.compile(r"[ \t]{0,3}(```|~~~)")
+HEADING = re.compile(r"[ \t]{0,3}#{1,6}(?:[ \t]|$)")
+BLANK = re.compile(r"\s*$")
+# Sentence punctuation followed by whitespace, so decimals, URLs and code are not split
+SENTENCE_END = re.compile(r"[.!?]+[\"')\]]*(?=\s)")
+ABBREVIATIONS = {
+    "e.g", "i.e", "etc", "vs", "cf", "approx", "fig", "no", "nr", "mr", "mrs", "ms", "dr", "prof",
+    "st", "jr", "sr", "inc", "ltd", "co", "jan", "feb", "mar", "apr", "jun", "jul", "aug", "sep",
+    "sept", "oct", "nov", "dec",
+}
+
+
+class _Unit(NamedTuple):
+    start: int
+    end: int
+    tokens: int
+    heading: bool
+
+
+class Chunker:
+    """Incremental, structure-aware chunker that produces character offsets.
+
+    Text is read line by line and grouped into headings, paragraphs and fenced
+    code blocks. Blocks that fit are kept whole; larger ones are split into
+    sentences (or lines, for code) and, as a last resort, token windows. Blocks
+    are packed into chunks of at most max_tokens, a heading always starts a new
+    chunk, and each chunk repeats up to overlap_tokens of the previous one.
+
+    Text can be fed in pieces of any size; only the part that may still end up
+    in a chunk is kept, and all work is done on offsets, so the cost is linear
+    in the input without copying it.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int = DEFAULT_MAX_TOKENS,
+        overlap_tokens: int = DEFAULT_OVERLAP_TOKENS,
+        count_tokens: Optional[Callable[[str], int]] = None
+    ):
+        if max_tokens <= 0 or not 0 <= overlap_tokens < max_tokens:
+            raise ValueError("Need max_tokens > 0 and 0 <= overlap_tokens < max_tokens")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count_tokens = count_tokens
+        # Lines and paragraphs are cut at these lengths so memory stays bounded
+        self.max_line_chars = max_tokens * 16
+        self.max_block_chars = max_tokens * 64
+
+        self._buffer = ""
+        # Document offset of _buffer[0] and of the first character not yet read
+        self._base = 0
+        self._pos = 0
+        # Block being collected: "text", "code" or None
+        self._block_kind: Optional[str] = None
+        self._block_start = 0
+        self._block_end = 0
+        self._fence: Optional[str] = None
+        # Units of the chunk being packed
+        self._units: Deque[_Unit] = deque()
+        self._tokens = 0
+        self._spans: List[Span] = []
+
+    def feed(self, text: str) -> List[Span]:
+        """Add the next piece of the document and return the chunks completed by it"""
+        if self._buffer:
+            self._trim()
+            self._buffer += text
+        else:
+            self._buffer = text
+        self._read_lines(final=False)
+        return self._take()
+
+    def close(self) -> List[Span]:
+        """Mark the end of the document and return the remaining chunks"""
+        self._read_lines(final=True)
+        self._end_block()
+        if self._units:
+            self._emit(overlap=False)
+        return self._take()
+
+    def text(self, start: int, end: int) -> str:
+        """Text of a span returned by the last call to feed or close"""
+        return self._buffer[start - self._base:end - self._base]
+
+    def _take(self) -> List[Span]:
+        spans, self._spans = self._spans, []
+        return spans
+
+    def _trim(self):
+        """Drop the consumed start of the buffer once it is at least half of it"""
+        keep_from = self._pos
+        if self._units:
+            keep_from = min(keep_from, self._units[0].start)
+        if self._block_kind is not None:
+            keep_from = min(keep_from, self._block_start)
+        drop = keep_from - self._base
+        if drop > 0 and drop * 2 >= len(self._buffer):
+            self._buffer = self._buffer[drop:]
+            self._base = keep_from
+
+    def _count(self, start: int, end: int) -> int:
+        if self.count_tokens is not None:
+            return self.count_tokens(self._buffer[start - self._base:end - self._base])
+        return sum(1 for _ in TOKEN.finditer(self._buffer, start - self._base, end - self._base))
+
+    def _strip(self, start: int, end: int) -> Span:
+        buffer, base = self._buffer, self._base
+        while start < end and buffer[start - base].isspace():
+            start += 1
+        while end > start and buffer[end - base - 1].isspace():
+            end -= 1
+        return start, end
+
+    def _read_lines(self, final: bool):
+        buffer, base = self._buffer, self._base
+        data_end = base + len(buffer)
+        while self._pos < data_end:
+            newline = buffer.find("\n", self._pos - base)
+            if newline != -1:
+                line_end = base + newline
+                next_pos = line_end + 1
+            elif final:
+                line_end = next_pos = data_end
+            elif data_end - self._pos > self.max_line_chars:
+                # A very long line without a newline yet, break it after the last space
+                limit = self._pos - base + self.max_line_chars
+                space = buffer.rfind(" ", self._pos - base, limit)
+                line_end = next_pos = base + (space + 1 if space != -1 else limit)
+            else:
+                return
+            self._line(self._pos, line_end, next_pos)
+            self._pos = next_pos
+
+    def _line(self, start: int, end: int, next_start: int):
+        """Handle the line between start and end; the next one starts after its newline, if any, at next_start"""
+        buffer, base = self._buffer, self._base
+        fence = FENCE.match(buffer, start - base, end - base)
+
+        if self._fence is not None:
+            self._block_end = end
+            if fence and fence.group(1) == self._fence:
+                self._fence = None
+                self._end_block()
+            elif self._block_end - self._block_start > self.max_block_chars:
+                # Keep the fence open, the rest of the code continues in a new block
+                self._end_block()
+                # A line broken for its length has no newline to skip
+                self._start_block("code", next_start)
+            return
+
+        if BLANK.match(buffer, start - base, end - base):
+            self._end_block()
+        elif fence:
+            self._end_block()
+            self._fence = fence.group(1)
+            self._start_block("code", start)
+            self._block_end = end
+        elif HEADING.match(buffer, start - base, end - base):
+            self._end_block()
+            self._start_block("heading", *self._strip(start, end))
+            self._end_block()
+        else:
+            start, end = self._strip(start, end)
+            if self._block_kind != "text":
+                self._end_block()
+                self._start_block("text", start)
+            self._block_end = end
+            if self._block_end - self._block_start > self.max_block_chars:
+                self._end_block()
+
+    def _start_block(self, kind: str, start: int, end: Optional[int] = None):
+        self._block_kind = kind
+        self._block_start = start
+        self._block_end = start if end is None else end
+
+    def _end_block(self):
+        kind, self._block_kind = self._block_kind, None
+        if kind is None:
+            return
+        start, end = self._strip(self._block_start, self._block_end)
+        if start >= end:
+            return
+
+        heading = kind == "heading"
+        tokens = self._count(start, end)
+        if tokens <= self.max_tokens:
+            self._add(_Unit(start, end, tokens, heading))
+            return
+
+        pieces = self._code_lines(start, end) if kind == "code" else self._sentences(start, end)
+        for piece_start, piece_end in pieces:
+            tokens = self._count(piece_start, piece_end)
+            if tokens <= self.max_tokens:
+                self._add(_Unit(piece_start, piece_end, tokens, heading))
+            else:
+                for window_start, window_end, window_tokens in self._token_windows(piece_start, piece_end):
+                    self._add(_Unit(window_start, window_end, window_tokens, heading))
+            heading = False
+
+    def _sentences(self, start: int, end: int) -> Iterator[Span]:
+        buffer, base = self._buffer, self._base
+        sentence_start = start
+        for match in SENTENCE_END.finditer(buffer, start - base, end - base):
+            # Look at the word before the punctuation to skip abbreviations and initials
+            word_start = match.start()
+            while word_start > sentence_start - base and (buffer[word_start - 1].isalnum() or buffer[word_start - 1] == "."):
+                word_start -= 1
+            word = buffer[word_start:match.start()].lower()
+            if word in ABBREVIATIONS or (len(word) == 1 and word.isalpha()):
+                continue
+            yield sentence_start, base + match.end()
+            sentence_start, _ = self._strip(base + match.end(), end)
+        if sentence_start < end:
+            yield sentence_start, end
+
+    def _code_lines(self, start: int, end: int) -> Iterator[Span]:
+        buffer, base = self._buffer, self._base
+        line_start = start
+        while line_start < end:
+            newline = buffer.find("\n", line_start - base, end - base)
+            line_end = end if newline == -1 else base + newline
+            # Indentation is part of code, only trailing whitespace is dropped
+            _, stripped_end = self._strip(line_start, line_end)
+            if stripped_end > line_start:
+                yield line_start, stripped_end
+            line_start = line_end + 1
+
+    def _token_windows(self, start: int, end: int) -> Iterator[Tuple[int, int, int]]:
+        """Split a span without usable boundaries into windows of max_tokens tokens"""
+        window_start, window_end, tokens = None, start, 0
+        for match in TOKEN.finditer(self._buffer, start - self._base, end - self._base):
+            if window_start is None:
+                window_start = self._base + match.start()
+            window_end = self._base + match.end()
+            tokens += 1
+            if tokens == self.max_tokens:
+                yield window_start, window_end, tokens
+                window_start, tokens = None, 0
+        if window_start is not None:
+            yield window_start, window_end, tokens
+
+    def _add(self, unit: _Unit):
+        if unit.heading and self._units and not self._units[-1].heading:
+            # A heading starts a new section, and with it a new chunk
+            self._emit(overlap=False)
+        elif self._units and self._tokens + unit.tokens > self.max_tokens:
+            self._emit(overlap=True)
+            # Drop the overlap again when it leaves no room for the new unit
+            while self._units and self._tokens + unit.tokens > self.max_tokens:
+                self._tokens -= self._units.popleft().tokens
+        self._units.append(unit)
+        self._tokens += unit.tokens
+
+    def _emit(self, overlap: bool):
+        units = self._units
+        self._spans.append((units[0].start, units[-1].end))
+        carry = self._overlap(units) if overlap and self.overlap_tokens else None
+        self._units = deque([carry]) if carry else deque()
+        self._tokens = carry.tokens if carry else 0
+
+    def _overlap(self, units: Deque[_Unit]) -> Optional[_Unit]:
+        """The end of a finished chunk to repeat at the start of the next one"""
+        end = units[-1].end
+        start, tokens = None, 0
+        # Whole trailing sentences or blocks first, so the overlap starts on a boundary
+        for unit in reversed(units):
+            if tokens + unit.tokens > self.overlap_tokens:
+                break
+            start, tokens = unit.start, tokens + unit.tokens
+        if start is None:
+            tail: Deque[int] = deque(maxlen=self.overlap_tokens)
+            for match in TOKEN.finditer(self._buffer, units[-1].start - self._base, end - self._base):
+                tail.append(match.start())
+            start, tokens = self._base + tail[0], len(tail)
+        if start <= units[0].start:
+            # The whole chunk would be repeated
+            return None
+        return _Unit(start, end, tokens, False)
+
+
+def chunk_spans(
+    text: str,
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    overlap_tokens: int = DEFAULT_OVERLAP_TOKENS
+) -> List[Span]:
+    """Split text into (start, end) character spans of at most max_tokens tokens"""
+    chunker = Chunker(max_tokens, overlap_tokens)
+    return chunker.feed(text) + chunker.close()
@@ -2,26 +2,93 @@ import os
 os.environ["LANGCHAIN_DISABLE_TELEMETRY"] = "true"
 
 from pathlib import Path
-import uuid
-from typing import List, Optional, Dict
+import asyncio
+import tempfile
+import time
+from typing import List, Optional, Dict, Tuple
 import logging
-from langchain_community.embeddings import HuggingFaceEmbeddings
+import numpy as np
 from langchain_community.vectorstores import Chroma
-from langchain.schema import Document
-from app.models.document import QueryResponse, QueryResult, DocumentMetadata, RelevanceLevel
+from langchain_core.documents import Document
+from app.models.document import QueryResponse, QueryResult, DocumentMetadata, RelevanceLevel, QueryFilters
+from app.services.document_store import DocumentStore
+from app.services.chunking import chunk_spans, DEFAULT_MAX_TOKENS, DEFAULT_OVERLAP_TOKENS
+from app.services.manifest import Manifest
+from app.services.ingestion import IngestionPipeline
+from app.services.embedding_cache import CachedEmbeddings
+from app.services.embedding_backend import create_embeddings
+from app.services.extractors import extract_file, BLOCK_SIZE
+from app.services.lexical_index import LexicalIndex, LexicalHit, is_exact_query, reciprocal_rank_fusion, term_coverage
+from app.services.query_batcher import QueryBatcher
+from app.services.search_filter import SearchFilter, normalize_tags, tags_of
+from app.services.vector_index import CompactVectorIndex, FULL_COLLECTION, METADATA_COLLECTION, full_collection
+from app.metrics import timed, SPAN_SECONDS
+
+# Chunks fetched per wanted source in a vector search
+CHUNKS_PER_SOURCE = 4
+# Searches per query when the chunks found so far come from too few sources
+MAX_VECTOR_PASSES = 3
 
 class DocumentService:
     def __init__(self):
-        # Initialize embedding model from local path
-        self.embedding_model = HuggingFaceEmbeddings(
-            model_name="models/embeddings",  # Local path to model
-            model_kwargs={'device': 'cpu'},
-            encode_kwargs={'normalize_embeddings': True}
+        # Embedding model of the configured backend, behind a persistent cache
+        embeddings, model_id = create_embeddings()
+        self.embedding_model = CachedEmbeddings(
+            embeddings,
+            model_id=model_id,
+            path="data/embedding_cache.sqlite3",
+            memory_size=int(os.getenv("EMBEDDING_CACHE_SIZE", 20000)),
+            disk_size=int(os.getenv("EMBEDDING_DISK_CACHE_SIZE", 500000)),
+            # mpnet embeds queries and documents alike
+            symmetric=True
         )
         
+        # Optionally, vector searches go to a quantized index instead of Chroma's
+        self.vector_index = None
+        if os.getenv("VECTOR_BACKEND", "chroma").lower() == "compact":
+            self.vector_index = CompactVectorIndex(
+                "data/vectors",
+                quantization=os.getenv("VECTOR_QUANTIZATION", "int8"),
+                probes=int(os.getenv("VECTOR_IVF_PROBES", 32)),
+                rerank_factor=int(os.getenv("VECTOR_RERANK_FACTOR", 4))
+            )
+
         # Initialize ChromaDB
         self.persist_directory = "data/chromadb"
         self.db = self._initialize_db()
+
+        # Full document text lives outside the vector store, keyed by content hash
+        self.document_store = DocumentStore("data/documents")
+        # Content hashes of indexed sources, used to re-index only what changed
+        self.manifest = Manifest("data/manifest.sqlite3")
+        # BM25 index of the same chunks, for exact identifiers and names
+        self.lexical_index = LexicalIndex("data/lexical.sqlite3")
+        self.pipeline = IngestionPipeline(
+            self.db,
+            self.embedding_model,
+            self.document_store,
+            self.manifest,
+            lexical_index=self.lexical_index,
+            chunk_tokens=int(os.getenv("CHUNK_TOKENS", DEFAULT_MAX_TOKENS)),
+            chunk_overlap=int(os.getenv("CHUNK_OVERLAP_TOKENS", DEFAULT_OVERLAP_TOKENS)),
+            vector_index=self.vector_index
+        )
+        self.pipeline.ensure_lexical_index()
+        self.pipeline.ensure_vector_index(full_collection(self.db) if self.vector_index is not None else None)
+
+        # Concurrent queries are embedded and searched together
+        self.query_batcher = QueryBatcher(
+            self.embedding_model.embed_queries,
+            self._search_by_vectors,
+            window=float(os.getenv("QUERY_BATCH_WINDOW_MS", 5)) / 1000,
+            max_batch_size=int(os.getenv("QUERY_BATCH_SIZE", 32))
+        )
+
+        # Uploads are spooled to disk here until their ingestion job has run
+        self.upload_dir = Path("data/uploads")
+        self.upload_dir.mkdir(parents=True, exist_ok=True)
+        for stale in self.upload_dir.glob("*.upload"):
+            stale.unlink()
         
         logging.info("Vector store initialized")
 
@@ -30,6 +97,7 @@ class DocumentService:
         if os.path.exists(self.persist_directory):
             return self._load_vector_db()
         return Chroma(
+            collection_name=self._collection_name(),
             persist_directory=self.persist_directory,
             embedding_function=self.embedding_model
         )
@@ -37,66 +105,67 @@ class DocumentService:
     def _load_vector_db(self) -> Chroma:
         """Load existing vector database"""
         return Chroma(
+            collection_name=self._collection_name(),
             persist_directory=self.persist_directory,
             embedding_function=self.embedding_model
         )
 
-    def _chunk_text(self, text: str, chunk_size: int = 500) -> List[str]:
-        """Split text into chunks of approximately chunk_size characters"""
-        sentences = text.split('.')
-        chunks = []
-        current_chunk = []
-        current_size = 0
-        
-        for sentence in sentences:
-            sentence = sentence.strip() + '.'
-            sentence_size = len(sentence)
-            
-            if current_size + sentence_size > chunk_size and current_chunk:
-                chunks.append(' '.join(current_chunk))
-                current_chunk = [sentence]
-                current_size = sentence_size
-            else:
-                current_chunk.append(sentence)
-                current_size += sentence_size
-        
-        if current_chunk:
-            chunks.append(' '.join(current_chunk))
-        
-        return chunks
+    def _collection_name(self) -> str:
+        # With the compact index, Chroma does not keep the vectors and builds no HNSW index of them
+        return METADATA_COLLECTION if self.vector_index is not None else FULL_COLLECTION
+
+    def _warm_up(self):
+        # Straight to the model, a cached query embedding would skip the forward pass
+        embedding = self.embedding_model.embeddings.embed_query("warm up")
+        if self.db._collection.count() > 0:
+            self._search_by_vectors([embedding], 1)
+        self.lexical_index.search("warm up", 1)
+
+    async def warm_up(self):
+        """Run a query through the embedding model and both indexes, so the first real query is not slow"""
+        started = time.perf_counter()
+        await asyncio.to_thread(self._warm_up)
+        logging.info(f"Warmed up in {time.perf_counter() - started:.2f}s")
 
-    async def add_document(self, filename: str, content: bytes) -> str:
+    def _chunk_spans(self, text: str) -> List[Tuple[int, int]]:
+        """Split text into (start, end) character spans with the configured chunk size and overlap"""
+        return chunk_spans(text, self.pipeline.chunk_tokens, self.pipeline.chunk_overlap)
+
+    def _chunk_text(self, text: str) -> List[str]:
+        """Split text into chunks with the configured chunk size and overlap"""
+        return [text[start:end] for start, end in self._chunk_spans(text)]
+
+    async def spool_upload(self, file) -> Path:
+        """Copy an upload to a file in the upload directory, one block at a time"""
+        fd, path = tempfile.mkstemp(dir=self.upload_dir, suffix=".upload")
         try:
-            # Check if document with this filename already exists
-            existing_docs = self.db._collection.get(
-                where={"source": filename}
+            with os.fdopen(fd, "wb") as f:
+                while block := await file.read(BLOCK_SIZE):
+                    f.write(block)
+        except Exception:
+            os.remove(path)
+            raise
+        return Path(path)
+
+    def index_upload(self, filename: str, path: Path, tags: str = "") -> str:
+        """Extract, chunk, embed and index a spooled upload; blocking, meant for worker threads"""
+        with timed("add_document"):
+            # Text is extracted and chunked as a stream, the file is never loaded whole.
+            # Skips unchanged documents and replaces the chunks of changed ones
+            doc_id = self.pipeline.index_stream(
+                filename,
+                extract_file(path, filename),
+                mtime_ns=time.time_ns(),
+                size=path.stat().st_size,
+                tags=tags
             )
-            if existing_docs['ids']:
-                logging.info(f"Document {filename} already exists, skipping")
-                return existing_docs['ids'][0]
+        logging.info(f"Successfully added document {filename} with ID {doc_id}")
+        return doc_id
 
-            text = content.decode('utf-8')
-            doc_id = str(uuid.uuid4())
-            chunks = self._chunk_text(text)
-            
-            logging.info(f"Processing document {filename} with {len(chunks)} chunks")
-            
-            documents = []
-            for chunk in chunks:
-                documents.append(
-                    Document(
-                        page_content=chunk,
-                        metadata={
-                            "source": filename,
-                            "full_document": text
-                        }
-                    )
-                )
-            
-            self.db.add_documents(documents)
-            self.db.persist()
-            
-            logging.info(f"Successfully added document {filename} with ID {doc_id}")
+    async def add_document(self, filename: str, path: Path) -> str:
+        try:
+            doc_id = await asyncio.to_thread(self.index_upload, filename, path)
+            await asyncio.to_thread(self.db.persist)
             return doc_id
             
         except Exception as e:
@@ -104,6 +173,18 @@ class DocumentService:
             logging.exception("Full traceback:")
             raise
 
+    def _resolve_doc_id(self, metadata: Dict) -> Optional[str]:
+        """Return the document id of a chunk, moving legacy inline text into the store"""
+        if "doc_id" in metadata:
+            return metadata["doc_id"]
+        if "full_document" in metadata:
+            return self.document_store.put(metadata["full_document"])
+        return None
+
+    def get_document(self, doc_id: str, start: int = 0, end: Optional[int] = None) -> Optional[Tuple[str, int]]:
+        """Load a document, or a slice of it, and its total length from the document store"""
+        return self.document_store.get_slice(doc_id, start, end)
+
     def _get_relevance_level(self, similarity: float) -> RelevanceLevel:
         """Determine relevance level based on similarity score"""
         # Using similarity score directly (higher is better)
@@ -120,42 +201,202 @@ class DocumentService:
         # Consider all levels except NOT_RELEVANT as relevant
         return relevance != RelevanceLevel.NOT_RELEVANT
 
+    def _search_by_vectors(self, embeddings: List[List[float]], k: int, search_filter: Optional[SearchFilter] = None) -> List[List[Tuple]]:
+        """Similarity search for several query embeddings in one call, scored like similarity_search_with_relevance_scores"""
+        if self.vector_index is not None:
+            return self._search_compact(embeddings, k, search_filter)
+        where = search_filter.where() if search_filter else None
+        results = self.db._collection.query(
+            query_embeddings=embeddings,
+            n_results=k,
+            # The filter is applied inside the index, not to the results
+            **({"where": where} if where else {}),
+            include=["documents", "metadatas", "distances"]
+        )
+        relevance_score = self.db._select_relevance_score_fn()
+        return [
+            [
+                (Document(page_content=text, metadata=metadata or {}), relevance_score(distance))
+                for text, metadata, distance in zip(texts, metadatas, distances)
+            ]
+            for texts, metadatas, distances in zip(results["documents"], results["metadatas"], results["distances"])
+        ]
+
+    def _search_compact(self, embeddings: List[List[float]], k: int, search_filter: Optional[SearchFilter]) -> List[List[Tuple]]:
+        """_search_by_vectors on the compact index, with the chunks' text and metadata read from Chroma by id"""
+        hits = self.vector_index.search(embeddings, k, search_filter)
+        ids = list({hit.chunk_id for query_hits in hits for hit in query_hits})
+        records = self.db._collection.get(ids=ids, include=["documents", "metadatas"]) if ids else {"ids": []}
+        chunks = {
+            chunk_id: (text, metadata)
+            for chunk_id, text, metadata in zip(records["ids"], records.get("documents") or [], records.get("metadatas") or [])
+        }
+        relevance_score = self.db._select_relevance_score_fn()
+        return [
+            [
+                (Document(page_content=chunks[hit.chunk_id][0], metadata=chunks[hit.chunk_id][1] or {}), relevance_score(hit.distance))
+                for hit in query_hits
+                if hit.chunk_id in chunks
+            ]
+            for query_hits in hits
+        ]
+
+    @staticmethod
+    def _best_per_source(hits: List[Tuple]) -> Dict[str, Tuple]:
+        """The best (document, similarity) of every source, in rank order"""
+        best = {}
+        for doc, similarity in hits:
+            best.setdefault(doc.metadata["source"], (doc, similarity))
+        return best
+
+    async def _vector_search(self, query: str, num_sources: int, search_filter: Optional[SearchFilter], timings: Optional[dict]) -> List[Tuple]:
+        """The best chunk of each of the num_sources nearest sources, as (document, similarity)"""
+        # Embedded and searched together with concurrent queries, off the event loop
+        k = num_sources * CHUNKS_PER_SOURCE
+        hits = await self.query_batcher.search_one(query, k, timings, search_filter)
+        best = self._best_per_source(hits)
+
+        passes = 1
+        while len(best) < num_sources and len(hits) == k and passes < MAX_VECTOR_PASSES:
+            # The nearest chunks all came from a few long documents, search the others
+            narrowed = (search_filter or SearchFilter())._replace(exclude_sources=tuple(best))
+            k = (num_sources - len(best)) * CHUNKS_PER_SOURCE
+            with timed("vector_search_more", timings):
+                # The query's embedding is in the embedding cache's memory tier by now
+                embedding = await asyncio.to_thread(self.embedding_model.embed_query, query)
+                hits = (await asyncio.to_thread(self._search_by_vectors, [embedding], k, narrowed))[0]
+            for source, hit in self._best_per_source(hits).items():
+                best.setdefault(source, hit)
+            passes += 1
+        return list(best.values())[:num_sources]
+
+    async def _lexical_search(self, query: str, num_sources: int, search_filter: Optional[SearchFilter], timings: Optional[dict]) -> List[LexicalHit]:
+        """The best chunk of each of the num_sources best matching sources"""
+        with timed("lexical_search", timings):
+            return await asyncio.to_thread(self.lexical_index.search, query, num_sources, search_filter, 1)
+
+    def _lexical_similarities(self, query: str, chunk_ids: List[str]) -> Dict[str, float]:
+        """Vector similarity of the query to chunks, scored like the vector search"""
+        if not chunk_ids:
+            return {}
+        # In the embedding cache's memory tier already, after the vector search
+        query_embedding = np.asarray(self.embedding_model.embed_query(query), dtype=np.float32)
+        if self.vector_index is not None:
+            embeddings = self.vector_index.vectors(chunk_ids)
+        else:
+            records = self.db._collection.get(ids=chunk_ids, include=["embeddings"])
+            embeddings = dict(zip(records["ids"], records["embeddings"]))
+        relevance_score = self.db._select_relevance_score_fn()
+        return {
+            chunk_id: relevance_score(float(np.sum((np.asarray(embedding, dtype=np.float32) - query_embedding) ** 2)))
+            for chunk_id, embedding in embeddings.items()
+        }
+
+    def _fuse(
+        self,
+        query: str,
+        vector_hits: List[Tuple],
+        lexical_hits: List[LexicalHit],
+        lexical_similarities: Optional[Dict[str, float]] = None
+    ) -> List[Tuple[str, Dict, float]]:
+        """Merge both rankings of sources with reciprocal-rank fusion into (text, metadata, similarity), best first.
+
+        A source is represented by its chunk from the ranking it ranks highest
+        in. Sources only found by the lexical search get their chunk's vector
+        similarity from lexical_similarities. Without it, as on the lexical-only
+        path, they get the fraction of the query's words other than stopwords
+        their chunk contains.
+        """
+        lexical_similarities = lexical_similarities or {}
+        vector_sources = [doc.metadata["source"] for doc, _ in vector_hits]
+        lexical_sources = [hit.metadata["source"] for hit in lexical_hits]
+        vector_by_source = dict(zip(vector_sources, vector_hits))
+        lexical_by_source = dict(zip(lexical_sources, lexical_hits))
+        vector_rank = {source: rank for rank, source in enumerate(vector_sources)}
+        lexical_rank = {source: rank for rank, source in enumerate(lexical_sources)}
+
+        scores = reciprocal_rank_fusion([vector_sources, lexical_sources])
+        fused = []
+        for source in sorted(scores, key=scores.get, reverse=True):
+            vector_hit, lexical_hit = vector_by_source.get(source), lexical_by_source.get(source)
+            if vector_hit is not None and (lexical_hit is None or vector_rank[source] <= lexical_rank[source]):
+                doc, similarity = vector_hit
+                fused.append((doc.page_content, doc.metadata, similarity))
+            else:
+                if vector_hit is not None:
+                    similarity = vector_hit[1]
+                elif lexical_hit.chunk_id in lexical_similarities:
+                    similarity = lexical_similarities[lexical_hit.chunk_id]
+                else:
+                    similarity = term_coverage(query, lexical_hit.text)
+                fused.append((lexical_hit.text, lexical_hit.metadata, similarity))
+        return fused
+
+    @staticmethod
+    def _search_filter(filters: Optional[QueryFilters]) -> Optional[SearchFilter]:
+        if filters is None:
+            return None
+        search_filter = SearchFilter(
+            sources=tuple(filters.sources or ()),
+            tags=normalize_tags(filters.tags or ()),
+            modified_after=int(filters.modified_after.timestamp()) if filters.modified_after else None,
+            modified_before=int(filters.modified_before.timestamp()) if filters.modified_before else None
+        )
+        return search_filter if search_filter != SearchFilter() else None
+
     async def query_documents(
         self, 
         query: str, 
         num_results: int = 3, 
         min_relevance: Optional[RelevanceLevel] = None,
-        min_similarity: Optional[float] = None
+        min_similarity: Optional[float] = None,
+        include_full_document: bool = False,
+        timings: Optional[dict] = None,
+        include_embedding: bool = False,
+        filters: Optional[QueryFilters] = None
     ) -> QueryResponse:
         try:
             logging.info(f"Querying documents with: '{query}'")
+            # Read before searching, so a concurrent change shows up as a newer version
+            index_version = self.manifest.index_version()
             
             doc_count = self.db._collection.count()
             logging.info(f"Total documents in collection: {doc_count}")
             
             if doc_count == 0:
                 logging.warning("No documents in collection")
-                return QueryResponse(results=[], has_results=False)
-            
-            # Search in ChromaDB
-            logging.info(f"Searching for top {num_results * 2} results")
-            results = self.db.similarity_search_with_relevance_scores(
-                query,
-                k=num_results * 2  # Get more results to filter
-            )
+                return QueryResponse(results=[], has_results=False, index_version=index_version)
             
-            logging.info(f"Found {len(results)} initial results")
+            # Filters are applied inside both indexes, and both return one chunk per source
+            search_filter = self._search_filter(filters)
+            logging.info(f"Searching for the top {num_results} sources")
+            lexical_similarities = None
+            if is_exact_query(query):
+                # Identifiers and quoted phrases: the lexical index alone answers, skipping the embedding
+                lexical_hits = await self._lexical_search(query, num_results, search_filter, timings)
+                vector_hits = [] if lexical_hits else await self._vector_search(query, num_results, search_filter, timings)
+            else:
+                vector_hits, lexical_hits = await asyncio.gather(
+                    self._vector_search(query, num_results, search_filter, timings),
+                    self._lexical_search(query, num_results, search_filter, timings)
+                )
+                # Puts sources only the lexical search found on the same scale as the others
+                vector_sources = {doc.metadata["source"] for doc, _ in vector_hits}
+                lexical_only = [hit.chunk_id for hit in lexical_hits if hit.metadata["source"] not in vector_sources]
+                with timed("lexical_similarity", timings):
+                    lexical_similarities = await asyncio.to_thread(self._lexical_similarities, query, lexical_only)
             
-            # Use dict to deduplicate by source while keeping highest similarity
-            source_results = {}
-            for doc, similarity in results:
-                source = doc.metadata["source"]
-                if source not in source_results or similarity > source_results[source][1]:
-                    source_results[source] = (doc, similarity)
+            logging.info(f"Found {len(vector_hits)} vector and {len(lexical_hits)} lexical results")
+
+            query_embedding = None
+            if include_embedding:
+                # Usually in the embedding cache's memory tier already, after the vector search
+                query_embedding = await asyncio.to_thread(self.embedding_model.embed_query, query)
             
-            # Convert back to list and format results
+            format_started = time.perf_counter()
+            # Format results, one per source in fused rank order
             formatted_results = []
-            for doc, similarity in source_results.values():
+            for text, metadata, similarity in self._fuse(query, vector_hits, lexical_hits, lexical_similarities):
                 relevance = self._get_relevance_level(similarity)
                 
                 # Apply filters
@@ -167,11 +408,21 @@ class DocumentService:
                     logging.info(f"Skipping result due to low relevance: {relevance} < {min_relevance}")
                     continue
                 
+                doc_id = self._resolve_doc_id(metadata)
+                full_document = None
+                if include_full_document and doc_id:
+                    full_document = self.document_store.get(doc_id)
+
                 result = QueryResult(
-                    text=doc.page_content,
+                    text=text,
                     metadata=DocumentMetadata(
-                        source=doc.metadata["source"],
-                        full_document=doc.metadata["full_document"],
+                        source=metadata["source"],
+                        doc_id=doc_id,
+                        start=metadata.get("start"),
+                        end=metadata.get("end"),
+                        tags=list(tags_of(metadata)),
+                        modified=metadata.get("modified"),
+                        full_document=full_document,
                         similarity=float(similarity),
                         relevance=relevance
                     ),
@@ -179,16 +430,19 @@ class DocumentService:
                 )
                 formatted_results.append(result)
             
-            # Sort by similarity
-            formatted_results.sort(key=lambda x: x.metadata.similarity, reverse=True)
-            
             # Limit to requested number
             formatted_results = formatted_results[:num_results]
             logging.info(f"Returning {len(formatted_results)} final results")
+            format_seconds = time.perf_counter() - format_started
+            SPAN_SECONDS.labels(span="format_results").observe(format_seconds)
+            if timings is not None:
+                timings["format_results"] = round(format_seconds, 4)
             
             return QueryResponse(
                 results=formatted_results,
-                has_results=len(formatted_results) > 0
+                has_results=len(formatted_results) > 0,
+                index_version=index_version,
+                query_embedding=query_embedding
             )
             
         except Exception as e:
@@ -0,0 +1,184 @@
+import codecs
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+from collections import Counter
+from pathlib import Path
+from typing import Callable, Iterable, Iterator, Optional, Tuple
+
+_DOC_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+# UTF-8 continuation bytes, every other byte starts a character
+_CONTINUATION_BYTES = bytes(range(0x80, 0xC0))
+
+
+class DocumentStore:
+    """Content-addressed store for the full text of source documents.
+
+    Documents are kept once on disk, keyed by the SHA-256 of their text. Chunks in
+    the vector store only carry this id and their offsets, and the full text is
+    loaded lazily when it is actually needed.
+
+    Documents that are being indexed are pinned: collect never deletes them,
+    even while no chunk references them yet.
+    """
+
+    def __init__(self, root: str = "data/documents"):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        # Guards the pins together with storing and collecting documents
+        self._lock = threading.Lock()
+        self._pins: Counter = Counter()
+
+    @staticmethod
+    def compute_id(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_valid_id(doc_id: str) -> bool:
+        return bool(_DOC_ID_PATTERN.match(doc_id))
+
+    def _path(self, doc_id: str) -> Path:
+        if not self.is_valid_id(doc_id):
+            raise ValueError(f"Invalid document id: {doc_id}")
+        return self.root / doc_id[:2] / f"{doc_id}.txt"
+
+    def exists(self, doc_id: str) -> bool:
+        return self._path(doc_id).exists()
+
+    def put(self, text: str) -> str:
+        """Store text if it is not stored yet and return its document id"""
+        doc_id = self.compute_id(text)
+        path = self._path(doc_id)
+        if path.exists():
+            return doc_id
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Write to a temporary file first so readers never see partial content
+        fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(text)
+            os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        logging.info(f"Stored document {doc_id} ({len(text)} characters)")
+        return doc_id
+
+    def put_stream(self, pieces: Iterable[str], pin: bool = False) -> str:
+        """Store text arriving in pieces, hashing it on the way, and return its document id.
+
+        With pin, the document is also pinned until unpin is called.
+        """
+        self.root.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        length = 0
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                for piece in pieces:
+                    digest.update(piece.encode("utf-8"))
+                    length += len(piece)
+                    f.write(piece)
+            doc_id = digest.hexdigest()
+            path = self._path(doc_id)
+            # Together with pinning, so a concurrent collect cannot delete it in between
+            with self._lock:
+                if pin:
+                    self._pins[doc_id] += 1
+                if path.exists():
+                    os.remove(tmp_path)
+                    return doc_id
+                path.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_path, path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        logging.info(f"Stored document {doc_id} ({length} characters)")
+        return doc_id
+
+    def iter_text(self, doc_id: str, block_size: int = 1024 * 1024) -> Iterator[str]:
+        """Read a stored document in blocks of block_size characters"""
+        with open(self._path(doc_id), encoding="utf-8", newline="") as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    return
+                yield block
+
+    def get(self, doc_id: str) -> Optional[str]:
+        path = self._path(doc_id)
+        if not path.exists():
+            return None
+        # Keep line endings as stored, chunk offsets count every character
+        with open(path, encoding="utf-8", newline="") as f:
+            return f.read()
+
+    def get_slice(self, doc_id: str, start: int = 0, end: Optional[int] = None, block_size: int = 1024 * 1024) -> Optional[Tuple[str, int]]:
+        """Return the characters between start and end of a stored document, and its length in characters.
+
+        Only the blocks holding the window are decoded; the rest of the file is
+        read as bytes and its characters are counted by their UTF-8 lead bytes.
+        """
+        path = self._path(doc_id)
+        if not path.exists():
+            return None
+
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        pieces = []
+        # Offset of the first decoded character, None until the window is reached
+        window_start = None
+        window_done = False
+        length = 0
+        with open(path, "rb") as f:
+            while True:
+                block = f.read(block_size)
+                if not block:
+                    break
+                block_length = len(block.translate(None, _CONTINUATION_BYTES))
+                if window_start is None and length + block_length > start:
+                    window_start = length
+                    # Bytes of a character that started in the previous block
+                    block = block.lstrip(_CONTINUATION_BYTES)
+                if window_start is not None and not window_done:
+                    pieces.append(decoder.decode(block))
+                length += block_length
+                # Once the character after the window has started, the window is complete
+                if window_start is not None and end is not None and length > end:
+                    window_done = True
+
+        if window_start is None or (end is not None and end <= start):
+            return "", length
+        text = "".join(pieces)
+        return text[start - window_start:None if end is None else end - window_start], length
+
+    def pin(self, doc_id: str):
+        """Keep a document from being collected until it is unpinned as often as it was pinned"""
+        with self._lock:
+            self._pins[doc_id] += 1
+
+    def unpin(self, doc_id: str):
+        with self._lock:
+            self._pins[doc_id] -= 1
+            if self._pins[doc_id] <= 0:
+                del self._pins[doc_id]
+
+    def collect(self, doc_id: str, is_referenced: Callable[[str], bool]) -> bool:
+        """Delete a document unless it is pinned or is_referenced(doc_id), returning whether it was deleted"""
+        with self._lock:
+            if self._pins[doc_id] > 0 or is_referenced(doc_id):
+                return False
+            self.delete(doc_id)
+            return True
+
+    def delete(self, doc_id: str):
+        path = self._path(doc_id)
+        if path.exists():
+            path.unlink()
@@ -0,0 +1,151 @@
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# Written by models/download_model.py
+EMBEDDING_MODEL_DIR = "models/embeddings"
+ONNX_MODEL_DIR = "models/embeddings-onnx"
+# Export settings stored next to the ONNX models
+ONNX_CONFIG_FILE = "embedding_config.json"
+# ONNX model file of each backend
+ONNX_MODEL_FILES = {"onnx": "model.onnx", "onnx-int8": "model-int8.onnx"}
+EMBEDDING_BACKENDS = ("torch", *ONNX_MODEL_FILES)
+# all-mpnet-base-v2 truncates inputs to this many tokens
+DEFAULT_MAX_SEQ_LENGTH = 384
+DEFAULT_BATCH_SIZE = 32
+MODEL_NAME = "all-mpnet-base-v2"
+
+
+class OnnxEmbeddings(Embeddings):
+    """Sentence embeddings from an ONNX export of the model, run by ONNX Runtime.
+
+    Does the same as the sentence-transformers model: tokenize, run the
+    transformer, mean-pool the token vectors over the attention mask and
+    normalize. Texts are embedded in batches of similar length, so little time
+    goes to padding. Importing neither torch nor transformers keeps startup fast.
+    """
+
+    def __init__(
+        self,
+        model_dir: str = ONNX_MODEL_DIR,
+        model_file: str = "model.onnx",
+        threads: int = 0,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_seq_length: int = DEFAULT_MAX_SEQ_LENGTH
+    ):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        model_dir = Path(model_dir)
+        config = json.loads((model_dir / ONNX_CONFIG_FILE).read_text())
+        self.batch_size = batch_size
+        self.max_seq_length = min(max_seq_length, config["max_seq_length"])
+        self.pad_token_id = config["pad_token_id"]
+
+        self.tokenizer = Tokenizer.from_file(str(model_dir / "tokenizer.json"))
+        self.tokenizer.no_padding()
+        self.tokenizer.enable_truncation(self.max_seq_length)
+
+        options = onnxruntime.SessionOptions()
+        # 0 lets ONNX Runtime use one thread per physical core
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(
+            str(model_dir / model_file), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _embed_batch(self, texts: List[str]) -> np.ndarray:
+        encodings = self.tokenizer.encode_batch(texts)
+        length = max(len(encoding.ids) for encoding in encodings)
+        input_ids = np.full((len(texts), length), self.pad_token_id, dtype=np.int64)
+        attention_mask = np.zeros((len(texts), length), dtype=np.int64)
+        for row, encoding in enumerate(encodings):
+            input_ids[row, :len(encoding.ids)] = encoding.ids
+            attention_mask[row, :len(encoding.ids)] = 1
+
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if "token_type_ids" in self.input_names:
+            inputs["token_type_ids"] = np.zeros_like(input_ids)
+        token_vectors = self.session.run(None, inputs)[0]
+
+        mask = attention_mask[:, :, None].astype(np.float32)
+        pooled = (token_vectors * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        return pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        # Longest first, so every batch holds texts of about the same length
+        order = sorted(range(len(texts)), key=lambda index: len(texts[index]), reverse=True)
+        vectors: List[List[float]] = [[] for _ in texts]
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            for index, vector in zip(batch, self._embed_batch([texts[index] for index in batch])):
+                vectors[index] = vector.tolist()
+        return vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([text])[0]
+
+
+def _torch_embeddings(threads: int, batch_size: int, max_seq_length: int) -> Embeddings:
+    # Imported here, torch takes seconds to import and is not needed for ONNX
+    from langchain_community.embeddings import HuggingFaceEmbeddings
+
+    if threads:
+        import torch
+        torch.set_num_threads(threads)
+    embeddings = HuggingFaceEmbeddings(
+        model_name=EMBEDDING_MODEL_DIR,  # Local path to model
+        model_kwargs={'device': 'cpu'},
+        encode_kwargs={'normalize_embeddings': True, 'batch_size': batch_size}
+    )
+    embeddings.client.max_seq_length = max_seq_length
+    return embeddings
+
+
+def embedding_model_id(backend: str, max_seq_length: int = DEFAULT_MAX_SEQ_LENGTH) -> str:
+    """Identifies the vectors of a backend in the embedding cache"""
+    model_id = f"{MODEL_NAME}/normalized" if backend == "torch" else f"{MODEL_NAME}/{backend}/normalized"
+    if max_seq_length != DEFAULT_MAX_SEQ_LENGTH:
+        model_id += f"/{max_seq_length}"
+    return model_id
+
+
+def create_embeddings(
+    backend: Optional[str] = None,
+    threads: Optional[int] = None,
+    batch_size: Optional[int] = None,
+    max_seq_length: Optional[int] = None
+) -> Tuple[Embeddings, str]:
+    """The configured embedding model and its model id, settings default to the EMBEDDING_* variables"""
+    backend = (backend or os.getenv("EMBEDDING_BACKEND", "torch")).lower()
+    threads = threads if threads is not None else int(os.getenv("EMBEDDING_THREADS", 0))
+    batch_size = batch_size or int(os.getenv("EMBEDDING_BATCH_SIZE", DEFAULT_BATCH_SIZE))
+    max_seq_length = max_seq_length or int(os.getenv("EMBEDDING_MAX_SEQ_LENGTH", DEFAULT_MAX_SEQ_LENGTH))
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend {backend}, use one of {', '.join(EMBEDDING_BACKENDS)}")
+
+    if backend == "torch":
+        embeddings = _torch_embeddings(threads, batch_size, max_seq_length)
+    else:
+        model_path = Path(ONNX_MODEL_DIR) / ONNX_MODEL_FILES[backend]
+        if not model_path.exists():
+            raise FileNotFoundError(
+                f"No {backend} embedding model at {model_path}. "
+                f"Export it with: python models/download_model.py --export {backend}"
+            )
+        embeddings = OnnxEmbeddings(
+            ONNX_MODEL_DIR,
+            ONNX_MODEL_FILES[backend],
+            threads=threads,
+            batch_size=batch_size,
+            max_seq_length=max_seq_length
+        )
+    logging.info(f"Embedding with the {backend} backend, batches of {batch_size}, up to {max_seq_length} tokens")
+    return embeddings, embedding_model_id(backend, max_seq_length)
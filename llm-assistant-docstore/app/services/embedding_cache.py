@@ -0,0 +1,170 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+
+class CachedEmbeddings(Embeddings):
+    """Embedding function with a persistent cache in front of the model.
+
+    Vectors are keyed by the model id, the kind of input (query or document) and
+    a hash of the text. Lookups go through an in-memory LRU tier first and an
+    SQLite tier on disk second; only texts missing from both are embedded, so
+    repeated queries and unchanged chunks skip the model's forward pass. The
+    disk tier holds at most disk_size vectors, the least recently used are pruned.
+    """
+
+    def __init__(
+        self,
+        embeddings: Embeddings,
+        model_id: str,
+        path: str = "data/embedding_cache.sqlite3",
+        memory_size: int = 20000,
+        symmetric: bool = False,
+        disk_size: int = 500000
+    ):
+        self.embeddings = embeddings
+        self.model_id = model_id
+        # Queries and documents go through the same encoder, so queries can be embedded in batches
+        self.symmetric = symmetric
+        self.memory_size = memory_size
+        self.disk_size = disk_size
+        self._memory: "OrderedDict[bytes, np.ndarray]" = OrderedDict()
+        self._lock = threading.Lock()
+
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(embeddings)")]
+            if "used" not in columns:
+                # Caches written before pruning was added
+                self._conn.execute("ALTER TABLE embeddings ADD COLUMN used INTEGER NOT NULL DEFAULT 0")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_used ON embeddings (used)")
+        self._disk_entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.disk_evictions = 0
+
+    def _key(self, kind: str, text: str) -> bytes:
+        return hashlib.sha256(f"{self.model_id}\0{kind}\0{text}".encode("utf-8")).digest()
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_size:
+            self._memory.popitem(last=False)
+
+    def _lookup(self, keys: List[bytes]) -> Dict[bytes, np.ndarray]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                vector = self._memory.get(key)
+                if vector is not None:
+                    self._memory.move_to_end(key)
+                    found[key] = vector
+            self.memory_hits += len(found)
+
+            missing = [key for key in keys if key not in found]
+            # Stay well below SQLite's limit on bound parameters
+            for i in range(0, len(missing), 500):
+                batch = missing[i:i + 500]
+                rows = self._conn.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})",
+                    batch
+                ).fetchall()
+                for key, blob in rows:
+                    vector = np.frombuffer(blob, dtype=np.float32)
+                    found[key] = vector
+                    self._remember(key, vector)
+                self.disk_hits += len(rows)
+                if rows:
+                    with self._conn:
+                        self._conn.execute(
+                            f"UPDATE embeddings SET used = ? WHERE key IN ({','.join('?' * len(rows))})",
+                            [int(time.time()), *(key for key, _ in rows)]
+                        )
+        return found
+
+    def _store(self, vectors: Dict[bytes, np.ndarray]):
+        with self._lock:
+            for key, vector in vectors.items():
+                self._remember(key, vector)
+            used = int(time.time())
+            with self._conn:
+                changes = self._conn.total_changes
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vector, used) VALUES (?, ?, ?)",
+                    [(key, vector.tobytes(), used) for key, vector in vectors.items()]
+                )
+                self._disk_entries += self._conn.total_changes - changes
+                if self._disk_entries > self.disk_size:
+                    self._prune()
+
+    def _prune(self):
+        """Delete the least recently used vectors on disk, down to 90% of disk_size so pruning is rare"""
+        excess = self._disk_entries - int(self.disk_size * 0.9)
+        self._conn.execute(
+            "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used, rowid LIMIT ?)",
+            (excess,)
+        )
+        self._disk_entries -= excess
+        self.disk_evictions += excess
+
+    def _embed(self, kind: str, texts: List[str]) -> List[List[float]]:
+        keys = [self._key(kind, text) for text in texts]
+        found = self._lookup(list(dict.fromkeys(keys)))
+
+        # Embed each distinct missing text once
+        missing: Dict[bytes, str] = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+
+        if missing:
+            with self._lock:
+                self.misses += len(missing)
+            if kind == "query" and not self.symmetric:
+                computed = [self.embeddings.embed_query(text) for text in missing.values()]
+            else:
+                computed = self.embeddings.embed_documents(list(missing.values()))
+            new_vectors = {
+                key: np.asarray(vector, dtype=np.float32)
+                for key, vector in zip(missing.keys(), computed)
+            }
+            self._store(new_vectors)
+            found.update(new_vectors)
+
+        return [found[key].tolist() for key in keys]
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._embed("document", texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed("query", [text])[0]
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embed several queries, in one forward pass when the model is symmetric"""
+        return self._embed("query", texts)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "model_id": self.model_id,
+                "memory_entries": len(self._memory),
+                "disk_entries": self._disk_entries,
+                "disk_evictions": self.disk_evictions,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
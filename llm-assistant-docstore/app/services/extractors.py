@@ -0,0 +1,144 @@
+import codecs
+import re
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import BinaryIO, Dict, Iterator, List, Optional, Type
+
+# Bytes read from a file at a time
+BLOCK_SIZE = 1024 * 1024
+
+
+class Extractor:
+    """Turns a file into a stream of text pieces without loading it whole"""
+
+    def extract(self, file: BinaryIO) -> Iterator[str]:
+        raise NotImplementedError
+
+
+class TextExtractor(Extractor):
+    """UTF-8 text, decoded block by block. Also used for Markdown, whose
+    headings and code fences are understood by the chunker itself."""
+
+    def extract(self, file: BinaryIO) -> Iterator[str]:
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        while True:
+            block = file.read(BLOCK_SIZE)
+            if not block:
+                break
+            text = decoder.decode(block)
+            if text:
+                yield text
+        text = decoder.decode(b"", final=True)
+        if text:
+            yield text
+
+
+class _HtmlText(HTMLParser):
+    """Collects the readable text of an HTML document, with Markdown-style
+    headings and code fences so the chunker can follow its structure"""
+
+    BLOCK_TAGS = {
+        "address", "article", "aside", "blockquote", "dd", "div", "dl", "dt", "figcaption", "footer",
+        "form", "header", "hr", "main", "nav", "ol", "p", "section", "table", "tr", "ul",
+    }
+    SKIPPED_TAGS = {"script", "style", "noscript", "template", "head"}
+    HEADINGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+    WHITESPACE = re.compile(r"\s+")
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces: List[str] = []
+        self._skipping = 0
+        self._pre = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping += 1
+        elif tag in self.HEADINGS:
+            self.pieces.append("\n\n" + "#" * self.HEADINGS[tag] + " ")
+        elif tag == "pre":
+            self._pre += 1
+            self.pieces.append("\n\n```\n")
+        elif tag in self.BLOCK_TAGS:
+            self.pieces.append("\n\n")
+        elif tag in ("br", "li"):
+            self.pieces.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIPPED_TAGS:
+            self._skipping = max(0, self._skipping - 1)
+        elif tag == "pre":
+            self._pre = max(0, self._pre - 1)
+            self.pieces.append("\n```\n\n")
+        elif tag in self.HEADINGS or tag in self.BLOCK_TAGS:
+            self.pieces.append("\n\n")
+
+    def handle_data(self, data):
+        if self._skipping:
+            return
+        self.pieces.append(data if self._pre else self.WHITESPACE.sub(" ", data))
+
+    def take(self) -> str:
+        text, self.pieces = "".join(self.pieces), []
+        return text
+
+
+class HtmlExtractor(Extractor):
+    def extract(self, file: BinaryIO) -> Iterator[str]:
+        parser = _HtmlText()
+        for text in TextExtractor().extract(file):
+            parser.feed(text)
+            text = parser.take()
+            if text:
+                yield text
+        parser.close()
+        text = parser.take()
+        if text:
+            yield text
+
+
+class PdfExtractor(Extractor):
+    """Text of a PDF, page by page. Needs the optional pypdf package."""
+
+    def extract(self, file: BinaryIO) -> Iterator[str]:
+        try:
+            from pypdf import PdfReader
+        except ImportError:
+            raise ValueError("PDF support needs the pypdf package (pip install pypdf)")
+
+        # Pages are parsed one at a time, only the cross-reference table is kept
+        for number, page in enumerate(PdfReader(file).pages):
+            text = page.extract_text() or ""
+            if text.strip():
+                yield text if number == 0 else "\n\n" + text
+
+
+EXTRACTORS: Dict[str, Type[Extractor]] = {
+    ".txt": TextExtractor,
+    ".log": TextExtractor,
+    ".md": TextExtractor,
+    ".markdown": TextExtractor,
+    ".html": HtmlExtractor,
+    ".htm": HtmlExtractor,
+    ".pdf": PdfExtractor,
+}
+
+
+def register_extractor(extension: str, extractor: Type[Extractor]):
+    """Handle files with the given extension (such as ".rst") with extractor"""
+    EXTRACTORS[extension.lower()] = extractor
+
+
+def supported_extensions() -> tuple:
+    return tuple(EXTRACTORS)
+
+
+def get_extractor(filename: str) -> Extractor:
+    """Extractor for a file name, falling back to plain text for unknown extensions"""
+    return EXTRACTORS.get(Path(filename).suffix.lower(), TextExtractor)()
+
+
+def extract_file(path: Path, filename: Optional[str] = None) -> Iterator[str]:
+    """Stream the text of the file at path, choosing the extractor by filename"""
+    with open(path, "rb") as file:
+        yield from get_extractor(filename or path.name).extract(file)
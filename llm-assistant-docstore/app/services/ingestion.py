@@ -0,0 +1,520 @@
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from app.services.chunking import Chunker, DEFAULT_MAX_TOKENS, DEFAULT_OVERLAP_TOKENS
+from app.services.document_store import DocumentStore
+from app.services.extractors import extract_file, supported_extensions
+from app.services.lexical_index import LexicalIndex
+from app.services.manifest import Manifest, ManifestEntry, UPLOAD_ORIGIN
+from app.services.search_filter import normalize_tags, split_tags, tag_metadata
+from app.services.vector_index import CompactVectorIndex, PLACEHOLDER_EMBEDDING
+
+# A chunk ready to embed: (chunk id, chunk text, chunk metadata)
+Chunk = Tuple[str, str, Dict]
+
+
+def iter_chunks(
+    source: str,
+    doc_id: str,
+    pieces: Iterable[str],
+    max_tokens: int = DEFAULT_MAX_TOKENS,
+    overlap_tokens: int = DEFAULT_OVERLAP_TOKENS,
+    document_metadata: Optional[Dict] = None
+) -> Iterator[List[Chunk]]:
+    """Chunk a document arriving in pieces into (id, text, metadata) triples with deterministic ids.
+
+    document_metadata, such as tags, is added to the metadata of every chunk.
+    """
+    chunker = Chunker(max_tokens, overlap_tokens)
+    index = 0
+
+    def build(spans) -> List[Chunk]:
+        nonlocal index
+        chunks = []
+        for start, end in spans:
+            metadata = {**(document_metadata or {}), "source": source, "doc_id": doc_id, "start": start, "end": end}
+            chunks.append((f"{doc_id}-{index}", chunker.text(start, end), metadata))
+            index += 1
+        return chunks
+
+    for piece in pieces:
+        chunks = build(chunker.feed(piece))
+        if chunks:
+            yield chunks
+    chunks = build(chunker.close())
+    if chunks:
+        yield chunks
+
+
+def document_metadata(entry: ManifestEntry) -> Dict:
+    """Metadata shared by all chunks of a document, used by search filters"""
+    # Upload time for uploads, file modification time otherwise, in seconds
+    modified = entry.mtime_ns // 1_000_000_000 if entry.mtime_ns else int(time.time())
+    return {"modified": modified, **tag_metadata(split_tags(entry.tags))}
+
+
+def directory_tags(path: Path, documents_dir: str) -> str:
+    """Tags of a file from the folders it is in below the documents directory"""
+    return ",".join(normalize_tags(path.parent.relative_to(documents_dir).parts))
+
+
+def iter_document_files(documents_dir: str, extensions: Optional[Tuple[str, ...]] = None) -> Iterator[Path]:
+    """Walk a directory lazily, yielding files with one of the given extensions (default: all extractable).
+
+    Extensions match in any case, the way extract_file picks an extractor.
+    """
+    extensions = {extension.lower() for extension in extensions or supported_extensions()}
+    for root, _, filenames in os.walk(documents_dir):
+        for filename in filenames:
+            path = Path(root) / filename
+            if path.suffix.lower() in extensions:
+                yield path
+
+
+class IngestionStats:
+    def __init__(self):
+        self.started_at = time.monotonic()
+        self.documents = 0
+        self.updated = 0
+        self.chunks = 0
+        self.unchanged = 0
+        self.removed = 0
+        self.failed = 0
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started_at
+
+    def summary(self) -> str:
+        elapsed = max(self.elapsed, 1e-9)
+        return (
+            f"{self.documents} documents indexed ({self.updated} changed), {self.chunks} chunks, "
+            f"{self.unchanged} unchanged, {self.removed} removed, {self.failed} failed in {elapsed:.1f}s "
+            f"({self.documents / elapsed:.1f} documents/s, {self.chunks / elapsed:.1f} chunks/s)"
+        )
+
+
+class _BatchWriter:
+    """Embeds chunks in fixed-size batches and upserts them in bounded batches.
+
+    Manifest entries are only written once all chunks of their document have
+    been upserted, so an interrupted run never marks a document as indexed.
+    """
+
+    def __init__(self, pipeline: "IngestionPipeline", stats: IngestionStats):
+        self.pipeline = pipeline
+        self.stats = stats
+        self.pending: List[Chunk] = []
+        self.upserts: List[Chunk] = []
+        self.entries: Deque[Tuple[int, ManifestEntry]] = deque()
+        self.enqueued = 0
+        self.flushed = 0
+
+    def add(self, chunks: List[Chunk], entry: Optional[ManifestEntry] = None):
+        """Queue chunks of a document; pass the entry with (or after) its last chunks"""
+        self.pending.extend(chunks)
+        self.enqueued += len(chunks)
+        if entry is not None:
+            self.entries.append((self.enqueued, entry))
+
+        batch_size = self.pipeline.embed_batch_size
+        while len(self.pending) >= batch_size:
+            self._embed(self.pending[:batch_size])
+            del self.pending[:batch_size]
+
+    def finish(self):
+        if self.pending:
+            self._embed(self.pending)
+            self.pending = []
+        self._flush()
+
+    def _embed(self, chunks: List[Chunk]):
+        texts = [text for _, text, _ in chunks]
+        embeddings = self.pipeline.embedding_model.embed_documents(texts)
+        self.upserts.extend(
+            (chunk_id, embedding, metadata, text)
+            for (chunk_id, text, metadata), embedding in zip(chunks, embeddings)
+        )
+        self.stats.chunks += len(chunks)
+
+        if len(self.upserts) >= self.pipeline.upsert_batch_size:
+            self._flush()
+
+    def _flush(self):
+        if self.upserts:
+            self.pipeline.db._collection.upsert(
+                ids=[row[0] for row in self.upserts],
+                # With the compact vector index, the vector store does not keep the vectors
+                embeddings=[
+                    row[1] if self.pipeline.vector_index is None else PLACEHOLDER_EMBEDDING for row in self.upserts
+                ],
+                metadatas=[row[2] for row in self.upserts],
+                documents=[row[3] for row in self.upserts],
+            )
+            if self.pipeline.lexical_index is not None:
+                self.pipeline.lexical_index.add((row[0], row[3], row[2]) for row in self.upserts)
+            if self.pipeline.vector_index is not None:
+                self.pipeline.vector_index.add((row[0], row[1], row[2]) for row in self.upserts)
+            self.flushed += len(self.upserts)
+            self.upserts = []
+            self.pipeline.manifest.bump_index_version()
+
+        done = []
+        while self.entries and self.entries[0][0] <= self.flushed:
+            done.append(self.entries.popleft()[1])
+        if done:
+            self.pipeline.manifest.put_many(done)
+
+
+class IngestionPipeline:
+    """Streaming, incremental ingestion into the vector store.
+
+    Files are read, converted to text and hashed into the document store by
+    a pool of reader threads, streaming, so no file is ever held in memory
+    whole. The caller's thread then reads the stored text back in blocks,
+    chunks it and embeds chunks in fixed-size batches and upserts them in
+    bounded batches. Memory stays flat regardless of file and corpus size.
+
+    The manifest records the content hash and file stats of every source:
+    unchanged files are skipped without being read, changed ones are deleted
+    and re-embedded, and files that disappeared are removed from the index.
+    The lexical index and the compact vector index, when given, are updated
+    together with the vector store. With the compact vector index, the vector
+    store only keeps the chunks' text and metadata.
+    When the chunk size or overlap changes, every document is chunked again.
+    """
+
+    def __init__(
+        self,
+        db,
+        embedding_model,
+        document_store: DocumentStore,
+        manifest: Manifest,
+        embed_batch_size: int = 64,
+        upsert_batch_size: int = 512,
+        reader_threads: int = 4,
+        progress_interval: float = 5.0,
+        lexical_index: Optional[LexicalIndex] = None,
+        chunk_tokens: int = DEFAULT_MAX_TOKENS,
+        chunk_overlap: int = DEFAULT_OVERLAP_TOKENS,
+        vector_index: Optional[CompactVectorIndex] = None
+    ):
+        self.db = db
+        self.embedding_model = embedding_model
+        self.document_store = document_store
+        self.manifest = manifest
+        self.embed_batch_size = embed_batch_size
+        self.upsert_batch_size = upsert_batch_size
+        self.reader_threads = reader_threads
+        # Files read ahead of the embedder; bounds memory held by pending reads
+        self.max_in_flight = reader_threads * 4
+        self.progress_interval = progress_interval
+        self.lexical_index = lexical_index
+        self.vector_index = vector_index
+        self.chunk_tokens = chunk_tokens
+        self.chunk_overlap = chunk_overlap
+        # Recorded in the manifest to tell whether the index was chunked the same way.
+        # The last part is the version of the chunk metadata, which filters depend on
+        self.chunking = f"structured:{chunk_tokens}:{chunk_overlap}:2"
+
+    def indexed_sources(self, page_size: int = 10000) -> Dict[str, Optional[str]]:
+        """Map every source in the collection to its document id, fetched in one pass"""
+        sources = {}
+        offset = 0
+        while True:
+            page = self.db._collection.get(include=["metadatas"], limit=page_size, offset=offset)
+            for metadata in page["metadatas"]:
+                if metadata and "source" in metadata:
+                    sources[metadata["source"]] = metadata.get("doc_id")
+            if len(page["ids"]) < page_size:
+                return sources
+            offset += page_size
+
+    def ensure_lexical_index(self, page_size: int = 10000):
+        """Build the lexical index from the vector store if it is empty, e.g. after an upgrade"""
+        if self.lexical_index is None or self.lexical_index.count() or not self.db._collection.count():
+            return
+        logging.info("Building the lexical index from the vector store")
+        offset = 0
+        while True:
+            page = self.db._collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            self.lexical_index.add(
+                (chunk_id, text, metadata)
+                for chunk_id, text, metadata in zip(page["ids"], page["documents"], page["metadatas"])
+                if metadata and "source" in metadata
+            )
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+        logging.info(f"Lexical index built with {self.lexical_index.count()} chunks")
+
+    def ensure_vector_index(self, full_collection=None, page_size: int = 10000):
+        """Rebuild the compact vector index when it and the vector store hold different chunks.
+
+        The vector store then only holds text and metadata, so the chunks are
+        embedded again, mostly from the embedding cache. When the chroma
+        backend's collection, full_collection, has chunks, e.g. on the first
+        start with the compact backend, its chunks and vectors replace both
+        instead and it is deleted.
+        """
+        if self.vector_index is None:
+            return
+        collection = self.db._collection
+        moving = full_collection is not None and full_collection.count() > 0
+        if not moving and self.vector_index.count() == collection.count():
+            return
+        source = full_collection if moving else collection
+        logging.info(f"Building the vector index from the vector store ({source.count()} chunks)")
+        self.vector_index.clear()
+        if moving:
+            stale = collection.get(include=[])["ids"]
+            if stale:
+                collection.delete(ids=stale)
+        offset = 0
+        while True:
+            page = source.get(include=["documents", "metadatas", *(["embeddings"] if moving else [])], limit=page_size, offset=offset)
+            vectors = page["embeddings"] if moving else [None] * len(page["ids"])
+            rows = [
+                (chunk_id, text, metadata, vector)
+                for chunk_id, text, metadata, vector in zip(page["ids"], page["documents"], page["metadatas"], vectors)
+                if metadata and "source" in metadata
+            ]
+            if rows and moving:
+                collection.upsert(
+                    ids=[row[0] for row in rows],
+                    embeddings=[PLACEHOLDER_EMBEDDING] * len(rows),
+                    metadatas=[row[2] for row in rows],
+                    documents=[row[1] for row in rows],
+                )
+            elif rows:
+                embeddings = self.embedding_model.embed_documents([row[1] for row in rows])
+                rows = [(chunk_id, text, metadata, vector) for (chunk_id, text, metadata, _), vector in zip(rows, embeddings)]
+            self.vector_index.add((chunk_id, vector, metadata) for chunk_id, _, metadata, vector in rows)
+            if len(page["ids"]) < page_size:
+                break
+            offset += page_size
+        self.vector_index.flush()
+        if moving:
+            # Its vectors are in the vector index now, and it would go stale
+            self.db._client.delete_collection(full_collection.name)
+        logging.info(f"Vector index built with {self.vector_index.count()} chunks")
+
+    def stored_chunks(self, source: str, doc_id: str, metadata: Optional[Dict] = None) -> Iterator[List[Chunk]]:
+        """Chunks of a stored document, read from the document store in blocks"""
+        return iter_chunks(
+            source, doc_id, self.document_store.iter_text(doc_id), self.chunk_tokens, self.chunk_overlap, metadata
+        )
+
+    def _write_document(self, writer: "_BatchWriter", entry: ManifestEntry):
+        for chunks in self.stored_chunks(entry.source, entry.doc_id, document_metadata(entry)):
+            writer.add(chunks)
+        writer.add([], entry)
+
+    def remove_source(self, source: str, doc_id: Optional[str] = None):
+        """Delete a source's chunks and manifest entry, and its text once nothing references it.
+
+        Pass no doc_id while chunks are still queued in a writer, and collect
+        the text with collect_documents once it has finished: a source with the
+        same content may have chunks referencing it that are not upserted yet.
+        """
+        self.db._collection.delete(where={"source": source})
+        if self.lexical_index is not None:
+            self.lexical_index.delete_source(source)
+        if self.vector_index is not None:
+            self.vector_index.delete_source(source)
+        self.manifest.delete(source)
+        self.manifest.bump_index_version()
+        if doc_id:
+            self.collect_documents([doc_id])
+
+    def _is_referenced(self, doc_id: str) -> bool:
+        return bool(self.db._collection.get(where={"doc_id": doc_id}, limit=1)["ids"])
+
+    def collect_documents(self, doc_ids: Iterable[str]):
+        """Delete the stored text of documents that no chunk references anymore.
+
+        Texts that another job is still indexing are pinned in the document
+        store and kept, their chunks may not be upserted yet.
+        """
+        for doc_id in doc_ids:
+            self.document_store.collect(doc_id, self._is_referenced)
+
+    def index_document(
+        self,
+        source: str,
+        text: str,
+        mtime_ns: Optional[int] = None,
+        size: Optional[int] = None,
+        origin: str = UPLOAD_ORIGIN,
+        tags: str = ""
+    ) -> str:
+        """Index a single document, replacing its previous version if the content changed"""
+        return self.index_stream(source, [text], mtime_ns, size, origin, tags)
+
+    def index_stream(
+        self,
+        source: str,
+        pieces: Iterable[str],
+        mtime_ns: Optional[int] = None,
+        size: Optional[int] = None,
+        origin: str = UPLOAD_ORIGIN,
+        tags: str = ""
+    ) -> str:
+        """Index a document arriving as pieces of text, replacing its previous version if it or its tags changed"""
+        # Stored and hashed first, the id decides whether anything needs to be indexed.
+        # Pinned until its chunks are upserted, so other jobs do not collect the text
+        doc_id = self.document_store.put_stream(pieces, pin=True)
+        try:
+            entry = ManifestEntry(source, doc_id, mtime_ns, size, origin, tags)
+
+            existing = self.db._collection.get(where={"source": source}, include=["metadatas"], limit=1)
+            if existing["ids"]:
+                previous = existing["metadatas"][0].get("doc_id")
+                previous_entry = self.manifest.get(source)
+                if previous == doc_id and (previous_entry is None or previous_entry.tags == tags):
+                    logging.info(f"Document {source} is unchanged, skipping")
+                    self.manifest.put(entry)
+                    return doc_id
+                logging.info(f"Document {source} changed, re-indexing")
+                self.remove_source(source)
+            else:
+                previous = None
+
+            stats = IngestionStats()
+            writer = _BatchWriter(self, stats)
+            self._write_document(writer, entry)
+            writer.finish()
+        finally:
+            self.document_store.unpin(doc_id)
+        # Keep the stored text when only the tags changed
+        if previous and previous != doc_id:
+            self.collect_documents([previous])
+        logging.info(f"Processed document {source} with {stats.chunks} chunks")
+        return doc_id
+
+    def _read(self, path: Path) -> str:
+        """Runs on a reader thread: extract one file's text into the document store and return its id"""
+        return self.document_store.put_stream(extract_file(path), pin=True)
+
+    def sync_directory(self, documents_dir: str) -> IngestionStats:
+        """Bring the index in line with a directory: add new, re-index changed and drop deleted files"""
+        origin = str(Path(documents_dir).resolve())
+        stats = IngestionStats()
+        manifest_entries = self.manifest.entries()
+        indexed = self.indexed_sources()
+        logging.info(f"{len(indexed)} sources in the vector store, {len(manifest_entries)} in the manifest")
+        rechunk = self.manifest.get_setting("chunking") != self.chunking
+        if rechunk and indexed:
+            logging.info(f"Chunking changed to {self.chunking}, re-indexing all documents")
+
+        writer = _BatchWriter(self, stats)
+        in_flight: Deque[Tuple[str, os.stat_result, str, Future]] = deque()
+        seen = set()
+        # Replaced texts, deleted once the writer has upserted every chunk
+        replaced = set()
+        # Texts pinned by the readers, unpinned once the writer has upserted every chunk
+        pinned: List[str] = []
+        last_report = time.monotonic()
+
+        def report():
+            nonlocal last_report
+            if time.monotonic() - last_report >= self.progress_interval:
+                logging.info(f"Progress: {stats.summary()}")
+                last_report = time.monotonic()
+
+        def drain(source: str, stat: os.stat_result, tags: str, future: Future):
+            try:
+                doc_id = future.result()
+            except Exception as e:
+                stats.failed += 1
+                logging.error(f"Error loading {source}: {str(e)}")
+                return
+            pinned.append(doc_id)
+
+            entry = ManifestEntry(source, doc_id, stat.st_mtime_ns, stat.st_size, origin, tags)
+            previous = manifest_entries.get(source)
+            if not rechunk and doc_id == indexed.get(source) and (previous is None or previous.tags == tags):
+                # Touched but identical content, only the file stats changed
+                stats.unchanged += 1
+                self.manifest.put(entry)
+                return
+
+            if source in indexed:
+                stats.updated += 1
+                self.remove_source(source)
+                # Keep the stored text when only the chunking or tags changed
+                if indexed[source] and indexed[source] != doc_id:
+                    replaced.add(indexed[source])
+            stats.documents += 1
+            self._write_document(writer, entry)
+            report()
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.reader_threads, thread_name_prefix="ingest-reader") as readers:
+                for path in iter_document_files(documents_dir):
+                    # The path below the documents directory, so files of the same name in
+                    # different folders are separate sources. Top-level files keep their name
+                    source = path.relative_to(documents_dir).as_posix()
+                    seen.add(source)
+
+                    stat = path.stat()
+                    tags = directory_tags(path, documents_dir)
+                    entry = manifest_entries.get(source)
+                    if (
+                        not rechunk
+                        and entry is not None
+                        and source in indexed
+                        and entry.mtime_ns == stat.st_mtime_ns
+                        and entry.size == stat.st_size
+                        and entry.tags == tags
+                    ):
+                        stats.unchanged += 1
+                        continue
+
+                    future = readers.submit(self._read, path)
+                    in_flight.append((source, stat, tags, future))
+                    if len(in_flight) >= self.max_in_flight:
+                        drain(*in_flight.popleft())
+
+                while in_flight:
+                    drain(*in_flight.popleft())
+
+            if rechunk:
+                # Uploads have no file to read again, their text comes from the document store
+                for source, entry in manifest_entries.items():
+                    if entry.origin != UPLOAD_ORIGIN or source not in indexed:
+                        continue
+                    self.document_store.pin(entry.doc_id)
+                    pinned.append(entry.doc_id)
+                    if not self.document_store.exists(entry.doc_id):
+                        logging.warning(f"Text of uploaded document {source} is missing, cannot re-chunk it")
+                        continue
+                    self.remove_source(source)
+                    stats.updated += 1
+                    stats.documents += 1
+                    self._write_document(writer, entry)
+
+            writer.finish()
+        finally:
+            # Texts read ahead of a failure
+            pinned.extend(future.result() for *_, future in in_flight if not future.exception())
+            for doc_id in pinned:
+                self.document_store.unpin(doc_id)
+
+        self.collect_documents(replaced)
+        self.manifest.set_setting("chunking", self.chunking)
+
+        # Files that were synced from this directory before but are gone now
+        for source, entry in manifest_entries.items():
+            if entry.origin == origin and source not in seen:
+                logging.info(f"Document {source} was deleted, removing it from the index")
+                self.remove_source(source, entry.doc_id)
+                stats.removed += 1
+
+        logging.info(f"Ingestion finished: {stats.summary()}")
+        return stats
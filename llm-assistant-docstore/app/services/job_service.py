@@ -0,0 +1,121 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+from app.models.job import JobInfo, JobStatus
+
+
+class _SourceLock:
+    """Lock of one source and the number of jobs holding or waiting for it"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = 0
+
+
+class IngestionJobManager:
+    """Runs document ingestion in a worker pool so uploads return immediately.
+
+    Chunking and embedding happen on worker threads, off the event loop, so
+    queries stay responsive while documents are being indexed. Persisting the
+    vector store is coalesced: it happens at most once per persist_interval,
+    however many documents were indexed in the meantime.
+    """
+
+    def __init__(self, doc_service, max_workers: int = 2, persist_interval: float = 5.0, max_jobs: int = 1000):
+        self.doc_service = doc_service
+        self.persist_interval = persist_interval
+        self.max_jobs = max_jobs
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingestion-job")
+        self._jobs: "OrderedDict[str, JobInfo]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Two uploads of the same filename must not interleave their re-indexing
+        # Only sources with a job running or waiting have a lock
+        self._source_locks: Dict[str, _SourceLock] = {}
+        self._persist_timer: Optional[threading.Timer] = None
+
+    def submit(self, filename: str, path: Path, tags: str = "") -> JobInfo:
+        """Queue a spooled upload for ingestion; the file is deleted once the job has run"""
+        job = JobInfo(job_id=str(uuid.uuid4()), filename=filename, created_at=time.time())
+        with self._lock:
+            self._jobs[job.job_id] = job
+            # Forget the oldest finished jobs
+            while len(self._jobs) > self.max_jobs:
+                oldest_id, oldest = next(iter(self._jobs.items()))
+                if oldest.status not in (JobStatus.COMPLETED, JobStatus.FAILED):
+                    break
+                del self._jobs[oldest_id]
+
+        self._executor.submit(self._run, job, path, tags)
+        logging.info(f"Queued ingestion job {job.job_id} for {filename}")
+        return job.model_copy()
+
+    def get(self, job_id: str) -> Optional[JobInfo]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return job.model_copy() if job else None
+
+    @contextmanager
+    def _source_lock(self, source: str) -> Iterator[None]:
+        """Hold the source's lock, dropping it once no other job needs it"""
+        with self._lock:
+            source_lock = self._source_locks.setdefault(source, _SourceLock())
+            source_lock.users += 1
+        try:
+            with source_lock.lock:
+                yield
+        finally:
+            with self._lock:
+                source_lock.users -= 1
+                if source_lock.users == 0:
+                    del self._source_locks[source]
+
+    def _run(self, job: JobInfo, path: Path, tags: str):
+        job.status = JobStatus.RUNNING
+        job.started_at = time.time()
+        try:
+            with self._source_lock(job.filename):
+                job.doc_id = self.doc_service.index_upload(job.filename, path, tags)
+            job.status = JobStatus.COMPLETED
+            self._schedule_persist()
+            logging.info(f"Ingestion job {job.job_id} completed for {job.filename}")
+        except Exception as e:
+            job.status = JobStatus.FAILED
+            job.error = str(e)
+            logging.error(f"Ingestion job {job.job_id} failed: {str(e)}")
+            logging.exception("Full traceback:")
+        finally:
+            job.finished_at = time.time()
+            path.unlink(missing_ok=True)
+
+    def _schedule_persist(self):
+        with self._lock:
+            if self._persist_timer is not None:
+                return
+            self._persist_timer = threading.Timer(self.persist_interval, self._persist)
+            self._persist_timer.daemon = True
+            self._persist_timer.start()
+
+    def _persist(self):
+        with self._lock:
+            self._persist_timer = None
+        try:
+            self.doc_service.db.persist()
+            if self.doc_service.vector_index is not None:
+                self.doc_service.vector_index.flush()
+        except Exception as e:
+            logging.error(f"Error persisting vector store: {str(e)}")
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+        with self._lock:
+            timer, self._persist_timer = self._persist_timer, None
+        if timer is not None:
+            timer.cancel()
+            self._persist()
@@ -0,0 +1,200 @@
+import re
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Hashable, Iterable, List, NamedTuple, Optional, Tuple
+
+from app.services.search_filter import SearchFilter, split_tags, tag_metadata, tags_of
+
+# Constant of reciprocal-rank fusion; dampens the weight of the very first ranks
+RRF_K = 60
+
+# Tokens shaped like code, which only match exactly: anything with a digit,
+# snake_case, camelCase or PascalCase, and dotted or :: names such as app.main.
+# Hyphenated words such as long-term are ordinary English, unless they hold a
+# digit like ERR-42, and so are abbreviations such as e.g.
+IDENTIFIER = re.compile(
+    r"^(?:(?=[\w.\-:/#]*\d)\w[\w.\-:/#]*|\w+_\w+|[a-z]+[A-Z]\w*|[A-Z][a-z]+[A-Z]\w*|(?=.*\w\w)\w+(?:(?:\.|::)\w+)+)$"
+)
+QUERY_TERM = re.compile(r'"([^"]+)"|(\S+)')
+WORD = re.compile(r"\w+")
+# Left out of term_coverage, they appear in almost every chunk
+STOPWORDS = frozenset(
+    "a an and are as at be but by can do does for from has have how i if in is it its "
+    "me my no not of on or so that the their them there these they this to was we what "
+    "when where which who why will with you your".split()
+)
+
+
+class LexicalHit(NamedTuple):
+    chunk_id: str
+    text: str
+    metadata: Dict
+    score: float
+
+
+def is_exact_query(query: str) -> bool:
+    """True when most of the query is quoted phrases or identifier-like tokens"""
+    terms = QUERY_TERM.findall(query)
+    if not terms:
+        return False
+    exact = sum(1 for phrase, token in terms if phrase or IDENTIFIER.match(token.strip(".,;:!?()'")))
+    return exact * 2 >= len(terms)
+
+
+def term_coverage(query: str, text: str) -> float:
+    """Fraction of the query's distinct words, other than stopwords, that appear in text"""
+    terms = set(WORD.findall(query.lower())) - STOPWORDS
+    if not terms:
+        return 0.0
+    return len(terms & set(WORD.findall(text.lower()))) / len(terms)
+
+
+def reciprocal_rank_fusion(rankings: Iterable[List[Hashable]], k: int = RRF_K) -> Dict[Hashable, float]:
+    """Score every key by the sum of 1 / (k + rank) over the rankings it appears in"""
+    scores: Dict[Hashable, float] = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return scores
+
+
+def match_expression(query: str) -> Optional[str]:
+    """FTS5 query matching any of the query's words or quoted phrases, ranked by BM25"""
+    parts = []
+    for phrase, token in QUERY_TERM.findall(query):
+        words = WORD.findall((phrase or token).lower())
+        if words:
+            parts.append('"' + " ".join(words) + '"')
+    return " OR ".join(parts) if parts else None
+
+
+class LexicalIndex:
+    """BM25 inverted index of the chunks in the vector store, kept in SQLite FTS5.
+
+    Finds exact identifiers, error codes and names that dense embeddings blur
+    together. Chunks are added and removed together with their vectors, so the
+    two indexes always cover the same documents.
+    """
+
+    def __init__(self, path: str = "data/lexical.sqlite3"):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Shared by the API's worker threads, access is serialised by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS chunks (
+                    id INTEGER PRIMARY KEY,
+                    chunk_id TEXT NOT NULL UNIQUE,
+                    source TEXT NOT NULL,
+                    doc_id TEXT,
+                    start INTEGER,
+                    end INTEGER,
+                    text TEXT NOT NULL
+                )"""
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(chunks)")}
+            # Filter columns, added to indexes from before filters were supported
+            if "modified" not in columns:
+                self._conn.execute("ALTER TABLE chunks ADD COLUMN modified INTEGER")
+            if "tags" not in columns:
+                self._conn.execute("ALTER TABLE chunks ADD COLUMN tags TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS chunks_source ON chunks (source)")
+            # Underscores are part of a token so snake_case names stay searchable as a whole
+            self._conn.execute(
+                """CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+                    text, content='chunks', content_rowid='id', tokenize="unicode61 tokenchars '_'"
+                )"""
+            )
+
+    def _delete_rows(self, rows: List[Tuple[int, str]]):
+        """Remove rows from the FTS index and the chunk table; caller holds the lock and transaction"""
+        self._conn.executemany(
+            "INSERT INTO chunks_fts (chunks_fts, rowid, text) VALUES ('delete', ?, ?)",
+            rows
+        )
+        self._conn.executemany("DELETE FROM chunks WHERE id = ?", [(row_id,) for row_id, _ in rows])
+
+    def add(self, chunks: Iterable[Tuple[str, str, Dict]]):
+        """Index (chunk id, text, metadata) triples, replacing chunks with the same id"""
+        chunks = list(chunks)
+        with self._lock, self._conn:
+            existing = []
+            for chunk_id, _, _ in chunks:
+                existing.extend(self._conn.execute("SELECT id, text FROM chunks WHERE chunk_id = ?", (chunk_id,)))
+            self._delete_rows(existing)
+            for chunk_id, text, metadata in chunks:
+                tags = "," + ",".join(tags_of(metadata)) + ","
+                cursor = self._conn.execute(
+                    "INSERT INTO chunks (chunk_id, source, doc_id, start, end, text, modified, tags) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        chunk_id, metadata["source"], metadata.get("doc_id"), metadata.get("start"), metadata.get("end"),
+                        text, metadata.get("modified"), tags
+                    )
+                )
+                self._conn.execute(
+                    "INSERT INTO chunks_fts (rowid, text) VALUES (?, ?)",
+                    (cursor.lastrowid, text)
+                )
+
+    def delete_source(self, source: str):
+        with self._lock, self._conn:
+            rows = self._conn.execute("SELECT id, text FROM chunks WHERE source = ?", (source,)).fetchall()
+            self._delete_rows(rows)
+
+    def clear(self):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('delete-all')")
+            self._conn.execute("DELETE FROM chunks")
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        search_filter: Optional[SearchFilter] = None,
+        per_source: Optional[int] = None
+    ) -> List[LexicalHit]:
+        """Best k chunks by BM25 that match the filter, highest score first.
+
+        With per_source, at most that many chunks of every source are returned,
+        so k chunks cover as many sources as possible.
+        """
+        expression = match_expression(query)
+        if expression is None:
+            return []
+        condition, params = (search_filter or SearchFilter()).sql("c")
+        matches = f"""SELECT c.chunk_id, c.text, c.source, c.doc_id, c.start, c.end, c.modified, c.tags, bm25(chunks_fts) AS rank
+            FROM chunks_fts JOIN chunks c ON c.id = chunks_fts.rowid
+            WHERE chunks_fts MATCH ? AND {condition}"""
+        if per_source is None:
+            sql = f"{matches} ORDER BY rank LIMIT ?"
+            params = [expression, *params, k]
+        else:
+            # Rank the matches within their source and keep the best of each
+            sql = f"""SELECT chunk_id, text, source, doc_id, start, end, modified, tags, rank FROM (
+                    SELECT *, ROW_NUMBER() OVER (PARTITION BY source ORDER BY rank) AS source_rank
+                    FROM ({matches})
+                )
+                WHERE source_rank <= ?
+                ORDER BY rank
+                LIMIT ?"""
+            params = [expression, *params, per_source, k]
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        hits = []
+        for chunk_id, text, source, doc_id, start, end, modified, tags, rank in rows:
+            # Shaped like the chunk's metadata in the vector store
+            metadata = {"source": source, "start": start, "end": end}
+            if doc_id is not None:
+                metadata["doc_id"] = doc_id
+            if modified is not None:
+                metadata["modified"] = modified
+            metadata.update(tag_metadata(split_tags(tags)))
+            # FTS5 reports BM25 as a negative number, lower is better
+            hits.append(LexicalHit(chunk_id, text, metadata, -rank))
+        return hits
@@ -0,0 +1,100 @@
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, NamedTuple, Optional
+
+# Origin of documents uploaded through the API rather than synced from a directory
+UPLOAD_ORIGIN = "upload"
+
+
+class ManifestEntry(NamedTuple):
+    source: str
+    doc_id: str
+    mtime_ns: Optional[int]
+    size: Optional[int]
+    origin: str
+    # Comma-separated tags of the document, see search_filter.split_tags
+    tags: str = ""
+
+
+class Manifest:
+    """Tracks the content hash and file stats of every indexed source.
+
+    Lets re-indexing skip unchanged files without reading them, re-embed only
+    changed ones and drop sources whose files were deleted.
+    """
+
+    def __init__(self, path: str = "data/manifest.sqlite3"):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Shared by the API's worker threads, access is serialised by the lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS sources (
+                    source TEXT PRIMARY KEY,
+                    doc_id TEXT NOT NULL,
+                    mtime_ns INTEGER,
+                    size INTEGER,
+                    origin TEXT NOT NULL
+                )"""
+            )
+            columns = {row[1] for row in self._conn.execute("PRAGMA table_info(sources)")}
+            if "tags" not in columns:
+                # Manifests from before tags were supported
+                self._conn.execute("ALTER TABLE sources ADD COLUMN tags TEXT NOT NULL DEFAULT ''")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS sources_doc_id ON sources (doc_id)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('index_version', 0)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def get(self, source: str) -> Optional[ManifestEntry]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT source, doc_id, mtime_ns, size, origin, tags FROM sources WHERE source = ?",
+                (source,)
+            ).fetchone()
+        return ManifestEntry(*row) if row else None
+
+    def entries(self, origin: Optional[str] = None) -> Dict[str, ManifestEntry]:
+        query = "SELECT source, doc_id, mtime_ns, size, origin, tags FROM sources"
+        params = ()
+        if origin is not None:
+            query += " WHERE origin = ?"
+            params = (origin,)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return {row[0]: ManifestEntry(*row) for row in rows}
+
+    def put(self, entry: ManifestEntry):
+        self.put_many([entry])
+
+    def put_many(self, entries: Iterable[ManifestEntry]):
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO sources (source, doc_id, mtime_ns, size, origin, tags) VALUES (?, ?, ?, ?, ?, ?)",
+                list(entries)
+            )
+
+    def delete(self, source: str):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM sources WHERE source = ?", (source,))
+
+    def index_version(self) -> int:
+        """Counter that changes whenever the index changes, also across processes"""
+        with self._lock:
+            return self._conn.execute("SELECT value FROM meta WHERE key = 'index_version'").fetchone()[0]
+
+    def bump_index_version(self):
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'index_version'")
+
+    def get_setting(self, key: str) -> Optional[str]:
+        """Setting the index was built with, such as the chunking parameters"""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM settings WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_setting(self, key: str, value: str):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
@@ -0,0 +1,124 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+
+from app.metrics import timed, SPAN_SECONDS, QUERY_BATCH_SIZE
+from app.services.search_filter import SearchFilter
+
+# Embeds a list of queries into a list of vectors
+EmbedFn = Callable[[List[str]], List[List[float]]]
+# Searches the k nearest chunks matching a filter for every vector, returning one hit list per vector
+SearchFn = Callable[[List[List[float]], int, Optional[SearchFilter]], List[List[Tuple]]]
+
+
+class _Pending(NamedTuple):
+    query: str
+    k: int
+    future: asyncio.Future
+    queued_at: float
+    timings: Optional[dict]
+    search_filter: Optional[SearchFilter]
+
+
+class QueryBatcher:
+    """Groups concurrent vector searches into batches.
+
+    Queries that arrive within window seconds of the first one waiting are
+    embedded in one forward pass and searched in one call to the vector store
+    per distinct filter.
+    Batches run one at a time, so while one is being embedded the next one
+    fills up: under load the batches grow and the per-query cost drops, while
+    a lone query only waits for the window.
+    """
+
+    def __init__(self, embed: EmbedFn, search: SearchFn, window: float = 0.005, max_batch_size: int = 32):
+        if max_batch_size <= 0:
+            raise ValueError("max_batch_size must be positive")
+        self.embed = embed
+        self.search = search
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def search_one(
+        self,
+        query: str,
+        k: int,
+        timings: Optional[dict] = None,
+        search_filter: Optional[SearchFilter] = None
+    ) -> List[Tuple]:
+        """The k nearest chunks of query that match the filter as (document, similarity), best first"""
+        if self._worker is None or self._worker.done():
+            # Created lazily so the queue and task belong to the running event loop
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put(_Pending(query, k, future, time.perf_counter(), timings, search_filter))
+        return await future
+
+    async def _collect(self) -> List[_Pending]:
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.window
+        while len(batch) < self.max_batch_size:
+            if not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+                continue
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = [pending for pending in await self._collect() if not pending.future.done()]
+            if not batch:
+                continue
+            batch_started = time.perf_counter()
+            for pending in batch:
+                waited = batch_started - pending.queued_at
+                SPAN_SECONDS.labels(span="batch_wait").observe(waited)
+                if pending.timings is not None:
+                    pending.timings["batch_wait"] = round(waited, 4)
+            try:
+                # One timings dict for the batch, copied to every query in it
+                batch_timings = {}
+                results = await asyncio.to_thread(self._process, batch, batch_timings)
+            except Exception as e:
+                logging.error(f"Error searching a batch of {len(batch)} queries: {str(e)}")
+                for pending in batch:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                continue
+
+            for pending, hits in zip(batch, results):
+                if pending.timings is not None:
+                    pending.timings.update(batch_timings)
+                if not pending.future.done():
+                    pending.future.set_result(hits[:pending.k])
+
+    def _process(self, batch: List[_Pending], timings: dict) -> List[List[Tuple]]:
+        QUERY_BATCH_SIZE.observe(len(batch))
+        with timed("embed_query", timings):
+            embeddings = self.embed([pending.query for pending in batch])
+
+        # A vector store query takes one filter, so queries are grouped by theirs
+        groups: Dict[Optional[SearchFilter], List[int]] = {}
+        for index, pending in enumerate(batch):
+            groups.setdefault(pending.search_filter, []).append(index)
+        results: List[List[Tuple]] = [[] for _ in batch]
+        with timed("vector_search", timings):
+            for search_filter, indexes in groups.items():
+                hits = self.search(
+                    [embeddings[index] for index in indexes],
+                    max(batch[index].k for index in indexes),
+                    search_filter
+                )
+                for index, query_hits in zip(indexes, hits):
+                    results[index] = query_hits
+        return results
@@ -0,0 +1,81 @@
+import re
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# Tags are stored on every chunk as a boolean metadata key, such as "tag:finance"
+TAG_PREFIX = "tag:"
+TAG_INVALID = re.compile(r"[^\w\-]+")
+
+
+def normalize_tags(tags: Iterable[str]) -> Tuple[str, ...]:
+    """Lowercase tags with anything but letters, digits, '_' and '-' replaced, sorted and unique"""
+    normalized = {TAG_INVALID.sub("-", tag.strip().lower()).strip("-") for tag in tags}
+    return tuple(sorted(tag for tag in normalized if tag))
+
+
+def split_tags(tags: Optional[str]) -> Tuple[str, ...]:
+    """Tags from a comma-separated string"""
+    return normalize_tags(tags.split(",")) if tags else ()
+
+
+def tag_metadata(tags: Iterable[str]) -> Dict[str, bool]:
+    return {TAG_PREFIX + tag: True for tag in tags}
+
+
+def tags_of(metadata: Dict) -> Tuple[str, ...]:
+    return tuple(sorted(key[len(TAG_PREFIX):] for key in metadata if key.startswith(TAG_PREFIX)))
+
+
+class SearchFilter(NamedTuple):
+    """Restricts a search to chunks of some sources, with some tags or modified within a range.
+
+    Translated into a Chroma where clause and an SQL condition, so both
+    indexes only ever consider matching chunks. Hashable, so queries with the
+    same filter can share a batched vector search.
+    """
+
+    sources: Tuple[str, ...] = ()
+    # A chunk matches when its document has any of these tags
+    tags: Tuple[str, ...] = ()
+    # Unix timestamps, inclusive
+    modified_after: Optional[int] = None
+    modified_before: Optional[int] = None
+    exclude_sources: Tuple[str, ...] = ()
+
+    def where(self) -> Optional[Dict]:
+        """Chroma where clause, None when the filter matches everything"""
+        clauses: List[Dict] = []
+        if self.sources:
+            clauses.append({"source": {"$in": list(self.sources)}})
+        if self.exclude_sources:
+            clauses.append({"source": {"$nin": list(self.exclude_sources)}})
+        if self.tags:
+            tag_clauses = [{TAG_PREFIX + tag: True} for tag in self.tags]
+            clauses.append(tag_clauses[0] if len(tag_clauses) == 1 else {"$or": tag_clauses})
+        if self.modified_after is not None:
+            clauses.append({"modified": {"$gte": self.modified_after}})
+        if self.modified_before is not None:
+            clauses.append({"modified": {"$lte": self.modified_before}})
+        if not clauses:
+            return None
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    def sql(self, alias: str) -> Tuple[str, list]:
+        """SQL condition on the lexical index's chunk table and its parameters"""
+        conditions, params = [], []
+        if self.sources:
+            conditions.append(f"{alias}.source IN ({','.join('?' * len(self.sources))})")
+            params.extend(self.sources)
+        if self.exclude_sources:
+            conditions.append(f"{alias}.source NOT IN ({','.join('?' * len(self.exclude_sources))})")
+            params.extend(self.exclude_sources)
+        if self.tags:
+            # Tags are stored as ",a,b,"; '_' is a LIKE wildcard and must be escaped
+            conditions.append("(" + " OR ".join(f"{alias}.tags LIKE ? ESCAPE '\\'" for _ in self.tags) + ")")
+            params.extend("%," + tag.replace("_", "\\_") + ",%" for tag in self.tags)
+        if self.modified_after is not None:
+            conditions.append(f"{alias}.modified >= ?")
+            params.append(self.modified_after)
+        if self.modified_before is not None:
+            conditions.append(f"{alias}.modified <= ?")
+            params.append(self.modified_before)
+        return " AND ".join(conditions) or "1", params
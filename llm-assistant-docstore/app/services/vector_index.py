@@ -0,0 +1,418 @@
+import logging
+import math
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from app.services.search_filter import SearchFilter, tags_of
+
+QUANTIZATIONS = {"int8": np.int8, "float16": np.float16}
+# Rows scored per step of a scan, bounds the memory of the float32 copy of a block
+SCAN_BLOCK = 65536
+# Chroma collection holding chunks with their vectors, langchain's default name
+FULL_COLLECTION = "langchain"
+# Chroma collection that only holds the text and metadata of chunks, while their
+# vectors are in a CompactVectorIndex
+METADATA_COLLECTION = "chunks"
+# Stored in that collection in place of every chunk's embedding
+PLACEHOLDER_EMBEDDING = [0.0]
+
+
+def full_collection(db):
+    """The collection of a Chroma vector store that holds the vectors too, None if there is none"""
+    try:
+        return db._client.get_collection(FULL_COLLECTION, embedding_function=None)
+    except Exception:
+        return None
+
+
+class VectorHit(NamedTuple):
+    chunk_id: str
+    # Squared L2 distance, as reported by Chroma
+    distance: float
+
+
+class CompactVectorIndex:
+    """Quantized, memory-mapped vector index with IVF and exact re-ranking.
+
+    Vectors are kept twice on disk: quantized to int8 (one scale per vector)
+    or float16 in a memory-mapped matrix that every search scans, and as
+    float32 in a plain file that is only read for the few candidates being
+    re-ranked. Resident memory is a quarter (int8) or half (float16) of a
+    float32 index. Once the index holds min_train_size vectors it is split
+    into inverted lists by k-means, and a search only scans the lists nearest
+    to the query. The best rerank_factor * k candidates by the quantized
+    score are then re-ranked with their exact vectors, so the returned
+    distances are exact.
+
+    Chunk ids and the filter columns of every vector live in SQLite, so
+    searches take the same SearchFilter as the lexical index. Vectors are
+    added and removed together with the vector store, like the lexical index.
+    The vector store then keeps no vectors itself, only the chunks' text and
+    metadata in its METADATA_COLLECTION.
+    """
+
+    def __init__(
+        self,
+        path: str = "data/vectors",
+        quantization: str = "int8",
+        probes: int = 32,
+        rerank_factor: int = 4,
+        min_train_size: int = 20000
+    ):
+        if quantization not in QUANTIZATIONS:
+            raise ValueError(f"Unknown quantization {quantization}, use one of {', '.join(QUANTIZATIONS)}")
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.quantization = quantization
+        self.probes = probes
+        self.rerank_factor = rerank_factor
+        self.min_train_size = min_train_size
+        self._dtype = QUANTIZATIONS[quantization]
+
+        # Shared by the API's worker threads, access is serialised by the lock
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(self.path / "index.sqlite3", check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                """CREATE TABLE IF NOT EXISTS vectors (
+                    slot INTEGER PRIMARY KEY,
+                    chunk_id TEXT NOT NULL UNIQUE,
+                    source TEXT NOT NULL,
+                    doc_id TEXT,
+                    modified INTEGER,
+                    tags TEXT,
+                    list INTEGER NOT NULL,
+                    scale REAL NOT NULL
+                )"""
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS vectors_source ON vectors (source)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+        meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+        if meta.get("quantization", quantization) != quantization:
+            # Stored vectors can not be reinterpreted, the index is rebuilt from the vector store
+            logging.info(f"Vector index quantization changed to {quantization}, clearing it")
+            self._reset()
+            meta = {}
+        self.dim: Optional[int] = int(meta["dim"]) if "dim" in meta else None
+        self._trained_size = int(meta.get("trained_size", 0))
+
+        centroids_path = self.path / "centroids.npy"
+        self._centroids = np.load(centroids_path) if centroids_path.exists() and self._trained_size else None
+        self._quantized: Optional[np.memmap] = None
+        self._exact_fd: Optional[int] = None
+        # Inverted list of every slot, -1 for free slots, and the scale of its quantized vector
+        self._lists = np.zeros(0, dtype=np.int32)
+        self._scales = np.zeros(0, dtype=np.float32)
+        # Slots sorted by list and where each list starts, rebuilt after writes
+        self._order: Optional[np.ndarray] = None
+        self._offsets: Optional[np.ndarray] = None
+        if self.dim is not None:
+            self._open_files()
+
+    def _reset(self):
+        with self._conn:
+            self._conn.execute("DELETE FROM vectors")
+            self._conn.execute("DELETE FROM meta")
+        for name in ("quantized", "exact.f32", "centroids.npy"):
+            (self.path / name).unlink(missing_ok=True)
+
+    def _open_files(self):
+        """Map the quantized matrix and load slot lists and scales from SQLite"""
+        row_bytes = self.dim * np.dtype(self._dtype).itemsize
+        quantized_path = self.path / "quantized"
+        if not quantized_path.exists():
+            quantized_path.touch()
+        capacity = quantized_path.stat().st_size // row_bytes
+        self._quantized = np.memmap(quantized_path, dtype=self._dtype, mode="r+", shape=(capacity, self.dim)) if capacity else None
+        if self._exact_fd is None:
+            self._exact_fd = os.open(self.path / "exact.f32", os.O_RDWR | os.O_CREAT, 0o644)
+
+        self._lists = np.full(capacity, -1, dtype=np.int32)
+        self._scales = np.zeros(capacity, dtype=np.float32)
+        for slot, vector_list, scale in self._conn.execute("SELECT slot, list, scale FROM vectors"):
+            self._lists[slot] = vector_list
+            self._scales[slot] = scale
+        self._order = None
+
+    def _ensure_capacity(self, size: int):
+        """Grow the quantized matrix to hold at least size rows, doubling it"""
+        capacity = len(self._lists)
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2, 1024)
+        if self._quantized is not None:
+            self._quantized.flush()
+            self._quantized = None
+        row_bytes = self.dim * np.dtype(self._dtype).itemsize
+        with open(self.path / "quantized", "r+b") as f:
+            f.truncate(capacity * row_bytes)
+        self._quantized = np.memmap(self.path / "quantized", dtype=self._dtype, mode="r+", shape=(capacity, self.dim))
+        self._lists = np.concatenate([self._lists, np.full(capacity - len(self._lists), -1, dtype=np.int32)])
+        self._scales = np.concatenate([self._scales, np.zeros(capacity - len(self._scales), dtype=np.float32)])
+
+    def _quantize(self, vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        if self._dtype is np.float16:
+            return vectors.astype(np.float16), np.ones(len(vectors), dtype=np.float32)
+        # Symmetric int8 with one scale per vector
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def _read_exact(self, slots: np.ndarray) -> np.ndarray:
+        """float32 vectors of slots, read from disk without mapping the file"""
+        row_bytes = self.dim * 4
+        return np.stack([
+            np.frombuffer(os.pread(self._exact_fd, row_bytes, int(slot) * row_bytes), dtype=np.float32)
+            for slot in slots
+        ]) if len(slots) else np.zeros((0, self.dim), dtype=np.float32)
+
+    def _write_exact(self, slots: Iterable[int], vectors: np.ndarray):
+        for slot, vector in zip(slots, vectors):
+            os.pwrite(self._exact_fd, vector.astype(np.float32).tobytes(), int(slot) * self.dim * 4)
+
+    def _assign(self, vectors: np.ndarray) -> np.ndarray:
+        """Nearest centroid of every vector, 0 while the index is not trained"""
+        if self._centroids is None:
+            return np.zeros(len(vectors), dtype=np.int32)
+        lists = np.empty(len(vectors), dtype=np.int32)
+        for start in range(0, len(vectors), SCAN_BLOCK):
+            block = vectors[start:start + SCAN_BLOCK]
+            lists[start:start + SCAN_BLOCK] = np.argmax(block @ self._centroids.T, axis=1)
+        return lists
+
+    def add(self, vectors: Iterable[Tuple[str, List[float], Dict]]):
+        """Index (chunk id, embedding, metadata) triples, replacing vectors with the same id"""
+        # The last of several vectors with the same id wins
+        vectors = list({chunk_id: (chunk_id, embedding, metadata) for chunk_id, embedding, metadata in vectors}.values())
+        if not vectors:
+            return
+        matrix = np.asarray([embedding for _, embedding, _ in vectors], dtype=np.float32)
+        with self._lock, self._conn:
+            if self.dim is None:
+                self.dim = matrix.shape[1]
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                    [("dim", str(self.dim)), ("quantization", self.quantization)]
+                )
+                self._open_files()
+            if matrix.shape[1] != self.dim:
+                raise ValueError(f"Vectors of dimension {matrix.shape[1]} added to an index of dimension {self.dim}")
+
+            # Replaced chunks keep their slot, new ones take free slots first
+            slots = []
+            free = iter(np.flatnonzero(self._lists == -1).tolist())
+            appended = len(self._lists)
+            for chunk_id, _, _ in vectors:
+                row = self._conn.execute("SELECT slot FROM vectors WHERE chunk_id = ?", (chunk_id,)).fetchone()
+                slot = row[0] if row else next(free, None)
+                if slot is None:
+                    slot, appended = appended, appended + 1
+                slots.append(slot)
+            self._ensure_capacity(max(slots) + 1)
+
+            quantized, scales = self._quantize(matrix)
+            lists = self._assign(matrix)
+            index = np.asarray(slots)
+            self._quantized[index] = quantized
+            self._write_exact(slots, matrix)
+            self._lists[index] = lists
+            self._scales[index] = scales
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO vectors (slot, chunk_id, source, doc_id, modified, tags, list, scale) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        slot, chunk_id, metadata["source"], metadata.get("doc_id"), metadata.get("modified"),
+                        "," + ",".join(tags_of(metadata)) + ",", int(vector_list), float(scale)
+                    )
+                    for slot, (chunk_id, _, metadata), vector_list, scale in zip(slots, vectors, lists, scales)
+                ]
+            )
+            self._order = None
+
+            # Lists are (re)built once there are enough vectors, and again when the index quadrupled
+            count = int(np.count_nonzero(self._lists >= 0))
+            if count >= self.min_train_size and count >= self._trained_size * 4:
+                self._train(count)
+
+    def vectors(self, chunk_ids: List[str]) -> Dict[str, np.ndarray]:
+        """Exact vectors of those of the chunks that are in the index"""
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT chunk_id, slot FROM vectors WHERE chunk_id IN ({','.join('?' * len(chunk_ids))})", chunk_ids
+            ).fetchall()
+            if not rows:
+                return {}
+            return dict(zip((chunk_id for chunk_id, _ in rows), self._read_exact(np.asarray([slot for _, slot in rows]))))
+
+    def delete_source(self, source: str):
+        with self._lock, self._conn:
+            slots = [row[0] for row in self._conn.execute("SELECT slot FROM vectors WHERE source = ?", (source,))]
+            self._conn.execute("DELETE FROM vectors WHERE source = ?", (source,))
+            if slots:
+                self._lists[np.asarray(slots)] = -1
+                self._order = None
+
+    def clear(self):
+        with self._lock:
+            self._quantized = None
+            if self._exact_fd is not None:
+                os.close(self._exact_fd)
+                self._exact_fd = None
+            self._reset()
+            self.dim = None
+            self._trained_size = 0
+            self._centroids = None
+            self._lists = np.zeros(0, dtype=np.int32)
+            self._scales = np.zeros(0, dtype=np.float32)
+            self._order = None
+
+    def count(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM vectors").fetchone()[0]
+
+    def flush(self):
+        with self._lock:
+            if self._quantized is not None:
+                self._quantized.flush()
+            if self._exact_fd is not None:
+                os.fsync(self._exact_fd)
+
+    def _train(self, count: int, iterations: int = 10, sample_per_list: int = 64):
+        """Cluster the vectors into sqrt(count) lists with spherical k-means and reassign every vector"""
+        nlist = max(1, int(math.sqrt(count)))
+        logging.info(f"Training the vector index with {nlist} lists over {count} vectors")
+        live = np.flatnonzero(self._lists >= 0)
+        rng = np.random.default_rng(0)
+        sample = self._read_exact(np.sort(rng.choice(live, min(len(live), nlist * sample_per_list), replace=False)))
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(iterations):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(assignment, minlength=nlist)
+            # Empty lists keep their centroid
+            filled = counts > 0
+            starts = np.cumsum(counts) - counts
+            sums = np.add.reduceat(sample[np.argsort(assignment, kind="stable")], starts[filled], axis=0)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids[filled] = sums / np.maximum(norms, 1e-12)
+        self._centroids = centroids.astype(np.float32)
+
+        for start in range(0, len(live), SCAN_BLOCK):
+            block = live[start:start + SCAN_BLOCK]
+            self._lists[block] = self._assign(self._read_exact(block))
+        np.save(self.path / "centroids.npy", self._centroids)
+        self._trained_size = count
+        self._conn.executemany("UPDATE vectors SET list = ? WHERE slot = ?", zip(self._lists[live].tolist(), live.tolist()))
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('trained_size', ?)", (str(count),))
+        self._order = None
+
+    def _inverted_lists(self) -> Tuple[np.ndarray, np.ndarray]:
+        if self._order is None:
+            live = np.flatnonzero(self._lists >= 0)
+            self._order = live[np.argsort(self._lists[live], kind="stable")]
+            nlist = len(self._centroids) if self._centroids is not None else 1
+            self._offsets = np.searchsorted(self._lists[self._order], np.arange(nlist + 1))
+        return self._order, self._offsets
+
+    def _candidates(self, query: np.ndarray, wanted: int, allowed: Optional[np.ndarray]) -> np.ndarray:
+        """Slots to score for a query: the nearest lists, widened until they hold wanted allowed slots"""
+        order, offsets = self._inverted_lists()
+        if self._centroids is None:
+            return order if allowed is None else allowed
+        if allowed is not None and len(allowed) <= self.min_train_size:
+            # Selective filters are scanned exactly
+            return allowed
+        ranked_lists = np.argsort(-(self._centroids @ query))
+        probes = self.probes
+        while True:
+            probed = ranked_lists[:probes]
+            candidates = np.concatenate([order[offsets[i]:offsets[i + 1]] for i in probed])
+            if allowed is not None:
+                candidates = candidates[np.isin(candidates, allowed, assume_unique=True)]
+            if len(candidates) >= wanted or probes >= len(ranked_lists):
+                return candidates
+            probes *= 2
+
+    def _approximate_scores(self, slots: np.ndarray, queries: np.ndarray) -> np.ndarray:
+        """Dot products of the quantized vectors of slots with every query, shaped (slots, queries)"""
+        scores = np.empty((len(slots), len(queries)), dtype=np.float32)
+        for start in range(0, len(slots), SCAN_BLOCK):
+            block = slots[start:start + SCAN_BLOCK]
+            # Contiguous slots are read as a slice, which is much faster than fancy indexing a memmap.
+            # IVF candidates come from several lists, so every step is checked, not just the ends
+            if len(block) and np.all(np.diff(block) == 1):
+                rows = self._quantized[block[0]:block[-1] + 1]
+            else:
+                rows = self._quantized[block]
+            scores[start:start + len(block)] = (rows.astype(np.float32) @ queries.T) * self._scales[block, None]
+        return scores
+
+    def _rerank(self, slots: np.ndarray, scores: np.ndarray, query: np.ndarray, k: int) -> List[Tuple[int, float]]:
+        """Exact squared L2 distances of the best candidates by approximate score, nearest first"""
+        if not len(slots):
+            return []
+        keep = min(len(slots), max(k * self.rerank_factor, k))
+        if keep < len(slots):
+            best = np.argpartition(-scores, keep - 1)[:keep]
+            slots = slots[best]
+        exact = self._read_exact(slots)
+        distances = np.sum((exact - query) ** 2, axis=1)
+        nearest = np.argsort(distances)[:k]
+        return [(int(slots[i]), float(distances[i])) for i in nearest]
+
+    def _allowed(self, search_filter: SearchFilter) -> np.ndarray:
+        condition, params = search_filter.sql("v")
+        rows = self._conn.execute(f"SELECT slot FROM vectors v WHERE {condition} ORDER BY slot", params).fetchall()
+        return np.asarray([row[0] for row in rows], dtype=np.int64)
+
+    def search(
+        self,
+        embeddings: List[List[float]],
+        k: int,
+        search_filter: Optional[SearchFilter] = None
+    ) -> List[List[VectorHit]]:
+        """The k nearest vectors that match the filter for every embedding, nearest first"""
+        queries = np.asarray(embeddings, dtype=np.float32)
+        with self._lock:
+            if self.dim is None or not len(queries):
+                return [[] for _ in embeddings]
+            allowed = self._allowed(search_filter) if search_filter is not None else None
+            wanted = max(k * self.rerank_factor, k)
+
+            nearest: List[List[Tuple[int, float]]] = []
+            if self._centroids is None or (allowed is not None and len(allowed) <= self.min_train_size):
+                # Every query scans the same slots, scored together in one pass
+                slots = self._candidates(queries[0], wanted, allowed)
+                scores = self._approximate_scores(slots, queries)
+                nearest = [self._rerank(slots, scores[:, i], query, k) for i, query in enumerate(queries)]
+            else:
+                for query in queries:
+                    slots = self._candidates(query, wanted, allowed)
+                    nearest.append(self._rerank(slots, self._approximate_scores(slots, query[None])[:, 0], query, k))
+
+            found = sorted({slot for hits in nearest for slot, _ in hits})
+            ids = {}
+            for start in range(0, len(found), 500):
+                part = found[start:start + 500]
+                ids.update(self._conn.execute(
+                    f"SELECT slot, chunk_id FROM vectors WHERE slot IN ({','.join('?' * len(part))})", part
+                ))
+        return [[VectorHit(ids[slot], distance) for slot, distance in hits] for hits in nearest]
+
+    def stats(self) -> dict:
+        with self._lock:
+            live = int(np.count_nonzero(self._lists >= 0))
+            return {
+                "vectors": live,
+                "dimension": self.dim,
+                "quantization": self.quantization,
+                "lists": len(self._centroids) if self._centroids is not None else 0,
+                "probes": self.probes,
+                # Size of the scanned matrix, the part of the index that stays in memory
+                "quantized_mb": round(live * (self.dim or 0) * np.dtype(self._dtype).itemsize / 1024 ** 2, 2),
+            }
@@ -1,73 +1,97 @@
 import os
 os.environ["LANGCHAIN_DISABLE_TELEMETRY"] = "true"
 
-from langchain_community.embeddings import HuggingFaceEmbeddings
 from langchain_community.vectorstores import Chroma
-from langchain.schema import Document
+from app.services.document_store import DocumentStore
+from app.services.ingestion import IngestionPipeline
+from app.services.manifest import Manifest
+from app.services.lexical_index import LexicalIndex
+from app.services.vector_index import CompactVectorIndex, FULL_COLLECTION, METADATA_COLLECTION, full_collection
+from app.services.embedding_cache import CachedEmbeddings
+from app.services.embedding_backend import create_embeddings
+from app.services.chunking import DEFAULT_MAX_TOKENS, DEFAULT_OVERLAP_TOKENS
+import argparse
 import logging
 
-def load_documents(documents_dir="documents"):
+def load_documents(
+    documents_dir="documents",
+    embed_batch_size=64,
+    upsert_batch_size=512,
+    reader_threads=4,
+    chunk_tokens=DEFAULT_MAX_TOKENS,
+    chunk_overlap=DEFAULT_OVERLAP_TOKENS
+):
     # Use the same embedding model configuration as DocumentService
-    embedding_model = HuggingFaceEmbeddings(
-        model_name="models/embeddings",  # Local path to model
-        model_kwargs={'device': 'cpu'},
-        encode_kwargs={'normalize_embeddings': True}
+    embeddings, model_id = create_embeddings()
+    embedding_model = CachedEmbeddings(
+        embeddings,
+        model_id=model_id,
+        path="data/embedding_cache.sqlite3",
+        disk_size=int(os.getenv("EMBEDDING_DISK_CACHE_SIZE", 500000))
     )
     
-    # Initialize ChromaDB
+    # Kept up to date here too when the API searches it, see DocumentService
+    vector_index = None
+    if os.getenv("VECTOR_BACKEND", "chroma").lower() == "compact":
+        vector_index = CompactVectorIndex("data/vectors", quantization=os.getenv("VECTOR_QUANTIZATION", "int8"))
+
+    # Initialize ChromaDB, without the vectors when they are in the compact index
     persist_directory = "data/chromadb"
     db = Chroma(
+        collection_name=METADATA_COLLECTION if vector_index is not None else FULL_COLLECTION,
         persist_directory=persist_directory,
         embedding_function=embedding_model
     )
+    document_store = DocumentStore("data/documents")
+    manifest = Manifest("data/manifest.sqlite3")
+    lexical_index = LexicalIndex("data/lexical.sqlite3")
 
-    # Load documents from the documents directory
-    documents = []
-    loaded_sources = set()  # Track which files we've already loaded
-    
-    for filename in os.listdir(documents_dir):
-        if filename.endswith(".txt"):  # Add more extensions if needed
-            # Use just the filename without directory prefix for consistency
-            source_name = os.path.basename(filename)
-            
-            # Check if document already exists in the DB
-            existing_docs = db._collection.get(
-                where={"source": source_name}
-            )
-            if existing_docs['ids']:
-                logging.info(f"Document {source_name} already exists in DB, skipping")
-                continue
-
-            if source_name in loaded_sources:
-                logging.info(f"Document {source_name} already processed in this session, skipping")
-                continue
-
-            file_path = os.path.join(documents_dir, filename)
-            try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    text = f.read()
-                    documents.append(
-                        Document(
-                            page_content=text,
-                            metadata={
-                                "source": source_name,  # Use normalized filename
-                                "full_document": text
-                            }
-                        )
-                    )
-                loaded_sources.add(source_name)
-                logging.info(f"Loaded document: {source_name}")
-            except Exception as e:
-                logging.error(f"Error loading {source_name}: {str(e)}")
+    pipeline = IngestionPipeline(
+        db,
+        embedding_model,
+        document_store,
+        manifest,
+        embed_batch_size=embed_batch_size,
+        upsert_batch_size=upsert_batch_size,
+        reader_threads=reader_threads,
+        lexical_index=lexical_index,
+        chunk_tokens=chunk_tokens,
+        chunk_overlap=chunk_overlap,
+        vector_index=vector_index
+    )
+    # Indexes created before the lexical index existed are backfilled once
+    pipeline.ensure_lexical_index()
+    pipeline.ensure_vector_index(full_collection(db) if vector_index is not None else None)
+    # Only new and changed files are read and embedded, deleted files are dropped
+    stats = pipeline.sync_directory(documents_dir)
 
-    # Add documents to ChromaDB
-    if documents:
-        db.add_documents(documents)
+    if stats.documents or stats.removed:
         db.persist()
-        logging.info(f"Added {len(documents)} documents to the vector store")
+        if vector_index is not None:
+            vector_index.flush()
+        logging.info(f"Indexed {stats.documents} documents ({stats.chunks} chunks), removed {stats.removed}")
     else:
-        logging.warning("No documents found to load")
+        logging.info("Vector store is up to date")
+    return stats
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.INFO)
-    load_documents() 
\ No newline at end of file
+
+    parser = argparse.ArgumentParser(description="Load documents into the vector store")
+    parser.add_argument("--documents-dir", default="documents")
+    parser.add_argument("--embed-batch-size", type=int, default=64, help="Chunks embedded per batch")
+    parser.add_argument("--upsert-batch-size", type=int, default=512, help="Chunks written to the vector store per batch")
+    parser.add_argument("--readers", type=int, default=4, help="Threads extracting text from files")
+    # Defaults match the API's, so both chunk documents the same way
+    parser.add_argument("--chunk-tokens", type=int, default=int(os.getenv("CHUNK_TOKENS", DEFAULT_MAX_TOKENS)), help="Maximum tokens per chunk")
+    parser.add_argument("--chunk-overlap", type=int, default=int(os.getenv("CHUNK_OVERLAP_TOKENS", DEFAULT_OVERLAP_TOKENS)), help="Tokens repeated from the previous chunk")
+    args = parser.parse_args()
+
+    load_documents(
+        documents_dir=args.documents_dir,
+        embed_batch_size=args.embed_batch_size,
+        upsert_batch_size=args.upsert_batch_size,
+        reader_threads=args.readers,
+        chunk_tokens=args.chunk_tokens,
+        chunk_overlap=args.chunk_overlap
+    )
@@ -1,10 +1,171 @@
-from sentence_transformers import SentenceTransformer
+"""Download the embedding model, export it for ONNX Runtime and check the export.
+
+    python models/download_model.py                       # models/embeddings
+    python models/download_model.py --export onnx-int8    # models/embeddings-onnx
+    python models/download_model.py --check onnx-int8     # compare with the indexed vectors
+
+The parity check embeds chunks that are already in data/chromadb with the
+given backend and compares the vectors and nearest neighbours with the stored
+ones. Without an index it compares with the sentence-transformers model on a
+few sample texts instead. It exits with status 1 when they differ too much.
+"""
+import argparse
+import json
+import logging
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.services.embedding_backend import (
+    EMBEDDING_BACKENDS, EMBEDDING_MODEL_DIR, ONNX_CONFIG_FILE, ONNX_MODEL_DIR, ONNX_MODEL_FILES, create_embeddings
+)
+
+# Used by the parity check when there is no index yet
+SAMPLE_TEXTS = [
+    "The quarterly report shows revenue grew by 12 percent compared to last year.",
+    "To reset your password, open the account settings and choose 'Forgot password'.",
+    "Invoice INV-2023-0042 is due on 15 March and covers the support contract.",
+    "The cat sat on the mat while the dog slept in the garden.",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+    "Meeting notes: the team agreed to move the release to the second week of June.",
+    "The API returns HTTP 503 with a Retry-After header while the model is loading.",
+    "Add two cups of flour, a pinch of salt and stir until the dough is smooth.",
+]
 
 def download_model():
+    from sentence_transformers import SentenceTransformer
+
     # This will download and cache the model
     model = SentenceTransformer('all-mpnet-base-v2')
     # Save the model to local directory
-    model.save('models/embeddings')
+    model.save(EMBEDDING_MODEL_DIR)
+
+def export_onnx(quantize: bool):
+    """Export the transformer of models/embeddings to ONNX, and a dynamically int8-quantized copy"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(EMBEDDING_MODEL_DIR, device="cpu")
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+    output_dir = Path(ONNX_MODEL_DIR)
+    output_dir.mkdir(parents=True, exist_ok=True)
+
+    class TokenVectors(torch.nn.Module):
+        """The transformer's last hidden state, pooling is done by OnnxEmbeddings"""
+
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, input_ids, attention_mask):
+            return self.transformer(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    sample = tokenizer(["An example sentence to trace the model with."], return_tensors="pt")
+    model_path = output_dir / ONNX_MODEL_FILES["onnx"]
+    with torch.no_grad():
+        torch.onnx.export(
+            TokenVectors(),
+            (sample["input_ids"], sample["attention_mask"]),
+            str(model_path),
+            input_names=["input_ids", "attention_mask"],
+            output_names=["last_hidden_state"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "sequence"},
+                "attention_mask": {0: "batch", 1: "sequence"},
+                "last_hidden_state": {0: "batch", 1: "sequence"},
+            },
+            opset_version=14
+        )
+    tokenizer.save_pretrained(str(output_dir))
+    (output_dir / ONNX_CONFIG_FILE).write_text(json.dumps({
+        "max_seq_length": model.max_seq_length,
+        "pad_token_id": tokenizer.pad_token_id,
+        "dimension": model.get_sentence_embedding_dimension(),
+    }, indent=2))
+    logging.info(f"Exported {model_path}")
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        quantized_path = output_dir / ONNX_MODEL_FILES["onnx-int8"]
+        quantize_dynamic(str(model_path), str(quantized_path), weight_type=QuantType.QInt8)
+        logging.info(f"Quantized to {quantized_path}")
+
+def indexed_vectors(sample_size: int):
+    """Texts and vectors of up to sample_size chunks in the Chroma index, or None without one"""
+    if not Path("data/chromadb").exists():
+        return None
+    import chromadb
+
+    client = chromadb.PersistentClient(path="data/chromadb")
+    # The collection name langchain's Chroma uses by default
+    collection = client.get_or_create_collection("langchain")
+    if collection.count() == 0:
+        return None
+    found = collection.get(limit=sample_size, include=["documents", "embeddings"])
+    return found["documents"], np.asarray(found["embeddings"], dtype=np.float32)
+
+def neighbour_recall(reference: np.ndarray, candidate: np.ndarray, k: int) -> float:
+    """Share of every vector's k nearest neighbours that both sets of vectors agree on"""
+    k = min(k, len(reference) - 1)
+    if k <= 0:
+        return 1.0
+    def neighbours(vectors: np.ndarray) -> np.ndarray:
+        scores = vectors @ vectors.T
+        np.fill_diagonal(scores, -np.inf)
+        return np.argsort(-scores, axis=1)[:, :k]
+    expected, found = neighbours(reference), neighbours(candidate)
+    return float(np.mean([len(set(a) & set(b)) / k for a, b in zip(expected, found)]))
+
+def check_parity(backend: str, sample_size: int, min_similarity: float, min_recall: float) -> bool:
+    indexed = indexed_vectors(sample_size)
+    if indexed is not None:
+        texts, reference = indexed
+        logging.info(f"Comparing with {len(texts)} indexed chunks")
+    else:
+        texts = SAMPLE_TEXTS
+        reference_model, _ = create_embeddings("torch")
+        reference = np.asarray(reference_model.embed_documents(texts), dtype=np.float32)
+        logging.info(f"No index found, comparing with the torch backend on {len(texts)} sample texts")
+
+    embeddings, model_id = create_embeddings(backend)
+    started = time.perf_counter()
+    candidate = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    elapsed = time.perf_counter() - started
+
+    similarities = np.sum(reference * candidate, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1)
+    )
+    recall = neighbour_recall(reference, candidate, 10)
+    logging.info(
+        f"{model_id}: cosine similarity mean {similarities.mean():.5f}, min {similarities.min():.5f}, "
+        f"neighbour recall@10 {recall:.4f}, {len(texts) / elapsed:.1f} texts/s"
+    )
+    return similarities.mean() >= min_similarity and recall >= min_recall
 
 if __name__ == "__main__":
-    download_model() 
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Download, export and check the embedding model")
+    parser.add_argument("--export", choices=ONNX_MODEL_FILES, help="Export models/embeddings for this ONNX backend")
+    parser.add_argument("--check", choices=EMBEDDING_BACKENDS, help="Compare this backend's vectors with the indexed ones")
+    parser.add_argument("--sample-size", type=int, default=1000, help="Indexed chunks to compare")
+    parser.add_argument("--min-similarity", type=float, default=0.99, help="Least mean cosine similarity that passes")
+    parser.add_argument("--min-recall", type=float, default=0.9, help="Least neighbour recall@10 that passes")
+    args = parser.parse_args()
+
+    if args.export:
+        if not Path(EMBEDDING_MODEL_DIR).exists():
+            download_model()
+        export_onnx(quantize=args.export == "onnx-int8")
+    if args.check:
+        if not check_parity(args.check, args.sample_size, args.min_similarity, args.min_recall):
+            logging.error(f"The {args.check} backend does not match the indexed vectors")
+            sys.exit(1)
+    if not args.export and not args.check:
+        download_model()
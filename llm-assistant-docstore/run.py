@@ -1,4 +1,15 @@
+import argparse
+import os
 import uvicorn
 
 if __name__ == "__main__":
-    uvicorn.run("app.main:app", host="0.0.0.0", port=8001, reload=True) 
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Run the document store API")
+    parser.add_argument(
+        "--production",
+        action="store_true",
+        default=os.getenv("RUN_MODE") == "production",
+        help="Run without auto-reload, so the embedding model is loaded once and never reloaded on file changes"
+    )
+    args = parser.parse_args()
+
+    uvicorn.run("app.main:app", host="0.0.0.0", port=8001, reload=not args.production)
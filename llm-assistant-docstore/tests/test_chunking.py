@@ -0,0 +1,34 @@
+import random
+
+from app.services.chunking import Chunker
+
+
+def chunk(text: str, piece_size: int, max_tokens: int = 32, overlap_tokens: int = 4):
+    chunker = Chunker(max_tokens, overlap_tokens)
+    spans = []
+    for start in range(0, len(text), piece_size):
+        spans.extend(chunker.feed(text[start:start + piece_size]))
+    spans.extend(chunker.close())
+    return spans
+
+
+def uncovered(text: str, spans) -> list:
+    """Offsets of non-whitespace characters that are in no span"""
+    covered = bytearray(len(text))
+    for start, end in spans:
+        covered[start:end] = b"\x01" * (end - start)
+    return [offset for offset, char in enumerate(text) if not covered[offset] and not char.isspace()]
+
+
+def test_long_unbroken_fenced_lines_are_covered():
+    random.seed(7)
+    for _ in range(20):
+        lines = ["".join(random.choice("abc(),;=") for _ in range(random.randint(1, 3000))) for _ in range(5)]
+        text = "Intro text.\n\n```\n" + "\n".join(lines) + "\n```\n\nOutro text.\n"
+        for piece_size in (7, 100, 4096, len(text)):
+            assert uncovered(text, chunk(text, piece_size)) == []
+
+
+def test_spans_cover_prose_and_code():
+    text = "# Title\n\nSome prose. " * 40 + "\n```python\n" + "x = compute(y)\n" * 200 + "```\n"
+    assert uncovered(text, chunk(text, 50)) == []
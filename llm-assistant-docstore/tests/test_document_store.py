@@ -0,0 +1,23 @@
+import random
+
+from app.services.document_store import DocumentStore
+
+
+def test_get_slice_matches_text_slices(tmp_path):
+    store = DocumentStore(str(tmp_path))
+    random.seed(3)
+    alphabet = "ab \n\r€é日本😀"
+    text = "".join(random.choice(alphabet) for _ in range(5000))
+    doc_id = store.put(text)
+
+    for _ in range(300):
+        start = random.randint(0, len(text) + 5)
+        end = random.choice([None, random.randint(0, len(text) + 5)])
+        block_size = random.choice([1, 2, 3, 7, 64, 4096])
+        assert store.get_slice(doc_id, start, end, block_size=block_size) == (text[start:end], len(text))
+
+
+def test_get_slice_of_missing_and_empty_documents(tmp_path):
+    store = DocumentStore(str(tmp_path))
+    assert store.get_slice("0" * 64) is None
+    assert store.get_slice(store.put(""), 0, 10) == ("", 0)
@@ -0,0 +1,215 @@
+from app.services.document_store import DocumentStore
+from app.services.ingestion import IngestionPipeline, iter_document_files
+from app.services.manifest import Manifest
+from app.services.vector_index import CompactVectorIndex, PLACEHOLDER_EMBEDDING
+
+
+class FakeCollection:
+    """The part of a Chroma collection the ingestion pipeline uses"""
+
+    def __init__(self, name="langchain"):
+        self.name = name
+        self.rows = {}
+        self.embeddings = {}
+
+    @staticmethod
+    def _matches(metadata, where):
+        return all(metadata.get(key) == value for key, value in (where or {}).items())
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        for chunk_id, embedding, metadata, text in zip(ids, embeddings, metadatas, documents):
+            self.rows[chunk_id] = (metadata, text)
+            self.embeddings[chunk_id] = embedding
+
+    def delete(self, where=None, ids=None):
+        for chunk_id in [
+            chunk_id for chunk_id, (metadata, _) in self.rows.items()
+            if self._matches(metadata, where) and (ids is None or chunk_id in ids)
+        ]:
+            del self.rows[chunk_id]
+            del self.embeddings[chunk_id]
+
+    def get(self, where=None, include=(), limit=None, offset=0):
+        rows = [(chunk_id, metadata, text) for chunk_id, (metadata, text) in self.rows.items() if self._matches(metadata, where)]
+        rows = rows[offset:offset + limit if limit else None]
+        return {
+            "ids": [row[0] for row in rows],
+            "metadatas": [row[1] for row in rows],
+            "documents": [row[2] for row in rows],
+            "embeddings": [self.embeddings[row[0]] for row in rows],
+        }
+
+    def count(self):
+        return len(self.rows)
+
+
+class FakeClient:
+    def __init__(self):
+        self.deleted = []
+
+    def delete_collection(self, name):
+        self.deleted.append(name)
+
+
+class FakeDB:
+    def __init__(self, name="langchain"):
+        self._collection = FakeCollection(name)
+        self._client = FakeClient()
+
+
+class FakeEmbeddings:
+    def embed_documents(self, texts):
+        return [[1.0, 0.0] for _ in texts]
+
+
+def test_replaced_text_is_kept_for_identical_file_in_same_run(tmp_path):
+    documents = tmp_path / "documents"
+    documents.mkdir()
+    store = DocumentStore(str(tmp_path / "store"))
+    db = FakeDB()
+    pipeline = IngestionPipeline(
+        db, FakeEmbeddings(), store, Manifest(str(tmp_path / "manifest.sqlite3")),
+        # Chunks stay queued in the writer until the run finishes
+        embed_batch_size=1000, upsert_batch_size=1000
+    )
+
+    (documents / "a.txt").write_text("The original text of the first file.")
+    pipeline.sync_directory(str(documents))
+    original_id = store.compute_id("The original text of the first file.")
+
+    # a.txt changes, and b.txt now has a.txt's previous content
+    (documents / "a.txt").write_text("The new text of the first file.")
+    (documents / "b.txt").write_text("The original text of the first file.")
+    pipeline.sync_directory(str(documents))
+
+    doc_ids = {metadata["doc_id"] for metadata, _ in db._collection.rows.values()}
+    assert original_id in doc_ids
+    assert all(store.exists(doc_id) for doc_id in doc_ids)
+
+
+def test_replaced_text_is_deleted_when_unreferenced(tmp_path):
+    documents = tmp_path / "documents"
+    documents.mkdir()
+    store = DocumentStore(str(tmp_path / "store"))
+    pipeline = IngestionPipeline(FakeDB(), FakeEmbeddings(), store, Manifest(str(tmp_path / "manifest.sqlite3")))
+
+    (documents / "a.txt").write_text("The original text of the first file.")
+    pipeline.sync_directory(str(documents))
+    (documents / "a.txt").write_text("The new text of the first file.")
+    pipeline.sync_directory(str(documents))
+
+    assert not store.exists(store.compute_id("The original text of the first file."))
+    assert store.exists(store.compute_id("The new text of the first file."))
+
+
+class InterleavingEmbeddings(FakeEmbeddings):
+    """Runs another indexing job the first time chunks are embedded, before they are upserted"""
+
+    def __init__(self):
+        self.interleaved = None
+
+    def embed_documents(self, texts):
+        job, self.interleaved = self.interleaved, None
+        if job is not None:
+            job()
+        return super().embed_documents(texts)
+
+
+def test_replaced_text_is_kept_while_another_job_indexes_it(tmp_path):
+    store = DocumentStore(str(tmp_path / "store"))
+    db = FakeDB()
+    embeddings = InterleavingEmbeddings()
+    pipeline = IngestionPipeline(db, embeddings, store, Manifest(str(tmp_path / "manifest.sqlite3")))
+    pipeline.index_stream("a.txt", ["The original text of the first file."])
+    original_id = store.compute_id("The original text of the first file.")
+
+    # While b.txt, with a.txt's content, is embedded, another job replaces a.txt
+    embeddings.interleaved = lambda: pipeline.index_stream("a.txt", ["The new text of the first file."])
+    pipeline.index_stream("b.txt", ["The original text of the first file."])
+
+    assert {metadata["doc_id"] for metadata, _ in db._collection.rows.values()} == {
+        original_id, store.compute_id("The new text of the first file.")
+    }
+    assert store.exists(original_id)
+
+    # Collected once nothing references it anymore
+    pipeline.index_stream("b.txt", ["The new text of the second file."])
+    assert not store.exists(original_id)
+
+
+def test_document_files_match_extensions_in_any_case(tmp_path):
+    for name in ("REPORT.PDF", "notes.TXT", "readme.md", "image.png"):
+        (tmp_path / name).write_text("")
+
+    assert sorted(path.name for path in iter_document_files(str(tmp_path))) == ["REPORT.PDF", "notes.TXT", "readme.md"]
+
+
+def test_files_of_the_same_name_in_different_folders_are_separate_sources(tmp_path):
+    documents = tmp_path / "documents"
+    (documents / "finance").mkdir(parents=True)
+    (documents / "legal").mkdir()
+    (documents / "finance" / "report.md").write_text("Revenue grew by twelve percent.")
+    (documents / "legal" / "report.md").write_text("The contract renews in June.")
+    (documents / "notes.txt").write_text("Top-level files keep their name.")
+    db = FakeDB()
+    pipeline = IngestionPipeline(
+        db, FakeEmbeddings(), DocumentStore(str(tmp_path / "store")), Manifest(str(tmp_path / "manifest.sqlite3"))
+    )
+
+    pipeline.sync_directory(str(documents))
+    assert set(pipeline.indexed_sources()) == {"finance/report.md", "legal/report.md", "notes.txt"}
+
+    stats = pipeline.sync_directory(str(documents))
+    assert (stats.unchanged, stats.documents, stats.removed) == (3, 0, 0)
+
+
+class CountingEmbeddings(FakeEmbeddings):
+    def __init__(self):
+        self.embedded = 0
+
+    def embed_documents(self, texts):
+        self.embedded += len(texts)
+        return [[1.0, float(len(text))] for text in texts]
+
+
+def test_compact_backend_keeps_no_vectors_in_the_vector_store(tmp_path):
+    db = FakeDB("chunks")
+    vector_index = CompactVectorIndex(str(tmp_path / "vectors"))
+    pipeline = IngestionPipeline(
+        db, CountingEmbeddings(), DocumentStore(str(tmp_path / "store")), Manifest(str(tmp_path / "manifest.sqlite3")),
+        vector_index=vector_index
+    )
+    pipeline.index_stream("a.txt", ["Revenue grew by twelve percent."])
+
+    chunk_ids = list(db._collection.rows)
+    assert all(db._collection.embeddings[chunk_id] == PLACEHOLDER_EMBEDDING for chunk_id in chunk_ids)
+    assert vector_index.count() == len(chunk_ids)
+    assert list(vector_index.vectors(chunk_ids)[chunk_ids[0]]) == [1.0, float(len("Revenue grew by twelve percent."))]
+
+
+def test_compact_backend_moves_the_full_collection_over(tmp_path):
+    full = FakeCollection("langchain")
+    full.upsert(["a-0", "b-0"], [[1.0, 0.0], [0.0, 1.0]], [{"source": "a.txt"}, {"source": "b.txt"}], ["A", "B"])
+    db = FakeDB("chunks")
+    # Left from an earlier run with the compact backend
+    db._collection.upsert(["stale-0"], [PLACEHOLDER_EMBEDDING], [{"source": "stale.txt"}], ["S"])
+    vector_index = CompactVectorIndex(str(tmp_path / "vectors"))
+    embeddings = CountingEmbeddings()
+    pipeline = IngestionPipeline(
+        db, embeddings, DocumentStore(str(tmp_path / "store")), Manifest(str(tmp_path / "manifest.sqlite3")),
+        vector_index=vector_index
+    )
+
+    pipeline.ensure_vector_index(full)
+
+    assert set(db._collection.rows) == {"a-0", "b-0"}
+    assert all(embedding == PLACEHOLDER_EMBEDDING for embedding in db._collection.embeddings.values())
+    assert list(vector_index.vectors(["b-0"])["b-0"]) == [0.0, 1.0]
+    assert db._client.deleted == ["langchain"]
+    assert embeddings.embedded == 0
+
+    # Rebuilt by embedding the stored texts when the index lost track
+    vector_index.clear()
+    pipeline.ensure_vector_index()
+    assert vector_index.count() == 2
+    assert embeddings.embedded == 2
@@ -0,0 +1,24 @@
+from datetime import datetime, timezone
+
+from app.models.document import QueryFilters
+
+
+def timestamp(*args) -> int:
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+
+def test_date_only_range_includes_the_whole_day():
+    filters = QueryFilters(modified_after="2024-05-01", modified_before="2024-05-01")
+
+    after, before = int(filters.modified_after.timestamp()), int(filters.modified_before.timestamp())
+    assert after == timestamp(2024, 5, 1)
+    assert before == timestamp(2024, 5, 1, 23, 59, 59)
+    assert after <= timestamp(2024, 5, 1, 15, 30) <= before
+    assert timestamp(2024, 5, 2) > before
+
+
+def test_times_without_timezone_are_utc():
+    filters = QueryFilters(modified_after="2024-05-01T08:00:00", modified_before="2024-05-01T12:00:00+02:00")
+
+    assert int(filters.modified_after.timestamp()) == timestamp(2024, 5, 1, 8)
+    assert int(filters.modified_before.timestamp()) == timestamp(2024, 5, 1, 10)
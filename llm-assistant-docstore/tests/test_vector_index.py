@@ -0,0 +1,36 @@
+import numpy as np
+
+from app.services.vector_index import CompactVectorIndex
+
+
+def build_index(path, count: int = 400, dim: int = 16, **kwargs) -> CompactVectorIndex:
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(count, dim)).astype(np.float32)
+    index = CompactVectorIndex(str(path), **kwargs)
+    index.add((f"chunk-{i}", vector.tolist(), {"source": f"doc-{i % 7}.txt"}) for i, vector in enumerate(vectors))
+    index.flush()
+    return index
+
+
+def test_approximate_scores_of_unsorted_slots(tmp_path):
+    index = build_index(tmp_path)
+    queries = np.random.default_rng(1).normal(size=(2, 16)).astype(np.float32)
+
+    for slots in ([5, 3, 4, 7], [3, 5, 4, 6], [7, 6, 5, 4], [10, 11, 12, 13]):
+        slots = np.asarray(slots)
+        expected = np.stack([
+            (index._quantized[slot].astype(np.float32) @ queries.T) * index._scales[slot] for slot in slots
+        ])
+        assert np.allclose(index._approximate_scores(slots, queries), expected)
+
+
+def test_ivf_search_matches_exact_search(tmp_path):
+    index = build_index(tmp_path, min_train_size=100, probes=1000, rerank_factor=1000)
+    assert index._centroids is not None
+    rng = np.random.default_rng(2)
+    vectors = np.stack([index._read_exact(np.asarray([slot]))[0] for slot in range(400)])
+
+    for query in rng.normal(size=(5, 16)).astype(np.float32):
+        hits = index.search([query.tolist()], 5)[0]
+        expected = np.argsort(np.sum((vectors - query) ** 2, axis=1))[:5]
+        assert [hit.chunk_id for hit in hits] == [f"chunk-{slot}" for slot in expected]
@@ -376,6 +376,7 @@ export class ContextPanel extends LitElement {
           source: result.metadata.source,
           similarity: result.metadata.similarity,
           relevance: result.metadata.relevance,
+          docId: result.metadata.doc_id,
           fullDocument: result.metadata.full_document
         }));
 
@@ -384,8 +385,19 @@ export class ContextPanel extends LitElement {
     }
   }
 
-  showFullDocument(context) {
+  async showFullDocument(context) {
     this.selectedContext = context;
+    if (context.fullDocument || !context.docId) return;
+
+    // Full text is no longer part of query results, load it on demand
+    try {
+      const response = await fetch(`http://localhost:8001/documents/${context.docId}`);
+      const data = await response.json();
+      context.fullDocument = data.text;
+      this.selectedContext = { ...context };
+    } catch (error) {
+      console.error('Error fetching document:', error);
+    }
   }
 
   closeDocument() {
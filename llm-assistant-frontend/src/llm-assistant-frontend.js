@@ -22,6 +22,29 @@ class LlmAssistantFrontend extends LitElement {
     this.inputText = '';
     this.isLoading = false;
     this.waitingForFirstToken = false;
+    // Identifies the conversation kept by the backend, and lets it reuse the model state of earlier turns
+    this.sessionId = crypto.randomUUID();
+    // Set once the backend has the conversation
+    this.sessionStarted = false;
+  }
+
+  postMessage(message, history) {
+    // The backend keeps the conversation, only the new message is sent. The first
+    // message starts it, with the earlier turns when the backend lost them
+    const startSession = !this.sessionStarted || history !== undefined;
+    return fetch('http://localhost:8080/chat/stream', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json'
+      },
+      body: JSON.stringify({
+        message,
+        temperature: 0.7,
+        max_tokens: 2000,
+        session_id: this.sessionId,
+        ...(startSession ? { new_session: true, messages: history || [] } : {})
+      })
+    });
   }
 
   handleInputChange(e) {
@@ -54,17 +77,16 @@ class LlmAssistantFrontend extends LitElement {
     this.messages = [...this.messages, assistantMessage];
 
     try {
-      const response = await fetch('http://localhost:8080/chat/stream', {
-        method: 'POST',
-        headers: {
-          'Content-Type': 'application/json'
-        },
-        body: JSON.stringify({
-          messages: this.messages.slice(0, -1),
-          temperature: 0.7,
-          max_tokens: 2000
-        })
-      });
+      let response = await this.postMessage(userMessage.content);
+      if (response.status === 404) {
+        // The backend restarted or forgot the conversation, send it the earlier turns again
+        const history = this.messages.slice(0, -2).filter(message => message.content);
+        response = await this.postMessage(userMessage.content, history);
+      }
+      if (!response.ok) {
+        throw new Error(`Chat request failed with status ${response.status}`);
+      }
+      this.sessionStarted = true;
 
       const reader = response.body.getReader();
       const decoder = new TextDecoder();